@@ -261,5 +261,5 @@ rule perfire_recovery:
 
 # ### MERGE ALL PER-FIRE RECOVERY MAPS ###
 # """
-# task array: 1 job per 100 fires. last job waits for jobs 1 to n-1 to complete, then does final merge.
+# one job: statewide grid split into tiles, merged in parallel (MERGE_WORKERS); newest fire wins in each tile.
 # """
\ No newline at end of file
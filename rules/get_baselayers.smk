@@ -31,9 +31,13 @@ rule get_landfire:
         link=lambda wildcards: config['LANDFIRE_PRODUCTS'][wildcards.prod]['link'],
         checksum=lambda wildcards: config['LANDFIRE_PRODUCTS'][wildcards.prod]['checksum'],
         dir_name=lambda wildcards: get_path(config['LANDFIRE_PRODUCTS'][wildcards.prod]['dir_name'], ROI_PATH),
+        threads=4,
         conda_env='RIO_GPD',
         email=config['NOTIFY_EMAIL']
 
+    resources:
+        cpus=4
+
     conda: 
         '../workflow/envs/get_baselayers_env.yml'
 
@@ -51,7 +55,8 @@ rule get_landfire:
              {params.dir_name} \
              {output.metadata_dir} \
              {params.ROI} \
-             {output.done_flag}  > {log.stdout} 2> {log.stderr}
+             {output.done_flag} \
+             {params.threads}  > {log.stdout} 2> {log.stderr}
         """
 
 
@@ -72,11 +77,13 @@ rule make_hdist:
         timedim=config['BASELAYERS']['annual_dist']['dims']['timedim'],
         start_year=config['LANDFIRE_PRODUCTS']['Disturbance']['start_year'],
         end_year=config['LANDFIRE_PRODUCTS']['Disturbance']['end_year'],
+        threads=6,
         conda_env='RIO_GPD',
         email=config['NOTIFY_EMAIL']
     
     resources:
-        mem_gb=100
+        mem_gb=20,
+        cpus=6
 
     conda: 
         '../workflow/envs/get_baselayers_env.yml'
@@ -98,7 +105,8 @@ rule make_hdist:
              {params.timedim} \
              {params.start_year} \
              {params.end_year} \
-             {output.done_flag} > {log.stdout} 2> {log.stderr}
+             {output.done_flag} \
+             {params.threads} > {log.stdout} 2> {log.stderr}
         """
         
         
@@ -115,11 +123,13 @@ rule make_agdevmask:
         nlcd_dir=get_path(config['NLCD']['dir_name'], ROI_PATH),
         vegcodes_csv=get_path(config['NLCD']['vegcodes_csv'], ROI_PATH),
         dtype=config['BASELAYERS']['agdev_mask']['dtype'],
+        threads=6,
         conda_env='RIO_GPD',
         email=config['NOTIFY_EMAIL']
 
     resources:
-        mem_gb=100
+        mem_gb=10,
+        cpus=6
 
     conda: 
         '../workflow/envs/get_baselayers_env.yml'
@@ -136,7 +146,8 @@ rule make_agdevmask:
              {params.vegcodes_csv} \
              {output.merged_out_path} \
              {params.dtype} \
-             {output.done_flag}  > {log.stdout} 2> {log.stderr}
+             {output.done_flag} \
+             {params.threads}  > {log.stdout} 2> {log.stderr}
         """
 
 
@@ -234,9 +245,14 @@ rule download_nlcd:
         start_year=start_year,
         end_year=end_year,
         ROI=ROI_PATH,
+        download_threads=4, # network-bound downloads
+        threads=4, # cpu-bound clipping
         conda_env='RIO_GPD',
         email=config['NOTIFY_EMAIL']
 
+    resources:
+        cpus=4
+
     conda: 
         '../workflow/envs/get_baselayers_env.yml'
 
@@ -254,7 +270,9 @@ rule download_nlcd:
         {params.start_year} \
         {params.end_year} \
         {params.ROI} \
-        {output.done_flag}  > {log.stdout} 2> {log.stderr}
+        {output.done_flag} \
+        {params.download_threads} \
+        {params.threads}  > {log.stdout} 2> {log.stderr}
         """
 
 
@@ -273,6 +291,7 @@ rule make_groupings:
         vegcodes_csv=get_path(config['NLCD']['vegcodes_csv'], ROI_PATH),
         groupings_csv=get_path(config['BASELAYERS']['groupings']['summary_csv'], ROI_PATH),
         merged_topo=get_path(config['BASELAYERS']['topo']['fname'], ROI_PATH),
+        threads=6,
         conda_env='RIO_GPD',
         email=config['NOTIFY_EMAIL']
 
@@ -280,7 +299,8 @@ rule make_groupings:
         '../workflow/envs/get_baselayers_env.yml'
 
     resources:
-        mem_gb=120
+        mem_gb=40,
+        cpus=6
 
     log: 
         stdout=get_path('logs/baselayers/make_groupings.log', ROI_PATH),
@@ -296,5 +316,6 @@ rule make_groupings:
         {params.groupings_csv} \
         {params.merged_topo} \
         {output.out_f} \
-        {output.done_flag}  > {log.stdout} 2> {log.stderr}
+        {output.done_flag} \
+        {params.threads}  > {log.stdout} 2> {log.stderr}
         """
\ No newline at end of file
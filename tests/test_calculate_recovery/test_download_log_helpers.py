@@ -0,0 +1,116 @@
+import pytest
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import sys
+from shapely.geometry import box
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+sys.path.append('workflow/calculate_recovery/get_landsat_seasonal')
+from download_log_helpers import *
+from download_log_db import DOWNLOAD_LOG_COLS
+
+
+class TestChooseYrsPerRequest:
+    """Test suite for choose_yrs_per_request"""
+
+    @pytest.fixture
+    def bbox_shp(self, tmp_path):
+        """10km x 10km (100 km2) buffered fire bbox"""
+        shp_path = str(tmp_path / 'fire_bufferedshp.shp')
+        gpd.GeoDataFrame(geometry=[box(0, 0, 10000, 10000)], crs='EPSG:5070').to_file(shp_path)
+        return shp_path
+
+    def config(self, **landsat_config):
+        return {'LANDSAT': {'NUM_YRS_PER_REQUEST': 8, 'MIN_YRS_PER_REQUEST': 2, 'MAX_YRS_PER_REQUEST': 6, **landsat_config}}
+
+    def test_target_bundle_size(self, bbox_shp):
+        """Test that the number of years gives a bundle of ~TARGET_BUNDLE_GB (0.1 GB/yr for this bbox)"""
+        rates = {'gb_per_km2_yr': 0.001}
+
+        assert choose_yrs_per_request(bbox_shp, self.config(TARGET_BUNDLE_GB=0.5), rates) == 5
+
+    def test_clamped_to_min_max(self, bbox_shp):
+        """Test that very small/large bundles are clamped to MIN/MAX_YRS_PER_REQUEST"""
+        rates = {'gb_per_km2_yr': 0.001}
+
+        assert choose_yrs_per_request(bbox_shp, self.config(TARGET_BUNDLE_GB=100), rates) == 6
+        assert choose_yrs_per_request(bbox_shp, self.config(TARGET_BUNDLE_GB=0.01), rates) == 2
+
+    def test_target_task_hours(self, bbox_shp):
+        """Test that known latencies cap the years so tasks take ~TARGET_TASK_HOURS (still clamped)"""
+        rates = {'gb_per_km2_yr': 0.001, 'hours_per_gb': 10}
+
+        assert choose_yrs_per_request(bbox_shp, self.config(TARGET_BUNDLE_GB=100, TARGET_TASK_HOURS=3), rates) == 3
+        assert choose_yrs_per_request(bbox_shp, self.config(TARGET_BUNDLE_GB=100, TARGET_TASK_HOURS=0.5), rates) == 2
+
+    def test_no_target(self, bbox_shp):
+        """Test that NUM_YRS_PER_REQUEST is used when TARGET_BUNDLE_GB isn't set"""
+        assert choose_yrs_per_request(bbox_shp, self.config()) == 8
+
+
+class TestSplitFailedRequest:
+    """Test suite for split_failed_request"""
+
+    @pytest.fixture
+    def download_log(self, tmp_path):
+        """One fire with a 6 year window, a single year window, and a window split at the bad date"""
+        windows = [
+            ('2015-01-01', '2020-12-31'),
+            ('2021-01-01', '2021-12-31'),
+            ('2022-01-01', (LANDSAT_BAD_DATE - timedelta(days=1)).strftime('%Y-%m-%d')),
+            ((LANDSAT_BAD_DATE + timedelta(days=1)).strftime('%Y-%m-%d'), '2026-12-31')
+        ]
+        download_log = pd.DataFrame({
+            'submit_order': [1, 2, 3, 4],
+            'fire_name': 'fire',
+            'fireid': 'A',
+            'sensitivity': False,
+            'fire_year': 2014,
+            'start_date': pd.to_datetime([start for start, _ in windows]),
+            'end_date': pd.to_datetime([end for _, end in windows]),
+            'dest_dir': '',
+            'task_id': 'task',
+            'bundle': np.nan,
+            'task_status': 'submitted',
+            'task_submitted_time': pd.Timestamp('2025-01-01'),
+            'bundle_received_time': np.nan,
+            'download_complete': False,
+            'ndvi_mosaic_complete': False,
+            'get_bundle_tries_left': 0,
+            'download_bundle_tries_left': 20,
+            'mosaic_tries_left': 20,
+            'bufferedfire_shp_path': 'fire_bufferedshp.shp',
+            'request_leader': [1, 2, 3, 4],
+            'request_shp_path': 'fire_bufferedshp.shp',
+            'shared_dir': ''
+        })[DOWNLOAD_LOG_COLS]
+        download_log_path = str(tmp_path / 'download_log.db')
+        create_download_log_db(download_log, download_log_path)
+        return read_download_log(download_log_path), download_log_path
+
+    def test_split_at_year_boundary(self, download_log):
+        """Test that a failed multi-year window is split in two, and both halves are reset to unsubmitted (in the df and db)"""
+        download_log, download_log_path = download_log
+        new_submit_order = split_failed_request(download_log, download_log_path, 1)
+
+        assert new_submit_order == 5
+        for log in [download_log, read_download_log(download_log_path)]:
+            rows = log.set_index('submit_order').loc[[1, 5]]
+            assert list(rows['start_date']) == [pd.Timestamp('2015-01-01'), pd.Timestamp('2018-01-01')]
+            assert list(rows['end_date']) == [pd.Timestamp('2017-12-31'), pd.Timestamp('2020-12-31')]
+            assert list(rows['task_status']) == ['unsubmitted'] * 2
+            assert list(rows['get_bundle_tries_left']) == [DEFAULT_GET_BUNDLE_TRIES] * 2
+            assert list(rows['request_leader']) == [1, 5]
+            assert rows['task_id'].isna().all()
+
+    def test_not_split(self, download_log):
+        """Test that single year windows and bad date split windows are left untouched"""
+        download_log, download_log_path = download_log
+        before = download_log.copy()
+
+        for submit_order in [2, 3, 4]:
+            assert split_failed_request(download_log, download_log_path, submit_order) is None
+
+        pd.testing.assert_frame_equal(download_log, before)
+        pd.testing.assert_frame_equal(read_download_log(download_log_path), before)
@@ -0,0 +1,72 @@
+import pytest
+import numpy as np
+import pandas as pd
+import sys
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+sys.path.append('workflow/calculate_recovery/get_landsat_seasonal')
+import download_scheduler
+from download_scheduler import *
+
+
+class TestDownloadScheduler:
+    """Test suite for DownloadScheduler's priority queue + concurrent-task budget"""
+
+    @pytest.fixture
+    def download_log(self):
+        """5 unsubmitted tasks over 3 fires; only fire C is a sensitivity fire"""
+        submit_orders = [1, 2, 3, 4, 5]
+        return pd.DataFrame({
+            'submit_order': submit_orders,
+            'fireid': ['A', 'A', 'B', 'C', 'C'],
+            'sensitivity': [False, False, False, True, True],
+            'task_status': ['unsubmitted'] * 5,
+            'ndvi_mosaic_complete': [False] * 5,
+            'get_bundle_tries_left': [20] * 5,
+            'request_leader': submit_orders
+        })
+
+    @pytest.fixture
+    def submitted(self, monkeypatch):
+        """Record the submit_order of each post request, instead of posting it to appeears"""
+        submitted = []
+        monkeypatch.setattr(download_scheduler, 'create_post_request', lambda download_log, download_log_path, submit_order, config, perfire_config: submitted.append(submit_order))
+        return submitted
+
+    def scheduler(self, download_log, max_active_tasks, on_fire_ready=None):
+        return DownloadScheduler(download_log, 'download_log.db', {'LANDSAT': {}}, {}, max_active_tasks=max_active_tasks, on_fire_ready=on_fire_ready)
+
+    def test_priority_order(self, download_log, submitted):
+        """Test that sensitivity fires are submitted first, then the rest in submit_order"""
+        scheduler = self.scheduler(download_log, max_active_tasks=10)
+        scheduler.submit_tasks()
+
+        assert submitted == [4, 5, 1, 2, 3]
+        assert scheduler.active == {1, 2, 3, 4, 5}
+
+    def test_budget_limit(self, download_log, submitted):
+        """Test that no more than max_active_tasks are submitted at once, and finished tasks free up the budget"""
+        scheduler = self.scheduler(download_log, max_active_tasks=2)
+        scheduler.submit_tasks()
+        assert submitted == [4, 5]
+
+        scheduler.submit_tasks()
+        assert submitted == [4, 5]
+
+        scheduler.set_state(4, TASK_READY)
+        scheduler.submit_tasks()
+        assert submitted == [4, 5, 1]
+        assert scheduler.active == {5, 1}
+        assert scheduler.tasks_left() == 4
+
+    def test_fire_ready_once_all_tasks_done(self, download_log, submitted):
+        """Test that on_fire_ready is called once per fire, after its last task is ready"""
+        ready = []
+        scheduler = self.scheduler(download_log, max_active_tasks=10, on_fire_ready=ready.append)
+        scheduler.submit_tasks()
+
+        scheduler.set_state(4, TASK_READY)
+        assert ready == []
+        scheduler.set_state(5, TASK_READY)
+        scheduler.set_state(5, TASK_READY)
+        assert ready == ['C']
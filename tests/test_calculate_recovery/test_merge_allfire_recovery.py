@@ -0,0 +1,38 @@
+import pytest
+import numpy as np
+import sys
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+sys.path.append('workflow/calculate_recovery/merged_recovery')
+from workflow.calculate_recovery.merged_recovery.merge_allfire_recovery import *
+from workflow.calculate_recovery.merged_recovery.merged_band_info import band_info, nodata_value
+
+
+class TestDownsample2x:
+    """Test suite for downsample_2x, with the merged bands' own overview settings"""
+
+    def downsample(self, arr, band_name):
+        info = band_info[band_name]
+        return downsample_2x(np.array(arr, dtype=info['dtype']), info['nodata'], info['overview_resampling'], info.get('overview_sentinel'))
+
+    def test_recovery_time_mean_skips_never_recovered(self):
+        """Test that never recovered (127) is left out of recovery time means, and kept only for all-127 blocks"""
+        for band_name in ['matched_recovery_time', 'prefire_baseline_recovery_time']:
+            out = self.downsample([
+                [5, 127, 127, 127, 127, nodata_value, nodata_value, nodata_value],
+                [127, 127, 127, 4, nodata_value, 127, nodata_value, nodata_value]
+            ], band_name)
+
+            assert list(out[0]) == [5, 4, 127, nodata_value]
+
+    def test_average_without_sentinel(self):
+        """Test that other averaged bands keep a plain mean of the valid values"""
+        out = self.downsample([[10, 20, nodata_value, 127], [30, nodata_value, nodata_value, 127]], 'burn_bndy_dist')
+
+        assert list(out[0]) == [20, 127]
+
+    def test_mode_ignores_nodata(self):
+        """Test that categorical bands take the most common valid value in each block"""
+        out = self.downsample([[1, 1, nodata_value, nodata_value], [0, nodata_value, nodata_value, 3]], 'matched_recovery_status')
+
+        assert list(out[0]) == [1, 3]
@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import os, sys
+from datetime import datetime
+from shapely.geometry import box
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+sys.path.append('workflow/calculate_recovery/get_landsat_seasonal')
+from shared_requests import *
+
+
+class TestPlanSharedRequests:
+    """Test suite for plan_shared_requests"""
+
+    BAD_DATE = datetime(2024, 6, 8)
+
+    def bbox_shp(self, tmp_path, name, bounds):
+        shp_path = str(tmp_path / f'{name}_bufferedshp.shp')
+        gpd.GeoDataFrame(geometry=[box(*bounds)], crs=AREA_CRS).to_file(shp_path)
+        return shp_path
+
+    @pytest.fixture
+    def download_log(self, tmp_path):
+        """
+        Reburns A and B (same bbox) with their windows split at the bad date, C (same bbox) spanning the bad date,
+        and D (same dates as A's first window) far away.
+        """
+        shp_path = self.bbox_shp(tmp_path, 'AB', (0, 0, 10000, 10000))
+        rows = [
+            (1, 'A', shp_path, '2021-01-01', '2024-06-07'),
+            (2, 'A', shp_path, '2024-06-09', '2026-12-31'),
+            (3, 'B', shp_path, '2023-01-01', '2024-06-07'),
+            (4, 'B', shp_path, '2024-06-09', '2027-12-31'),
+            (5, 'C', self.bbox_shp(tmp_path, 'C', (5000, 5000, 15000, 15000)), '2022-01-01', '2025-12-31'),
+            (6, 'D', self.bbox_shp(tmp_path, 'D', (500000, 500000, 510000, 510000)), '2021-01-01', '2024-06-07')
+        ]
+        download_log = pd.DataFrame(rows, columns=['submit_order', 'fireid', 'bufferedfire_shp_path', 'start_date', 'end_date'])
+        download_log['start_date'] = pd.to_datetime(download_log['start_date'])
+        download_log['end_date'] = pd.to_datetime(download_log['end_date'])
+        download_log['ndvi_mosaic_complete'] = False
+        download_log['task_status'] = 'unsubmitted'
+        download_log['task_id'] = pd.Series([np.nan] * len(rows), dtype=object)
+        return download_log
+
+    def test_groups_skip_bad_date(self, download_log, tmp_path):
+        """Test that overlapping rows on the same side of the bad date are shared, and no shared union spans the bad date"""
+        shared_requests_dir = str(tmp_path / 'shared_requests')
+        download_log = plan_shared_requests(download_log, shared_requests_dir, self.BAD_DATE)
+
+        assert list(download_log['request_leader']) == [1, 2, 1, 2, 5, 6]
+        for leader, group in download_log.groupby('request_leader'):
+            if len(group) == 1: continue
+            assert not (group['start_date'].min() < self.BAD_DATE < group['end_date'].max())
+
+    def test_shared_request_bbox(self, download_log, tmp_path):
+        """Test that grouped rows request the union bbox, and ungrouped rows keep their own bbox"""
+        shared_requests_dir = str(tmp_path / 'shared_requests')
+        download_log = plan_shared_requests(download_log, shared_requests_dir, self.BAD_DATE)
+
+        assert list(download_log['request_shp_path'].iloc[[0, 2]]) == [os.path.join(shared_requests_dir, 'shared_request_1_bufferedshp.shp')] * 2
+        assert list(download_log['request_shp_path'].iloc[4:]) == list(download_log['bufferedfire_shp_path'].iloc[4:])
+        assert tuple(gpd.read_file(download_log['request_shp_path'].iloc[0]).total_bounds) == (0, 0, 10000, 10000)
+
+    def test_submitted_rows_not_grouped(self, download_log, tmp_path):
+        """Test that rows already submitted to appeears are left on their own"""
+        download_log.loc[download_log['submit_order']==3, ['task_status', 'task_id']] = ['submitted', 'abc']
+        download_log = plan_shared_requests(download_log, str(tmp_path / 'shared_requests'), self.BAD_DATE)
+
+        assert list(download_log['request_leader']) == [1, 2, 3, 2, 5, 6]
@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+import pandas as pd
+import sys
+
+sys.path.append('../../../fire_recovery')
+from workflow.get_baselayers.make_groupings import *
+
+
+def per_row_groupings(nlcd_arr, elev_arr, nlcd_yr_csv, output_csv, nodataval):
+    """Reference: the original make_singleyear_groupings (one np.where per grouping row)"""
+    out_data = np.full(nlcd_arr.shape, nodataval)
+    for _, row in output_csv.iterrows():
+        nlcd_val = int(nlcd_yr_csv['NLCD_CODE'][nlcd_yr_csv['NLCD_NAMES'] == row['NLCD_NAME']].iloc[0])
+        out_data = np.where((nlcd_arr == nlcd_val) & (elev_arr == int(row['ELEV_BAND'])), int(row['id']), out_data)
+    return out_data
+
+
+class TestGroupingsLut:
+    """Test suite for build_groupings_lut + make_singleyear_groupings against the per-row reclassification"""
+
+    @pytest.fixture
+    def groupings(self):
+        """Groupings for 3 veg types x elev bands -1..2, and 2 NLCD years whose codes differ"""
+        output_csv = pd.DataFrame([
+            (i, nlcd_name, elev_band)
+            for i, (nlcd_name, elev_band) in enumerate(
+                [(nlcd_name, elev_band) for nlcd_name in ['Deciduous Forest', 'Evergreen Forest', 'Shrub/Scrub'] for elev_band in range(-1, 3)],
+                start=1
+            )
+        ], columns=['id', 'NLCD_NAME', 'ELEV_BAND'])
+        nlcd_csv = pd.DataFrame({
+            'NLCD_CODE': [11, 41, 42, 52, 11, 41, 43, 71],
+            'NLCD_NAMES': ['Open Water', 'Deciduous Forest', 'Evergreen Forest', 'Shrub/Scrub'] * 2,
+            'year': [2001] * 4 + [2010] * 4
+        })
+        return output_csv, nlcd_csv
+
+    def test_lut_matches_per_row(self, groupings):
+        """Test that the lookup table gather gives the same groupings as the per-row np.where, for every year"""
+        output_csv, nlcd_csv = groupings
+        rng = np.random.default_rng(0)
+        # NLCD values from both years' codes plus unmapped/negative/past-the-table values; elev bands outside -1..2 too
+        nlcd_arr = rng.choice(np.array([-5, -1, 0, 11, 41, 42, 43, 52, 71, 95, 250], dtype=np.int16), (60, 70))
+        elev_arr = rng.integers(-4, 6, (60, 70)).astype(np.int8)
+
+        for year in [2001, 2010]:
+            nlcd_yr_csv = nlcd_csv[nlcd_csv['year'] == year]
+            lut, elev_min, n_elev_bands = build_groupings_lut(nlcd_yr_csv, output_csv, 0, np.int8)
+            out = make_singleyear_groupings(nlcd_arr, elev_arr, lut, elev_min, n_elev_bands, 0)
+
+            assert out.dtype == np.int8
+            assert np.array_equal(out, per_row_groupings(nlcd_arr, elev_arr, nlcd_yr_csv, output_csv, 0))
+
+    def test_years_use_their_own_codes(self, groupings):
+        """Test that the same NLCD value maps to different groupings in years whose codes differ"""
+        output_csv, nlcd_csv = groupings
+        nlcd_arr, elev_arr = np.array([[42, 43, 71]]), np.array([[0, 0, 0]])
+
+        outs = []
+        for year in [2001, 2010]:
+            lut, elev_min, n_elev_bands = build_groupings_lut(nlcd_csv[nlcd_csv['year'] == year], output_csv, 0, np.int8)
+            outs.append(list(make_singleyear_groupings(nlcd_arr, elev_arr, lut, elev_min, n_elev_bands, 0)[0]))
+
+        # elev band 0 is the 2nd band (ids: Deciduous 1-4, Evergreen 5-8, Shrub 9-12)
+        assert outs[0] == [6, 0, 0]
+        assert outs[1] == [0, 6, 10]
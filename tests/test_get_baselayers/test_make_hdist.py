@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+import pandas as pd
+import sys
+
+sys.path.append('../../../fire_recovery')
+from workflow.get_baselayers.make_hdist import *
+
+
+class TestDistLut:
+    """Test suite for build_dist_lut + update_annual_dist"""
+
+    VALID_YRS = range(2000, 2005)
+
+    @pytest.fixture
+    def rat(self):
+        """RAT with valid disturbances, a non-disturbance (no severity), a bad value, and years outside VALID_YRS"""
+        return pd.DataFrame({
+            'VALUE': [1, 2, 3, 4, 5, 6, 7, -1],
+            'YEAR': [2000, 2001, 2004, 1999, 2001, 2010, 2002, 2003],
+            'SEVERITY': ['Low', 'High', 'Medium', 'High', 'Unburned', 'Low', 'Medium', 'High']
+        })
+
+    def test_year_and_severity_lookups(self, rat):
+        """Test that each raster value maps to its year index and 1-3 severity; everything else is skipped"""
+        yr_idx_lut, sev_lut = build_dist_lut(rat, 'YEAR', self.VALID_YRS)
+
+        assert list(yr_idx_lut) == [-1, 0, 1, 4, -1, -1, -1, 2]
+        assert list(sev_lut) == [0, 1, 3, 2, 0, 0, 0, 2]
+
+    def test_out_of_range_years_warn(self, rat, capsys):
+        """Test that years outside valid_yrs are reported"""
+        build_dist_lut(rat, 'YEAR', self.VALID_YRS)
+
+        assert 'WARNING: [1999 2010] not valid years.' in capsys.readouterr().out
+
+    def test_max_severity_per_year(self, rat):
+        """Test that overlapping disturbance rasters keep the max severity of each year, per pixel"""
+        luts_a = build_dist_lut(rat, 'YEAR', self.VALID_YRS)
+        luts_b = build_dist_lut(pd.DataFrame({'VALUE': [1, 2], 'YEAR': [2000, 2001], 'SEVERITY': ['High', 'Low']}), 'YEAR', self.VALID_YRS)
+
+        annual_dist = np.zeros((len(self.VALID_YRS), 2, 3), dtype=np.int8)
+        update_annual_dist(annual_dist, np.array([[1, 2, 3], [0, 7, 99]]), *luts_a)
+        update_annual_dist(annual_dist, np.array([[1, 2, 0], [2, 1, 1]]), *luts_b)
+
+        # pixel (0, 0): 2000 Low (a) then High (b) -> High; pixel (0, 1): 2001 High (a) then Low (b) -> High
+        assert annual_dist[0].tolist() == [[3, 0, 0], [0, 3, 3]]
+        assert annual_dist[1].tolist() == [[0, 3, 0], [1, 0, 0]]
+        assert annual_dist[2].tolist() == [[0, 0, 0], [0, 2, 0]]
+        assert annual_dist[4].tolist() == [[0, 0, 2], [0, 0, 0]]
+        assert annual_dist[3].sum() == 0
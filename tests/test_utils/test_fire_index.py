@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import os, sys
+from shapely.geometry import box
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+from workflow.utils.fire_index import *
+
+
+class TestFireIndex:
+    """Test suite for build_fire_index and FireIndex queries"""
+
+    @pytest.fixture
+    def fire_index_path(self, tmp_path):
+        """Create 3 fire bundles (2 overlapping, 1 far away; 1 missing its severity raster) and index them"""
+        fires = pd.DataFrame({
+            'name': ['Old', 'New', 'Far', 'Failed'],
+            'fireid': ['CA0001120050801', 'CA0002220150701', 'CA0003320100601', 'CA0004420120101'],
+            'year': [2005, 2015, 2010, 2012]
+        })
+        polys = [
+            box(-2000000, 1800000, -1990000, 1810000),
+            box(-1995000, 1805000, -1985000, 1815000),
+            box(-1900000, 1700000, -1890000, 1710000),
+            box(-1900000, 1700000, -1890000, 1710000)
+        ]
+        for (_, fire), poly in zip(fires.iterrows(), polys):
+            spatialinfo_dir = tmp_path / 'bundles' / f'{fire["name"]}_{fire["fireid"]}' / 'spatialinfo'
+            os.makedirs(spatialinfo_dir)
+            gpd.GeoDataFrame(geometry=[poly], crs=INDEX_CRS).to_file(spatialinfo_dir / f'{fire["name"]}_{fire["fireid"]}_wumi_mtbs_poly.shp')
+            if fire['name'] != 'Failed':
+                (spatialinfo_dir / f'{fire["name"]}_{fire["fireid"]}_burnsev.tif').touch()
+        fires.to_csv(tmp_path / 'wumi_data.csv')
+
+        return build_fire_index(str(tmp_path / 'bundles'), str(tmp_path / 'wumi_data.csv'), get_fire_index_path(str(tmp_path)))
+
+    def test_index_order_follows_fire_date(self, fire_index_path):
+        """Test that only complete bundles are indexed, numbered 1-N in chronological order, with no uids yet"""
+        fires = FireIndex(fire_index_path).query_dates()
+
+        assert list(fires['name']) == ['Old', 'Far', 'New']
+        assert list(fires['index_order']) == [1, 2, 3]
+        assert list(fires['uid']) == [NO_UID, NO_UID, NO_UID]
+
+    def test_index_uids_from_progress_csv(self, fire_index_path, tmp_path):
+        """Test that uids are read from the progress csv's uid column when it has one"""
+        progress_csv = tmp_path / 'progress.csv'
+        pd.DataFrame({
+            'fireid': ['CA0001120050801', 'CA0003320100601', 'CA0004420120101', 'CA0002220150701'],
+            'uid': [1, 2, 3, 4]
+        }).to_csv(progress_csv, index=False)
+        index_path = build_fire_index(str(tmp_path / 'bundles'), str(tmp_path / 'wumi_data.csv'), str(tmp_path / 'index2.gpkg'), progress_csv=str(progress_csv))
+        fires = FireIndex(index_path).query_dates()
+
+        assert list(fires['name']) == ['Old', 'Far', 'New']
+        assert list(fires['index_order']) == [1, 2, 3]
+        assert list(fires['uid']) == [1, 2, 4]
+
+    def test_query_window_and_point(self, fire_index_path):
+        """Test window, point and date range queries"""
+        index = FireIndex(fire_index_path)
+
+        assert list(index.query_window((-1999000, 1801000, -1998000, 1802000))['name']) == ['Old']
+        assert list(index.query_window((-1999000, 1801000, -1986000, 1814000))['name']) == ['Old', 'New']
+        assert list(index.query_window((-1999000, 1801000, -1986000, 1814000), start_date='2010-01-01')['name']) == ['New']
+        assert list(index.query_point(-1992000, 1807000)['name']) == ['Old', 'New']
+        assert len(index.query_point(-1950000, 1750000)) == 0
+        assert list(index.query_point(-1950000, 1750000, footprint='buffered')['name']) == []
+        assert list(index.query_point(-1885000, 1705000, footprint='buffered')['name']) == ['Far']
+
+    def test_query_reburns(self, fire_index_path):
+        """Test that reburns are later fires overlapping the burn polygon"""
+        index = FireIndex(fire_index_path)
+
+        assert list(index.query_reburns('CA0001120050801')['name']) == ['New']
+        assert len(index.query_reburns('CA0002220150701')) == 0
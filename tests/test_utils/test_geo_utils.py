@@ -202,6 +202,108 @@ class TestReprojAlignRasters:
         assert reprojected.shape != original_shape
 
 
+class TestCalculateBurnbndyDist:
+    """Test suite for calculate_burnbndy_dist function"""
+
+    def test_distance_in_100m_from_edge(self):
+        """Test that distances are counted from the nearest unburned pixel, including past the array edge"""
+        burned = np.ones((1, 9), dtype=bool)
+        burned[0, 0] = False
+
+        dist = calculate_burnbndy_dist(burned, pixel_size=100)
+
+        assert dist.dtype == np.int8
+        assert list(dist[0]) == [0, 1, 1, 1, 1, 1, 1, 1, 1]
+
+    def test_bounded_tiles_match_saturated_distance(self):
+        """Test that small tiles give the same result as one tile, saturating at max_dist"""
+        burned = np.zeros((300, 400), dtype=bool)
+        burned[20:280, 30:370] = True
+
+        dist_one_tile = calculate_burnbndy_dist(burned, pixel_size=100, max_dist=50, tile_size=4096)
+        dist_small_tiles = calculate_burnbndy_dist(burned, pixel_size=100, max_dist=50, tile_size=32)
+
+        assert np.array_equal(dist_one_tile, dist_small_tiles)
+        assert dist_one_tile.max() == 50
+        assert dist_one_tile[0, 0] == 0
+
+    def test_export_burned_is_whole_perimeter(self, tmp_path):
+        """Test that every severity class inside the perimeter counts as burned, and severity 0/nodata as unburned"""
+        severity_tif = str(tmp_path / 'fire_burnsev.tif')
+        severity = np.tile(np.array([0, 1, 5, 6, 3, 3, -128, 3, 3], dtype=np.int8), (5, 1))
+        with rio.open(severity_tif, 'w', driver='GTiff', height=5, width=9, count=1, dtype='int8', nodata=-128,
+                      crs='EPSG:5070', transform=rio.transform.from_origin(0, 500, 100, 100)) as dst:
+            dst.write(severity, 1)
+
+        out_path = export_burnbndy_dist(severity_tif, get_burnbndy_dist_path(severity_tif))
+
+        with rio.open(out_path) as src:
+            assert list(src.read(1)[2]) == [0, 1, 2, 3, 2, 1, 0, 1, 1]
+
+
+class TestOpenMergedUid:
+    """Test suite for open_merged_uid function"""
+
+    @pytest.fixture
+    def uids(self):
+        return np.array([[0, 1, 99], [100, 812, 1127]], dtype=np.uint16)
+
+    def write_band(self, data, path, dtype, nodata):
+        da = xr.DataArray(
+            data,
+            dims=["y", "x"],
+            coords={"x": np.arange(data.shape[1]), "y": np.arange(data.shape[0])}
+        ).rio.write_crs("EPSG:5070")
+        export_to_tiff(da, str(path), dtype, nodata)
+
+    def test_split_and_single_layouts_match(self, uids, tmp_path):
+        """Test that UID_h/UID_to and the single UID band give the same UIDs"""
+        split_dir, single_dir = tmp_path / "split", tmp_path / "single"
+        os.makedirs(split_dir)
+        os.makedirs(single_dir)
+        self.write_band(np.where(uids > 0, uids.astype(np.int16) // 100, -128).astype(np.int8), split_dir / "merged_UID_h.tif", "int8", -128)
+        self.write_band(np.where(uids > 0, uids.astype(np.int16) % 100, -128).astype(np.int8), split_dir / "merged_UID_to.tif", "int8", -128)
+        self.write_band(uids, single_dir / "merged_UID.tif", "uint16", 0)
+
+        uid_split = open_merged_uid(str(split_dir / "merged_UID_h.tif"))
+        uid_single = open_merged_uid(str(single_dir / "merged_UID_h.tif"))
+
+        assert uid_split.dtype == np.uint16
+        assert np.array_equal(uid_split.data, uids)
+        assert np.array_equal(uid_single.data, uids)
+
+    def test_missing_layers_raise(self, tmp_path):
+        """Test that a missing UID layer raises FileNotFoundError"""
+        with pytest.raises(FileNotFoundError):
+            open_merged_uid(str(tmp_path / "merged_UID.tif"))
+
+
+class TestGetRasterMetadata:
+    """Test suite for get_raster_metadata, get_crs and get_gdalinfo"""
+
+    @pytest.fixture
+    def sample_tif(self, tmp_path):
+        path = str(tmp_path / "sample.tif")
+        with rio.open(path, "w", driver="GTiff", height=3, width=4, count=1, dtype="int16", crs="EPSG:5070",
+                      transform=rio.transform.from_origin(0, 3, 1, 1), nodata=-9999) as dst:
+            dst.write(np.arange(12, dtype=np.int16).reshape(1, 3, 4))
+        return path
+
+    def test_crs_dtype_nodata(self, sample_tif):
+        """Test that the CRS, GDAL dtype name and nodata are read in-process"""
+        assert get_crs(sample_tif) == pyproj.CRS("EPSG:5070")
+        assert get_gdalinfo(sample_tif) == {"dtype": "Int16", "nodata": -9999}
+        assert get_raster_metadata(sample_tif)["width"] == 4
+
+    def test_cache_follows_mtime(self, sample_tif):
+        """Test that metadata is cached until the file is modified"""
+        metadata = get_raster_metadata(sample_tif)
+        assert get_raster_metadata(sample_tif) is metadata
+
+        os.utime(sample_tif, ns=(0, os.stat(sample_tif).st_mtime_ns + 10**9))
+        assert get_raster_metadata(sample_tif) is not metadata
+
+
 # Integration test
 class TestIntegration:
     """Integration tests combining multiple functions"""
@@ -0,0 +1,60 @@
+import pytest
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import os, sys
+from shapely.geometry import box
+
+sys.path.append('/u/project/eordway/shared/surp_cd/fire_recovery')
+from workflow.utils.wumi_polys import *
+
+WUMI_CRS = 'EPSG:5070'
+
+
+class TestWumiPolys:
+    """Test suite for build_wumi_polys and read_wumi_polys"""
+
+    @pytest.fixture
+    def wumi_polys_path(self, tmp_path):
+        """Create 4 WUMI fire shapefiles (1 MTBS fire far away, 1 non-MTBS fire, 1 MTBS fire missing its shapefile) and compact them"""
+        subfires = pd.DataFrame({
+            'name': ['A', 'B', 'Far', 'NotMTBS', 'Missing'],
+            'fireid': ['CA0001120050801', 'CA0002220150701', 'CA0003320100601', 'CA0004420120101', 'CA0005520120101'],
+            'year': [2005, 2015, 2010, 2012, 2012],
+            'dataset': ['MTBS', 'mtbs', 'MTBS', 'other', 'MTBS']
+        })
+        polys = [
+            box(-2000000, 1800000, -1990000, 1810000),
+            box(-1995000, 1805000, -1985000, 1815000),
+            box(-1900000, 1700000, -1890000, 1710000),
+            box(-2000000, 1800000, -1990000, 1810000)
+        ]
+        for (_, fire), poly in zip(subfires.iterrows(), polys):
+            fire_dir = tmp_path / 'fire_maps' / str(fire['year']) / fire['fireid']
+            os.makedirs(fire_dir)
+            gpd.GeoDataFrame({'fireid': [fire['fireid']]}, geometry=[poly], crs=WUMI_CRS).to_file(fire_dir / f'{fire["fireid"]}_mtbs.shp')
+        subfires.to_csv(tmp_path / 'subfires.csv')
+
+        wumi_data_dir = str(tmp_path / 'fire_maps') + '/'
+        return build_wumi_polys(str(tmp_path / 'subfires.csv'), wumi_data_dir, WUMI_CRS, get_wumi_polys_path(wumi_data_dir))
+
+    def test_path_next_to_fire_maps(self, tmp_path):
+        """Test that the compacted file is saved next to the fire_maps dir"""
+        assert get_wumi_polys_path(str(tmp_path / 'fire_maps') + '/') == str(tmp_path / WUMI_POLYS_FNAME)
+
+    def test_only_mtbs_fires_compacted(self, wumi_polys_path):
+        """Test that only MTBS fires with a shapefile are compacted, in subfires order, with their years"""
+        wumi_polys = read_wumi_polys(wumi_polys_path)
+
+        assert list(wumi_polys['fireid']) == ['CA0001120050801', 'CA0002220150701', 'CA0003320100601']
+        assert list(wumi_polys[WUMI_YEAR_COL]) == [2005, 2015, 2010]
+        assert wumi_polys.crs == WUMI_CRS
+
+    def test_bbox_and_year_queries(self, wumi_polys_path):
+        """Test bbox and year range queries"""
+        bounds = (-1999000, 1801000, -1986000, 1814000)
+
+        assert list(read_wumi_polys(wumi_polys_path, bounds)['fireid']) == ['CA0001120050801', 'CA0002220150701']
+        assert list(read_wumi_polys(wumi_polys_path, bounds, start_year=2010)['fireid']) == ['CA0002220150701']
+        assert list(read_wumi_polys(wumi_polys_path, bounds, end_year=2010)['fireid']) == ['CA0001120050801']
+        assert len(read_wumi_polys(wumi_polys_path, (-1950000, 1750000, -1940000, 1760000))) == 0
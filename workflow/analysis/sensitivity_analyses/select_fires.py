@@ -7,18 +7,15 @@ import matplotlib.pyplot as plt
 
 from plot_helpers import create_static_fire_map
 
+sys.path.append('workflow/utils/')
+from geo_utils import open_merged_uid
 
-def count_fire_size(uid_h_data, uid_to_data, recovery_csv, wumi_csv):
-    # using V1 recovery maps, count # of pixels per fire id
-    fire_ids = np.full(uid_h_data.shape, np.nan) # create empty array to hold all fire ids
-    fire_ids = np.where(
-        (uid_h_data != -128) & (uid_to_data != -128), # where not nodata
-        (100*uid_h_data.astype('int16')) + uid_to_data.astype('int16'), # hundreds place + tens/ones place
-        fire_ids    # else, nans
-    ).flatten()
 
-    uids, counts = np.unique(fire_ids, return_counts=True, equal_nan=True)
-    counts_df = pd.DataFrame({'uid': uids, 'counts': counts}).dropna()
+def count_fire_size(uid_data, recovery_csv, wumi_csv):
+    # using V1 recovery maps, count # of pixels per fire id (uid_data from open_merged_uid, nodata=0)
+    uids, counts = np.unique(uid_data, return_counts=True)
+    counts_df = pd.DataFrame({'uid': uids, 'counts': counts})
+    counts_df = counts_df[counts_df['uid'] != 0]
 
     # merge counts_df, fire id csv, wumi csv to get the WUMI UID for each MTBS UID
     recovery_csv['mtbs_ID'] = recovery_csv['fire_id'].apply(lambda s: s.split('_')[-1].lower())
@@ -41,11 +38,10 @@ if __name__ == '__main__':
         ### Filter to fires with >1500 valid pixels in the final recovery map ###
         # Some fires occurred primarily in developed/ag lands, or were later largely reburned, 
         # meaning they don't appear in the final maps
-        uid_h_data = rxr.open_rasterio(config['SENSITIVITY']['merged_recovery_fireids_h']).data
-        uid_to_data = rxr.open_rasterio(config['SENSITIVITY']['merged_recovery_fireids_to']).data
+        uid_data = open_merged_uid(config['SENSITIVITY']['merged_recovery_fireids_h']).data # reads either UID layout
         recovery_csv = pd.read_csv(config['SENSITIVITY']['merged_recovery_fireids_csv'])
         wumi_csv = pd.read_csv(config['WUMI_PRODUCTS']['subfires_csv_f'])
-        fire_counts_df = count_fire_size(uid_h_data, uid_to_data, recovery_csv, wumi_csv)
+        fire_counts_df = count_fire_size(uid_data, recovery_csv, wumi_csv)
 
         ### Randomly select 100 large enough fires and add sensitivity indicator col to wumi_csv ###
         eligible_ids = np.unique(fire_counts_df.loc[fire_counts_df['counts']>5000, 'uid'])
@@ -0,0 +1,187 @@
+"""
+SQLite-backed storage for the all-fires AppEEARS download log.
+
+The coordinator (manage_all_downloads.py) and every per-fire download job (main_landsat_download.py)
+share one download log. Storing it in sqlite lets each job update only the rows it touched inside a
+transaction, instead of re-reading and rewriting the whole csv under a file lock after every change.
+Columns are the same as the original allfires_download_log.csv (see create_download_log), plus the
+request_leader/request_shp_path/shared_dir columns used to share one appeears task between overlapping fires.
+
+Export a human-readable csv with:
+python workflow/calculate_recovery/get_landsat_seasonal/download_log_db.py <download_log.db> <out.csv>
+"""
+
+import sys, os, json, sqlite3
+import pandas as pd
+import numpy as np
+from datetime import datetime, date
+
+DOWNLOAD_LOG_TABLE = 'download_log'
+DB_TIMEOUT = 120 # seconds to wait for a lock held by another job before raising
+
+# column name: sqlite type
+DOWNLOAD_LOG_SCHEMA = {
+    'submit_order': 'INTEGER PRIMARY KEY',
+    'fire_name': 'TEXT',
+    'fireid': 'TEXT',
+    'sensitivity': 'INTEGER',
+    'fire_year': 'INTEGER',
+    'start_date': 'TEXT',
+    'end_date': 'TEXT',
+    'dest_dir': 'TEXT',
+    'task_id': 'TEXT',
+    'bundle': 'TEXT',
+    'task_status': 'TEXT',
+    'task_submitted_time': 'TEXT',
+    'bundle_received_time': 'TEXT',
+    'download_complete': 'INTEGER',
+    'ndvi_mosaic_complete': 'INTEGER',
+    'get_bundle_tries_left': 'INTEGER',
+    'download_bundle_tries_left': 'INTEGER',
+    'mosaic_tries_left': 'INTEGER',
+    'bufferedfire_shp_path': 'TEXT',
+    'request_leader': 'INTEGER',        # submit_order of the row whose appeears task serves this row
+    'request_shp_path': 'TEXT',         # bbox requested from appeears (union bbox for shared requests)
+    'shared_dir': 'TEXT'                # where a shared request is downloaded before fanning out to dest_dir
+}
+DOWNLOAD_LOG_COLS = list(DOWNLOAD_LOG_SCHEMA.keys())
+BOOL_COLS = ['sensitivity', 'download_complete', 'ndvi_mosaic_complete']
+DATE_COLS = ['start_date', 'end_date']
+TIME_COLS = ['task_submitted_time', 'bundle_received_time']
+
+
+def connect_download_log(db_path:str)->sqlite3.Connection:
+    '''
+    Open a connection to the download log db.
+    Uses the default rollback journal (not WAL), since the log lives on a shared network filesystem.
+    '''
+    con = sqlite3.connect(db_path, timeout=DB_TIMEOUT)
+    add_missing_columns(con)
+    return con
+
+
+def add_missing_columns(con:sqlite3.Connection)->None:
+    '''Add any columns in DOWNLOAD_LOG_SCHEMA that are missing from an existing (older) download log table.'''
+    existing_cols = [row[1] for row in con.execute(f'PRAGMA table_info({DOWNLOAD_LOG_TABLE})')]
+    if len(existing_cols) == 0: return None # table not created yet
+
+    missing_cols = [col for col in DOWNLOAD_LOG_COLS if col not in existing_cols]
+    with con:
+        for col in missing_cols:
+            con.execute(f'ALTER TABLE {DOWNLOAD_LOG_TABLE} ADD COLUMN {col} {DOWNLOAD_LOG_SCHEMA[col]}')
+
+
+def to_sql_value(val):
+    '''Convert pandas/numpy values from the download log df to types sqlite can store.'''
+    if val is None: return None
+    if isinstance(val, (dict, list)): return json.dumps(val)
+    if isinstance(val, (pd.Timestamp, datetime, date)):
+        return None if pd.isna(val) else val.isoformat()
+    if isinstance(val, (bool, np.bool_)): return int(val)
+    if isinstance(val, np.integer): return int(val)
+    if isinstance(val, np.floating): return None if np.isnan(val) else float(val)
+    if isinstance(val, float) and np.isnan(val): return None
+    return val
+
+
+def create_download_log_db(download_log:pd.DataFrame, db_path:str)->str:
+    '''
+    Create the download log table (indexed by fireid and submit_order) and insert all rows of download_log.
+    Rows with a submit_order already in the table are replaced.
+    '''
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    col_defs = ',\n'.join([f'{col} {sql_type}' for col, sql_type in DOWNLOAD_LOG_SCHEMA.items()])
+
+    with connect_download_log(db_path) as con:
+        con.execute(f'CREATE TABLE IF NOT EXISTS {DOWNLOAD_LOG_TABLE} (\n{col_defs}\n)')
+        con.execute(f'CREATE INDEX IF NOT EXISTS idx_{DOWNLOAD_LOG_TABLE}_fireid ON {DOWNLOAD_LOG_TABLE} (fireid)')
+        con.executemany(
+            f'INSERT OR REPLACE INTO {DOWNLOAD_LOG_TABLE} ({", ".join(DOWNLOAD_LOG_COLS)}) VALUES ({", ".join(["?"]*len(DOWNLOAD_LOG_COLS))})',
+            [
+                tuple(to_sql_value(row[col]) for col in DOWNLOAD_LOG_COLS)
+                for _, row in download_log[DOWNLOAD_LOG_COLS].iterrows()
+            ]
+        )
+    con.close()
+
+    print(f'Saved {len(download_log)} rows to download log db {db_path}', flush=True)
+    return db_path
+
+
+def read_download_log(db_path:str, fireid:str=None)->pd.DataFrame:
+    '''
+    Read the download log (optionally, only the rows for one fireid), ordered by submit_order.
+    Returns a df formatted with the same dtypes as format_download_log.
+    '''
+    query = f'SELECT * FROM {DOWNLOAD_LOG_TABLE}'
+    params = ()
+    if fireid is not None:
+        query += ' WHERE fireid = ?'
+        params = (str(fireid),)
+    query += ' ORDER BY submit_order'
+
+    con = connect_download_log(db_path)
+    try:
+        download_log = pd.read_sql_query(query, con, params=params)
+    finally:
+        con.close()
+
+    # restore dtypes lost in sqlite
+    for col in BOOL_COLS:
+        download_log[col] = download_log[col].fillna(0).astype(bool)
+    for col in DATE_COLS:
+        download_log[col] = pd.to_datetime(download_log[col], errors='coerce')
+    for col in TIME_COLS:
+        download_log[col] = pd.to_datetime(download_log[col], errors='coerce').astype(object)
+    download_log['task_id'] = download_log['task_id'].astype(object).where(download_log['task_id'].notna(), np.nan)
+    download_log['bundle'] = download_log['bundle'].astype(object).where(download_log['bundle'].notna(), np.nan)
+    download_log['dest_dir'] = download_log['dest_dir'].fillna('')
+    download_log['shared_dir'] = download_log['shared_dir'].fillna('')
+    download_log['request_leader'] = download_log['request_leader'].fillna(download_log['submit_order']).astype(int)
+    download_log['request_shp_path'] = download_log['request_shp_path'].fillna(download_log['bufferedfire_shp_path'])
+
+    return download_log[DOWNLOAD_LOG_COLS]
+
+
+def update_download_log_row(db_path:str, submit_order:int, **values)->None:
+    '''Update the given columns for a single row (by submit_order) in one transaction.'''
+    update_download_log_rows(db_path, pd.DataFrame([{'submit_order': submit_order, **values}]))
+
+
+def update_download_log_rows(db_path:str, rows:pd.DataFrame)->None:
+    '''
+    Update the columns present in rows (keyed on rows['submit_order']) for each row in one transaction.
+    Only the given rows are written, so other jobs' rows are never overwritten.
+    '''
+    update_cols = [col for col in rows.columns if (col in DOWNLOAD_LOG_SCHEMA) and (col != 'submit_order')]
+    if len(rows) == 0 or len(update_cols) == 0: return None
+
+    set_clause = ', '.join([f'{col} = ?' for col in update_cols])
+    con = connect_download_log(db_path)
+    try:
+        with con:
+            con.executemany(
+                f'UPDATE {DOWNLOAD_LOG_TABLE} SET {set_clause} WHERE submit_order = ?',
+                [
+                    tuple(to_sql_value(row[col]) for col in update_cols) + (int(row['submit_order']),)
+                    for _, row in rows.iterrows()
+                ]
+            )
+    finally:
+        con.close()
+
+
+def export_download_log_csv(db_path:str, out_csv:str)->str:
+    '''Export the full download log to csv for inspection.'''
+    download_log = read_download_log(db_path)
+    download_log.to_csv(out_csv, index=False)
+    print(f'Exported {len(download_log)} download log rows to {out_csv}', flush=True)
+    return out_csv
+
+
+if __name__ == '__main__':
+    print(f'Running download_log_db.py with arguments {'\n'.join(sys.argv)}\n')
+    db_path = sys.argv[1]
+    out_csv = sys.argv[2]
+
+    export_download_log_csv(db_path, out_csv)
@@ -5,6 +5,8 @@ import filelock
 import time
 from datetime import datetime, timedelta
 from earthaccess_downloads import *
+from download_log_db import create_download_log_db, read_download_log, update_download_log_row, update_download_log_rows
+from shared_requests import plan_shared_requests, read_bboxes
 from typing import List
 
 sys.path.append("workflow/utils/") 
@@ -13,6 +15,11 @@ from geo_utils import export_to_tiff, reproj_align_rasters, buffer_firepoly
 LANDSAT_BAD_DATE = datetime(2024, 6, 8) # this date causes jobs to fail -- temp DAAC issue
 SLEEP_TIME = 120 # 2min pause between requests
 
+# Request sizing: prior for bundle size before the log has any received bundles to learn from.
+# ~1111 px/km2 at 30m x 5 int16 bands x ~70 scenes/yr (2 sensors, overlapping paths) ~= 0.8 MB per km2 per yr
+DEFAULT_GB_PER_KM2_YR = 0.0008
+DEFAULT_GET_BUNDLE_TRIES = 20
+
 
 ### Helper functions to process individual jobs, organize all years downloads, report results ##
 def skip_bad_dates(
@@ -89,9 +96,85 @@ def report_results(ls_seasonal_dir, years_range, progress_log_path, fireid):
     return successful_years, failed_years
 
 
-def generate_default_perfire_download_log(fireid, file_paths, fire_metadata, config):
-    # Generate job task dates
-    num_yrs_per_request = config['LANDSAT']['NUM_YRS_PER_REQUEST']
+def bundle_size_gb(bundle)->float:
+    '''Total size of the tif/nc files in an appeears bundle (nan if the bundle has no file sizes).'''
+    if type(bundle)==type('s'): bundle = json.loads(bundle)
+    try:
+        sizes = [f['file_size'] for f in bundle['files'] if ('.tif' in f['file_name']) or ('.nc' in f['file_name'])]
+    except (TypeError, KeyError):
+        return np.nan
+    return np.sum(sizes) / 1e9 if len(sizes) > 0 else np.nan
+
+
+def estimate_request_rates(download_log:pd.DataFrame)->dict:
+    '''
+    Learn bundle size per km2 per year, and appeears latency per GB, from the tasks in the download log
+    that already received a bundle (unshared requests only, since their bbox + dates are the row's own).
+    Returns medians {'gb_per_km2_yr': float, 'hours_per_gb': float}; either is nan if there is no history.
+    '''
+    rates = {'gb_per_km2_yr': np.nan, 'hours_per_gb': np.nan}
+    if download_log is None or len(download_log) == 0: return rates
+
+    received = download_log[
+        download_log['bundle'].notna() &
+        (download_log['request_leader'] == download_log['submit_order']) &
+        (download_log['shared_dir'] == '')
+    ].copy()
+    if len(received) == 0: return rates
+
+    received['size_gb'] = received['bundle'].apply(bundle_size_gb)
+    received = received[received['size_gb'] > 0]
+    if len(received) == 0: return rates
+
+    bbox_areas = {shp_path: bbox.area / 1e6 for shp_path, bbox in read_bboxes(received['bufferedfire_shp_path']).items()}
+    area_km2 = received['bufferedfire_shp_path'].map(bbox_areas)
+    years = (pd.to_datetime(received['end_date']) - pd.to_datetime(received['start_date'])).dt.days / 365.25
+    rates['gb_per_km2_yr'] = float(np.median(received['size_gb'] / (area_km2 * years)))
+
+    latency_hours = (
+        pd.to_datetime(received['bundle_received_time']) - pd.to_datetime(received['task_submitted_time'])
+    ).dt.total_seconds() / 3600
+    latency_per_gb = (latency_hours / received['size_gb'])[latency_hours > 0]
+    if len(latency_per_gb) > 0: rates['hours_per_gb'] = float(np.median(latency_per_gb))
+
+    print(f'Estimated request rates from {len(received)} received bundles: {rates}', flush=True)
+    return rates
+
+
+def choose_yrs_per_request(bufferedfire_shp_path:str, config:dict, request_rates:dict=None)->int:
+    '''
+    Number of years per appeears request for a fire, so the expected bundle is ~TARGET_BUNDLE_GB
+    (and, once latencies are known, the expected task time is ~TARGET_TASK_HOURS).
+    Falls back to NUM_YRS_PER_REQUEST if TARGET_BUNDLE_GB isn't set.
+    '''
+    landsat_config = config['LANDSAT']
+    if 'TARGET_BUNDLE_GB' not in landsat_config: return int(landsat_config['NUM_YRS_PER_REQUEST'])
+    if request_rates is None: request_rates = {}
+
+    gb_per_km2_yr = request_rates.get('gb_per_km2_yr', np.nan)
+    if np.isnan(gb_per_km2_yr): gb_per_km2_yr = DEFAULT_GB_PER_KM2_YR
+    area_km2 = read_bboxes([bufferedfire_shp_path])[bufferedfire_shp_path].area / 1e6
+    gb_per_yr = gb_per_km2_yr * area_km2
+
+    num_yrs = float(landsat_config['TARGET_BUNDLE_GB']) / gb_per_yr
+    hours_per_gb = request_rates.get('hours_per_gb', np.nan)
+    if ('TARGET_TASK_HOURS' in landsat_config) and not np.isnan(hours_per_gb):
+        num_yrs = min(num_yrs, float(landsat_config['TARGET_TASK_HOURS']) / (hours_per_gb * gb_per_yr))
+
+    min_yrs = int(landsat_config.get('MIN_YRS_PER_REQUEST', 1))
+    max_yrs = int(landsat_config.get('MAX_YRS_PER_REQUEST', landsat_config['NUM_YRS_PER_REQUEST']))
+    return int(np.clip(np.floor(num_yrs), min_yrs, max_yrs))
+
+
+def generate_default_perfire_download_log(fireid, file_paths, fire_metadata, config, request_rates=None):
+    # Create buffered fire shp path
+    # get buffered fire polygon for requesting Landsat data in a fire + 10km buffer
+    fire_poly_orig = glob.glob(f'{fire_metadata['FIRE_BOUNDARY_PATH']}*wumi_mtbs_poly.shp')[0]
+    _, bufferedfireShpPath = buffer_firepoly(fire_poly_orig)
+
+    # Generate job task dates (window length sized from the fire's bbox area + past bundles)
+    num_yrs_per_request = choose_yrs_per_request(bufferedfireShpPath, config, request_rates)
+    print(f'{fireid}: requesting {num_yrs_per_request} years per task', flush=True)
     years_range = list(range(
         fire_metadata['FIRE_YEAR'] - int(config['RECOVERY_PARAMS']['YRS_PREFIRE_MATCHED']), 
         datetime.now().year+1
@@ -101,11 +184,6 @@ def generate_default_perfire_download_log(fireid, file_paths, fire_metadata, con
     end_dates = [f'12-31-{year-1}' for year in start_years[1:]] + [f'06-30-{years_range[-1]}']
     start_dates, end_dates = skip_bad_dates(pd.to_datetime(start_dates), pd.to_datetime(end_dates))
 
-    # Create buffered fire shp path
-    # get buffered fire polygon for requesting Landsat data in a fire + 10km buffer
-    fire_poly_orig = glob.glob(f'{fire_metadata['FIRE_BOUNDARY_PATH']}*wumi_mtbs_poly.shp')[0]
-    _, bufferedfireShpPath = buffer_firepoly(fire_poly_orig)
-
     # Create perfire df with default values
     perfire_df = pd.DataFrame({
         'fire_name': fire_metadata['FIRE_NAME'],
@@ -122,7 +200,7 @@ def generate_default_perfire_download_log(fireid, file_paths, fire_metadata, con
         'bundle_received_time': np.nan,
         'download_complete': False,
         'ndvi_mosaic_complete': False,
-        'get_bundle_tries_left': 20,
+        'get_bundle_tries_left': DEFAULT_GET_BUNDLE_TRIES,
         'download_bundle_tries_left': 20,
         'mosaic_tries_left': 5,
         'bufferedfire_shp_path': bufferedfireShpPath
@@ -208,6 +286,16 @@ def format_download_log(download_log):
         'bufferedfire_shp_path': str
     })
 
+    # shared request cols (missing from older logs): by default, each row is its own request
+    if 'submit_order' in download_log.columns:
+        if 'request_leader' not in download_log.columns:
+            download_log['request_leader'] = download_log['submit_order']
+        if 'request_shp_path' not in download_log.columns:
+            download_log['request_shp_path'] = download_log['bufferedfire_shp_path']
+        if 'shared_dir' not in download_log.columns:
+            download_log['shared_dir'] = ''
+        download_log['shared_dir'] = download_log['shared_dir'].fillna('')
+
     return download_log
 
 
@@ -218,7 +306,7 @@ def create_download_log(
     )->pd.DataFrame:
     '''
     If it doesn't exist yet, creates a download log, ordered by task submit priority 
-    (keep fires together in order)
+    (keep fires together in order). Fires missing from an existing download log are appended to it.
 
     Download log cols:
         name: str
@@ -239,29 +327,51 @@ def create_download_log(
         download_bundle_tries_left: int
         mosaic_tries_left: int,
         bufferedfire_shp_path: str (path to buffered fire polygon bbox for generating requests)
+        request_leader: int (submit_order of the row whose task serves this row; itself unless shared)
+        request_shp_path: str (bbox sent to appeears; union bbox of all rows in a shared request)
+        shared_dir: str (download dir for a shared request, fanned out to each row's dest_dir)
     '''
-    download_log_path = os.path.join(
-        os.path.dirname(config['RECOVERY_PARAMS']['LOGGING_PROCESS_CSV']),
-        'allfires_download_log.csv'
-    )
+    download_log_path = get_download_log_path(config)
+    old_csv_path = download_log_path.replace('.db', '.csv')
 
-    # If download log exists, open and return it
+    # If download log exists, open it (adding any new fires) and return it
     if os.path.exists(download_log_path):
-        download_log = pd.read_csv(download_log_path)
-        download_log = format_download_log(download_log)
+        download_log = read_download_log(download_log_path)
+        new_fireids = [fireid for fireid in perfire_config.keys() if fireid not in set(download_log['fireid'])]
+        if len(new_fireids) > 0:
+            download_log = add_fires_to_download_log(download_log, download_log_path, new_fireids, config, perfire_config)
         return download_log, download_log_path
 
+    # If only a csv download log exists (vestige of old download log system), move it into the db
+    if os.path.exists(old_csv_path):
+        download_log = format_download_log(pd.read_csv(old_csv_path))
+        create_download_log_db(download_log, download_log_path)
+        return read_download_log(download_log_path), download_log_path
+
     # Otherwise, create download log and save it
+    download_log = add_fires_to_download_log(None, download_log_path, list(perfire_config.keys()), config, perfire_config)
+
+    return download_log, download_log_path
+
+
+def add_fires_to_download_log(download_log, download_log_path, fireids, config, perfire_config):
+    '''
+    Add rows for fireids to the download log db (creating it if download_log is None), ordered by
+    task submit priority (keep fires together in order) after any existing rows.
+    Request windows are sized from the bundles already received in download_log.
+    '''
+    request_rates = estimate_request_rates(download_log)
+
     # create list to hold perfire dfs
     download_log_dfs = []
 
     # iterate over all fires, adding them to download log
-    for fireid in perfire_config.keys():
+    for fireid in fireids:
         file_paths = perfire_config[fireid]['FILE_PATHS']
         fire_metadata = perfire_config[fireid]['FIRE_METADATA']
 
         # create perfire download log df with default values
-        perfire_df, years_range = generate_default_perfire_download_log(fireid, file_paths, fire_metadata, config)
+        perfire_df, years_range = generate_default_perfire_download_log(fireid, file_paths, fire_metadata, config, request_rates)
         
         # update download_complete and ndvi_mosaic_complete for each potential task
         # If recovery has been made, mark all as complete
@@ -275,17 +385,110 @@ def create_download_log(
 
         download_log_dfs.append(perfire_df)
     
-    # Concatenate all perfire dfs and save to csv
-    download_log = pd.concat(download_log_dfs)                      # concat all perfire dfs
-    download_log = format_download_log(download_log)                # format nicely
-    download_log = download_log.sort_values(
+    # Concatenate all perfire dfs and save to db
+    new_rows = pd.concat(download_log_dfs)                          # concat all perfire dfs
+    new_rows = format_download_log(new_rows)                        # format nicely
+    new_rows = new_rows.sort_values(
         by=['sensitivity', 'fireid', 'start_date'],
         ascending=False)                                                           # sort by sensitivity, then fireid, then start date
-    download_log['submit_order'] = range(len(download_log))
-    os.makedirs(os.path.dirname(download_log_path), exist_ok=True)  # save csv
-    download_log.to_csv(download_log_path, index=False)
+    first_submit_order = 0 if download_log is None else int(download_log['submit_order'].max()) + 1
+    new_rows['submit_order'] = range(first_submit_order, first_submit_order + len(new_rows))
+    new_rows = format_download_log(new_rows)                        # default (unshared) request cols
 
-    return download_log, download_log_path
+    # share one appeears task between rows with overlapping bboxes + dates (e.g. reburns)
+    if config['LANDSAT'].get('COALESCE_REQUESTS', False):
+        new_rows = plan_shared_requests(new_rows, get_shared_requests_dir(config), LANDSAT_BAD_DATE)
+
+    create_download_log_db(new_rows, download_log_path)             # save db
+    return read_download_log(download_log_path)                     # index rows by submit_order
+
+
+def reset_request(download_log, download_log_path, submit_order, **values):
+    '''Reset a row to an unsubmitted, unshared request (with any other values given, e.g. new dates).'''
+    row_mask = download_log['submit_order']==submit_order
+    row_update = {
+        'dest_dir': '',
+        'task_id': np.nan,
+        'bundle': np.nan,
+        'task_status': 'unsubmitted',
+        'task_submitted_time': np.nan,
+        'bundle_received_time': np.nan,
+        'get_bundle_tries_left': DEFAULT_GET_BUNDLE_TRIES,
+        'request_leader': submit_order,
+        'request_shp_path': download_log.loc[row_mask, 'bufferedfire_shp_path'].iloc[0],
+        'shared_dir': '',
+        **values
+    }
+    for col, val in row_update.items():
+        download_log.loc[row_mask, col] = val
+    update_download_log_row(download_log_path, submit_order, **row_update)
+
+
+def split_failed_request(download_log, download_log_path, submit_order):
+    '''
+    Split a failed request's date window in two at a year boundary (so each half's bundle is ~half the size),
+    resetting the row to the first half and adding a new unsubmitted row for the second half.
+    Returns the new row's submit_order, or None if the window is a single year or is part of a bad date split.
+    '''
+    row = download_log.loc[download_log['submit_order']==submit_order].iloc[0]
+    start_date, end_date = row['start_date'], row['end_date']
+    num_years = end_date.year - start_date.year + 1
+    bad_date_split = (
+        ((end_date.month == LANDSAT_BAD_DATE.month) and (end_date.year == LANDSAT_BAD_DATE.year)) or
+        ((start_date.month == LANDSAT_BAD_DATE.month) and (start_date.year == LANDSAT_BAD_DATE.year))
+    )
+    if (num_years < 2) or bad_date_split: return None
+    split_year = start_date.year + num_years // 2
+
+    # second half: a new row at the end of the submit order
+    new_submit_order = int(download_log['submit_order'].max()) + 1
+    download_log.loc[download_log.index.max()+1] = row
+    new_row_mask = download_log.index == download_log.index.max()
+    download_log.loc[new_row_mask, 'submit_order'] = new_submit_order
+    create_download_log_db(download_log.loc[new_row_mask], download_log_path)
+    reset_request(download_log, download_log_path, new_submit_order, start_date=pd.Timestamp(f'{split_year}-01-01'))
+
+    # first half: reuse this row
+    reset_request(download_log, download_log_path, submit_order, end_date=pd.Timestamp(f'{split_year-1}-12-31'))
+
+    print(f'Split failed request {submit_order} ({row['fireid']} {start_date.date()} - {end_date.date()}) at {split_year} into {submit_order} and {new_submit_order}', flush=True)
+    return new_submit_order
+
+
+def get_download_log_path(config:dict)->str:
+    '''Path to the sqlite download log shared by the coordinator and all per-fire download jobs.'''
+    return os.path.join(
+        os.path.dirname(config['RECOVERY_PARAMS']['LOGGING_PROCESS_CSV']),
+        'allfires_download_log.db'
+    )
+
+
+def get_shared_requests_dir(config:dict)->str:
+    '''Dir for shared request bboxes and downloads (before they are fanned out to each fire's data dir).'''
+    return os.path.join(config['LANDSAT']['dir_name'], 'shared_requests')
+
+
+def date_str(date)->str:
+    return f'{date.month}-{date.day}-{date.year}'
+
+
+def get_dest_dir(download_log, index, ls_data_dir):
+    '''
+    Per-fire data dir for a download log row.
+    For the task spanning the bad date, need to output 2 tasks to the same data dir to avoid splitting up data from the same year
+    '''
+    download_log_row = download_log.loc[download_log['submit_order']==index].iloc[0]
+    cleaned_roi_path = re.sub(r'[^a-zA-Z0-9_-]', '', os.path.basename(download_log_row['bufferedfire_shp_path']))
+    start_date, end_date = download_log_row['start_date'], download_log_row['end_date']
+
+    if (end_date.month == LANDSAT_BAD_DATE.month) and (end_date.year == LANDSAT_BAD_DATE.year): # bad date start of split
+        next_end_date = download_log.loc[download_log['submit_order']==index-1, 'end_date'].iloc[0]
+        return os.path.join(ls_data_dir, f'LS_{date_str(start_date)}_{date_str(next_end_date)}_{cleaned_roi_path}')
+    elif (start_date.month == LANDSAT_BAD_DATE.month) and (start_date.year == LANDSAT_BAD_DATE.year): # bad date end of split
+        prev_start_date = download_log.loc[download_log['submit_order']==index+1, 'start_date'].iloc[0]
+        return os.path.join(ls_data_dir, f'LS_{date_str(prev_start_date)}_{date_str(end_date)}_{cleaned_roi_path}')
+    else: # regular case
+        return os.path.join(ls_data_dir, f'LS_{date_str(start_date)}_{date_str(end_date)}_{cleaned_roi_path}')
 
 
 def create_post_request(download_log, download_log_path, index, config, perfire_config):
@@ -296,35 +499,29 @@ def create_post_request(download_log, download_log_path, index, config, perfire_
         print(f'Download row already submitted. Skipping row: \n{download_log_row}', flush=True)
         return None
 
-    # Get LS download data
-    fireid = download_log_row['fireid']
-    file_paths = perfire_config[fireid]['FILE_PATHS']
-    ls_data_dir = file_paths['INPUT_LANDSAT_DATA_DIR']
-    product_layers = config['LANDSAT']['PRODUCT_LAYERS']
+    # rows served by this row's task (just this row, unless it leads a shared request)
+    members = download_log[
+        (download_log['request_leader']==index) &
+        (download_log['task_status']=='unsubmitted')
+    ]
+    shared = len(members) > 1
 
-    # create and submit task json
-    roi_path = download_log_row['bufferedfire_shp_path']
+    # create and submit task json (over the union bbox and dates for a shared request)
+    roi_path = download_log_row['request_shp_path'] if shared else download_log_row['bufferedfire_shp_path']
     cleaned_roi_path = re.sub(r'[^a-zA-Z0-9_-]', '', os.path.basename(roi_path))
-    start_date, end_date = download_log_row['start_date'], download_log_row['end_date']
-    start_date_str=f'{start_date.month}-{start_date.day}-{start_date.year}'
-    end_date_str=f'{end_date.month}-{end_date.day}-{end_date.year}'
+    start_date, end_date = members['start_date'].min(), members['end_date'].max()
+    start_date_str, end_date_str = date_str(start_date), date_str(end_date)
     task_name = f'LS_{start_date_str}_{end_date_str}_{cleaned_roi_path}'
+    product_layers = config['LANDSAT']['PRODUCT_LAYERS']
 
-    # Format dest dir
-    # for the task spanning the bad date, need to output 2 tasks to the same data dir to avoid splitting up data from the same year
-    if (end_date.month == LANDSAT_BAD_DATE.month) and (end_date.year == LANDSAT_BAD_DATE.year): # bad date start of split
-        next_end_date = download_log.loc[download_log['submit_order']==index-1, 'end_date'].iloc[0]
-        next_end_date_str=f'{next_end_date.month}-{next_end_date.day}-{next_end_date.year}'
-        dest_dir = os.path.join(ls_data_dir, f'LS_{start_date_str}_{next_end_date_str}_{cleaned_roi_path}')
-    elif (start_date.month == LANDSAT_BAD_DATE.month) and (start_date.year == LANDSAT_BAD_DATE.year): # bad date end of split
-        # dest_dir = download_log.loc[download_log['submit_order']==index+1, 'dest_dir'].iloc[0]
-        prev_start_date = download_log.loc[download_log['submit_order']==index+1, 'start_date'].iloc[0]
-        prev_start_date_str=f'{prev_start_date.month}-{prev_start_date.day}-{prev_start_date.year}'
-        dest_dir = os.path.join(ls_data_dir, f'LS_{prev_start_date_str}_{end_date_str}_{cleaned_roi_path}')
-    else: # regular case
-        dest_dir = os.path.join(ls_data_dir, task_name)
+    # Format dest dirs (each row is downloaded/fanned out to its own fire's data dir)
+    dest_dirs = {
+        submit_order: get_dest_dir(download_log, submit_order, perfire_config[fireid]['FILE_PATHS']['INPUT_LANDSAT_DATA_DIR'])
+        for submit_order, fireid in members[['submit_order', 'fireid']].itertuples(index=False)
+    }
+    shared_dir = os.path.join(get_shared_requests_dir(config), task_name) if shared else ''
 
-    print(f'TASK NAME: {task_name} DEST DIR: {dest_dir}')
+    print(f'TASK NAME: {task_name} DEST DIRS: {list(dest_dirs.values())} SHARED DIR: {shared_dir}')
 
     task_json = create_product_request_json(
         task_name=task_name,
@@ -340,112 +537,71 @@ def create_post_request(download_log, download_log_path, index, config, perfire_
     # Submit task
     task_id = post_request(task_json, head, max_retries=30)
 
-    # Update download log row with task_status, task_submitted_time, dest_dir, task_id
-    download_log.loc[download_log['submit_order']==index, 'task_status'] = 'submitted'
-    download_log.loc[download_log['submit_order']==index, 'task_submitted_time'] = datetime.now()
-    download_log.loc[download_log['submit_order']==index, 'dest_dir'] = dest_dir
-    download_log.loc[download_log['submit_order']==index, 'task_id'] = task_id
+    # Update download log rows with task_status, task_submitted_time, dest_dir, task_id (and shared_dir)
+    task_submitted_time = datetime.now()
+    rows_update = pd.DataFrame([
+        {
+            'submit_order': submit_order,
+            'task_status': 'submitted',
+            'task_submitted_time': task_submitted_time,
+            'dest_dir': dest_dir,
+            'task_id': task_id,
+            'shared_dir': shared_dir
+        }
+        for submit_order, dest_dir in dest_dirs.items()
+    ])
+    for _, row_update in rows_update.iterrows():
+        for col, val in row_update.drop('submit_order').items():
+            download_log.loc[download_log['submit_order']==row_update['submit_order'], col] = val
     
-    # Update csv
-    download_log.to_csv(download_log_path, index=False)
+    # Update just these rows in the download log db
+    update_download_log_rows(download_log_path, rows_update)
     pass
 
 
-def update_status_incomplete_tasks(download_log, download_log_path):
-    # for each task with 'submitted' download_status, ping appeears, and if ready, change status to 'ready_to_download'
-    active_tasks = (download_log['ndvi_mosaic_complete']==False) & (download_log['task_status']=='submitted') & (download_log['get_bundle_tries_left']>0)
-    submitted_tasks = download_log[['start_date', 'task_id', 'submit_order', 'fire_name']][active_tasks]
-
-    for _, (start_date, task_id, submit_order, fire_name) in submitted_tasks.iterrows():
-        # ping appeears for this task
-        head = login_earthaccess()
-        task_complete = ping_appears_once(task_id, head)
-        print(f'Pinging appeears for start date: {fire_name} {start_date}; task_id: {task_id}; ping response: \t {task_complete}', flush=True)
-        time.sleep(SLEEP_TIME) # to enforce sleep time between requests
-
-        if task_complete==True:
-            # try to download bundles 
-            print('task complete')
-            bundle = try_get_bundle_once(task_id, head)
-            print('received bundle')
-
-            # Update download log
-            if type(bundle)!=type(np.nan):
-                download_log.loc[download_log['submit_order']==submit_order, 'bundle'] = json.dumps(bundle)
-                download_log.loc[download_log['submit_order']==submit_order, 'bundle_received_time'] = datetime.now()
-                download_log.loc[download_log['submit_order']==submit_order, 'task_status'] = 'ready_to_download'
-
-            else:
-                download_log.loc[download_log['submit_order']==submit_order, 'get_bundle_tries_left'] = download_log.loc[download_log['submit_order']==submit_order, 'get_bundle_tries_left'] - 1
-            
-        # Update csv
-        download_log.to_csv(download_log_path, index=False)
-
-    # Update list of ready fires
-    fires_not_ready = set(download_log.loc[download_log['task_status'] != 'ready_to_download', 'fireid'])
-    all_fires = set(download_log['fireid'])
-    ready_fireids = list(all_fires - fires_not_ready)
-
-    # return fireids for new fires ready
-    return download_log, ready_fireids
+def update_task_status(download_log, download_log_path, submit_order, head=None):
+    '''
+    Ping appeears once for a single submitted task. If the task is done, request its bundle and
+    mark the task ready_to_download; if the bundle request fails, use up one get_bundle try.
+    Returns the task_status for this row after the update.
+    '''
+    row_mask = download_log['submit_order']==submit_order
+    start_date, task_id, fire_name = download_log.loc[row_mask, ['start_date', 'task_id', 'fire_name']].iloc[0]
+
+    # ping appeears for this task
+    if head is None: head = login_earthaccess()
+    task_complete = ping_appears_once(task_id, head)
+    print(f'Pinging appeears for start date: {fire_name} {start_date}; task_id: {task_id}; ping response: \t {task_complete}', flush=True)
+    time.sleep(SLEEP_TIME) # to enforce sleep time between requests
+
+    if task_complete==True:
+        # try to download bundles 
+        print('task complete')
+        bundle = try_get_bundle_once(task_id, head)
+        print('received bundle')
+
+        # Update download log
+        if type(bundle)!=type(np.nan):
+            row_update = {
+                'bundle': json.dumps(bundle),
+                'bundle_received_time': datetime.now(),
+                'task_status': 'ready_to_download'
+            }
 
+        else:
+            row_update = {
+                'get_bundle_tries_left': download_log.loc[row_mask, 'get_bundle_tries_left'].iloc[0] - 1
+            }
 
-def read_csv_wait_for_content(filepath, timeout=120, check_interval=0.5):
-    """Wait until file has content and is readable."""
-    start_time = time.time()
-    last_error = None
-    
-    while time.time() - start_time < timeout:
-        try:
-            # Check if file exists and has content
-            if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                # Try to read the CSV
-                df = pd.read_csv(filepath)
-                # Verify we got actual data
-                if len(df) > 0 and len(df.columns) > 0:
-                    return df
-                else:
-                    # File read but empty, wait and retry
-                    time.sleep(check_interval)
-                    continue
-            else:
-                # File doesn't exist or is empty
-                time.sleep(check_interval)
-                continue
-                
-        except pd.errors.EmptyDataError as e:
-            # File is being written to or is temporarily empty
-            last_error = e
-            time.sleep(check_interval)
-            continue
-        except (PermissionError, IOError) as e:
-            # File is locked
-            last_error = e
-            time.sleep(check_interval)
-            continue
-        except Exception as e:
-            # Other pandas parsing errors (partial write)
-            last_error = e
-            time.sleep(check_interval)
-            continue
-    
-    raise TimeoutError(f"Could not read valid data from {filepath} after {timeout} seconds. Last error: {last_error}")
+        for col, val in row_update.items():
+            download_log.loc[row_mask, col] = val
+        
+        # Update just this row in the download log db
+        update_download_log_row(download_log_path, submit_order, **row_update)
 
+    return download_log.loc[row_mask, 'task_status'].iloc[0]
 
-def update_csv_wlock(f_to_update, download_log, fireid, timeout=60):
-    # Update download log csv
-    lock_file = f_to_update + '.lock'
-    lock = filelock.FileLock(lock_file, timeout=timeout)  # wait for lock, if necessary (other batch jobs for other fires may also be waiting to update csv)
-    try:
-        with lock:
-            csv = read_csv_wait_for_content(f_to_update)
-               
-            # update rows associated with this fireid
-            mask = csv['fireid'] == fireid
-            csv.loc[mask] = download_log[mask]
-            
-            # Save the updated csv
-            csv.to_csv(f_to_update, index=False)
 
-    except filelock.Timeout:
-        print("Could not acquire lock on file after waiting", flush=True)
\ No newline at end of file
+def update_download_log_fire(download_log_path, download_log, fireid):
+    '''Write the rows for this fireid back to the download log db (other fires' rows are untouched).'''
+    update_download_log_rows(download_log_path, download_log[download_log['fireid'] == fireid])
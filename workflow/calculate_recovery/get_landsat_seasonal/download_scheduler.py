@@ -0,0 +1,237 @@
+"""
+Scheduler for AppEEARS download tasks, used by manage_all_downloads.py.
+
+Each row of the download log is one task. The scheduler keeps every task in an explicit state,
+submits unsubmitted tasks from a priority queue (sensitivity fires first, then fireid, then start date --
+the same order used to assign submit_order in create_download_log) without exceeding a concurrent-task budget,
+and only polls tasks that are currently submitted. Tasks that fail (no get_bundle tries left, or still not done
+after MAX_TASK_HOURS) have their date window split in two and are re-queued. When the last task for a fire becomes ready,
+the on_fire_ready callback is called once for that fire (e.g. to touch its ready_to_download_{fireid} flag).
+
+Rows that share one appeears task (see shared_requests.py) are tracked as followers of their request_leader:
+only the leader is queued/polled, and its state (and bundle) is copied to its followers.
+"""
+
+import heapq
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable
+
+from download_log_helpers import create_post_request, update_task_status, login_earthaccess, split_failed_request, reset_request
+from download_log_db import update_download_log_rows
+
+# Task states
+TASK_UNSUBMITTED = 'unsubmitted'            # waiting in the priority queue
+TASK_SUBMITTED = 'submitted'                # posted to appeears, counts against the concurrent-task budget
+TASK_READY = 'ready_to_download'            # bundle received, ready for the per-fire download job
+TASK_COMPLETE = 'complete'                  # ndvi mosaic already made on a previous run, nothing to request
+TASK_FAILED = 'failed'                      # no get_bundle tries left
+DONE_STATES = (TASK_READY, TASK_COMPLETE)
+
+DEFAULT_MAX_ACTIVE_TASKS = 25
+
+
+class DownloadScheduler:
+    def __init__(
+        self,
+        download_log,
+        download_log_path: str,
+        config: dict,
+        perfire_config: dict,
+        max_active_tasks: int = DEFAULT_MAX_ACTIVE_TASKS,
+        on_fire_ready: Callable[[str], None] = None
+        ):
+        self.download_log = download_log
+        self.download_log_path = download_log_path
+        self.config = config
+        self.perfire_config = perfire_config
+        self.max_active_tasks = max_active_tasks
+        self.on_fire_ready = on_fire_ready
+        self.max_task_hours = float(config['LANDSAT'].get('MAX_TASK_HOURS', np.inf))
+
+        self.task_state = {}                        # submit_order: task state
+        self.task_fireid = {}                       # submit_order: fireid
+        self.fire_tasks_left = defaultdict(set)     # fireid: submit_orders not yet in a done state
+        self.pending = []                           # heap of (priority, submit_order) for unsubmitted tasks
+        self.active = set()                         # submit_orders of submitted tasks
+        self.followers = defaultdict(list)          # leader submit_order: submit_orders served by the leader's task
+        self.ready_fires = set()                    # fireids that on_fire_ready was already called for
+        self.initialized = False                    # hold fire-ready callbacks until all tasks are registered
+
+        cols = ['submit_order', 'fireid', 'sensitivity', 'task_status', 'ndvi_mosaic_complete', 'get_bundle_tries_left', 'request_leader']
+        rows = list(download_log[cols].itertuples(index=False))
+        for submit_order, fireid, sensitivity, task_status, mosaic_complete, tries_left, _ in rows:
+            submit_order = int(submit_order)
+            self.task_fireid[submit_order] = fireid
+            self.fire_tasks_left[fireid].add(submit_order)
+            self.set_state(submit_order, self.initial_state(task_status, mosaic_complete, tries_left))
+
+        self.task_sensitivity = {int(submit_order): sensitivity for submit_order, _, sensitivity, *_ in rows}
+        for submit_order, fireid, sensitivity, task_status, mosaic_complete, tries_left, leader in rows:
+            submit_order, leader = int(submit_order), int(leader)
+            if self.task_state[submit_order] not in (TASK_UNSUBMITTED, TASK_SUBMITTED): continue
+
+            # follow the leader's task while it can still serve this row
+            if (leader != submit_order) and (self.task_state.get(leader) in (TASK_UNSUBMITTED, TASK_SUBMITTED)):
+                self.followers[leader].append(submit_order)
+                self.active.discard(submit_order)
+            elif self.task_state[submit_order] == TASK_UNSUBMITTED:
+                if leader != submit_order: self.detach(submit_order)
+                heapq.heappush(self.pending, (self.task_priority(sensitivity, submit_order), submit_order))
+
+        # fires that are already ready (e.g. on restart) don't need to wait for any events
+        self.initialized = True
+        for fireid in list(self.fire_tasks_left.keys()):
+            self.check_fire_ready(fireid)
+
+
+    @staticmethod
+    def initial_state(task_status, mosaic_complete, tries_left):
+        if mosaic_complete: return TASK_COMPLETE
+        if task_status == TASK_READY: return TASK_READY
+        if tries_left <= 0: return TASK_FAILED
+        if task_status == TASK_SUBMITTED: return TASK_SUBMITTED
+        return TASK_UNSUBMITTED
+
+
+    @staticmethod
+    def task_priority(sensitivity, submit_order):
+        # submit_order already follows fireid/start date order; sensitivity fires always go first
+        return (not bool(sensitivity), submit_order)
+
+
+    def set_state(self, submit_order, state):
+        self.task_state[submit_order] = state
+        if state == TASK_SUBMITTED: self.active.add(submit_order)
+        else: self.active.discard(submit_order)
+
+        if state in DONE_STATES:
+            fireid = self.task_fireid[submit_order]
+            self.fire_tasks_left[fireid].discard(submit_order)
+            self.check_fire_ready(fireid)
+
+
+    def queue_task(self, submit_order):
+        self.set_state(submit_order, TASK_UNSUBMITTED)
+        heapq.heappush(self.pending, (self.task_priority(self.task_sensitivity[submit_order], submit_order), submit_order))
+
+
+    def fail_task(self, submit_order):
+        # split the failed task's date window and re-queue both halves; rows that were sharing it are requested on their own
+        for follower in self.followers.pop(submit_order, []):
+            reset_request(self.download_log, self.download_log_path, follower)
+            self.queue_task(follower)
+
+        new_submit_order = split_failed_request(self.download_log, self.download_log_path, submit_order)
+        if new_submit_order is None:
+            print(f'WARNING: Task {submit_order} ({self.task_fireid[submit_order]}) failed and cannot be split further.', flush=True)
+            self.set_state(submit_order, TASK_FAILED)
+            return None
+
+        fireid = self.task_fireid[submit_order]
+        self.task_fireid[new_submit_order] = fireid
+        self.task_sensitivity[new_submit_order] = self.task_sensitivity[submit_order]
+        self.fire_tasks_left[fireid].add(new_submit_order)
+        self.queue_task(submit_order)
+        self.queue_task(new_submit_order)
+
+
+    def task_timed_out(self, submit_order):
+        submitted_time = self.download_log.loc[self.download_log['submit_order']==submit_order, 'task_submitted_time'].iloc[0]
+        if pd.isna(submitted_time): return False
+        return (datetime.now() - pd.to_datetime(submitted_time)).total_seconds() / 3600 > self.max_task_hours
+
+
+    def detach(self, submit_order):
+        # the leader's task can't serve this row anymore (e.g. it finished on a previous run), so request it on its own
+        print(f'Detaching task {submit_order} from its shared request.', flush=True)
+        row_mask = self.download_log['submit_order']==submit_order
+        self.download_log.loc[row_mask, 'request_leader'] = submit_order
+        self.download_log.loc[row_mask, 'request_shp_path'] = self.download_log.loc[row_mask, 'bufferedfire_shp_path']
+        update_download_log_rows(self.download_log_path, self.download_log.loc[row_mask, ['submit_order', 'request_leader', 'request_shp_path']])
+
+
+    def update_followers(self, leader, state):
+        # copy a shared task's bundle and state from the leader to the rows it serves
+        followers = self.followers.pop(leader, [])
+        if len(followers) == 0: return None
+
+        if state == TASK_READY:
+            leader_row = self.download_log.loc[self.download_log['submit_order']==leader].iloc[0]
+            rows_update = pd.DataFrame([{
+                'submit_order': submit_order,
+                'bundle': leader_row['bundle'],
+                'bundle_received_time': leader_row['bundle_received_time'],
+                'task_status': TASK_READY
+            } for submit_order in followers])
+            for col in ['bundle', 'bundle_received_time', 'task_status']:
+                self.download_log.loc[self.download_log['submit_order'].isin(followers), col] = leader_row[col]
+            update_download_log_rows(self.download_log_path, rows_update)
+
+        for submit_order in followers:
+            self.set_state(submit_order, state)
+
+
+    def check_fire_ready(self, fireid):
+        # call on_fire_ready as soon as a fire's last task is done (only once per fire)
+        if not self.initialized: return None
+        if (len(self.fire_tasks_left[fireid]) == 0) and (fireid not in self.ready_fires):
+            self.ready_fires.add(fireid)
+            print(f'{datetime.now()}: All tasks ready for {fireid}.', flush=True)
+            if self.on_fire_ready is not None: self.on_fire_ready(fireid)
+
+
+    def submit_tasks(self):
+        # submit tasks in priority order until we hit the concurrent-task budget
+        jobs_to_submit_count = max(self.max_active_tasks - len(self.active), 0)
+        print(f'{len(self.active)} active jobs. Will submit up to {jobs_to_submit_count} jobs.', flush=True)
+
+        for _ in range(jobs_to_submit_count):
+            if len(self.pending) == 0: break
+            _, submit_order = heapq.heappop(self.pending)
+            create_post_request(self.download_log, self.download_log_path, submit_order, self.config, self.perfire_config)
+            self.set_state(submit_order, TASK_SUBMITTED)
+            for follower in self.followers[submit_order]:
+                self.task_state[follower] = TASK_SUBMITTED # submitted with the leader, but only the leader is polled
+
+
+    def poll_active_tasks(self):
+        # ping appeears once for each submitted task, moving tasks to ready/failed as they finish
+        if len(self.active) == 0: return None
+        head = login_earthaccess()
+
+        for submit_order in sorted(self.active):
+            task_status = update_task_status(self.download_log, self.download_log_path, submit_order, head)
+            tries_left = self.download_log.loc[self.download_log['submit_order']==submit_order, 'get_bundle_tries_left'].iloc[0]
+
+            if task_status == TASK_READY:
+                self.set_state(submit_order, TASK_READY)
+                self.update_followers(submit_order, TASK_READY)
+            elif tries_left <= 0:
+                print(f'WARNING: No get_bundle tries left for task {submit_order} ({self.task_fireid[submit_order]}).', flush=True)
+                self.fail_task(submit_order)
+            elif self.task_timed_out(submit_order):
+                print(f'WARNING: Task {submit_order} ({self.task_fireid[submit_order]}) not done after {self.max_task_hours} hours.', flush=True)
+                self.fail_task(submit_order)
+
+
+    def tasks_left(self):
+        return len(self.pending) + len(self.active) + sum(len(followers) for followers in self.followers.values())
+
+
+    def run(self):
+        # keep submitting/polling until no tasks are waiting or in progress
+        while self.tasks_left() > 0:
+            self.submit_tasks()
+            self.poll_active_tasks()
+
+            fires_left = {self.task_fireid[submit_order] for submit_order in self.active} | {self.task_fireid[submit_order] for _, submit_order in self.pending} \
+                | {self.task_fireid[submit_order] for followers in self.followers.values() for submit_order in followers}
+            print(f'Still have {self.tasks_left()}/{len(self.task_state)} jobs over {len(fires_left)} unique fires left to complete.', flush=True)
+
+        failed_fires = {fireid for fireid, tasks_left in self.fire_tasks_left.items() if len(tasks_left) > 0}
+        if len(failed_fires) > 0:
+            print(f'WARNING: {len(failed_fires)} fires have failed tasks and will not be downloaded: {failed_fires}', flush=True)
+        print('All fires are ready for download!', flush=True)
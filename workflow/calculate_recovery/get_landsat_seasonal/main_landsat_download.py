@@ -1,51 +1,279 @@
-import sys, os, glob, json
+import sys, os, glob, json, time, queue
 import pandas as pd
+import filelock
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from download_log_helpers import *
+from shared_requests import fan_out_shared_scenes, remove_shared_dir_if_done
 sys.path.append("workflow/utils/") 
 from earthaccess_downloads import *
 from merge_process_scenes import mosaic_ndvi_timeseries
 
 
-lock = Lock()
+SHARED_DOWNLOAD_LOCK_TIMEOUT = 6*60*60 # another fire's job may be downloading the same shared bundle
 
 ### Helper functions to process individual jobs, organize all years downloads, report results ##
-def download_task(submission_order, start_date, task_id, bundle, dest_dir, download_log, args, fireid):
+def download_shared_task(task_id, bundle, shared_dir, dest_dir, bufferedfire_shp_path, start_date, end_date, head):
+    '''
+    Download a shared request's bundle to shared_dir (once, for all the fires it serves),
+    then copy this fire's scenes to dest_dir, clipped to its own buffered bbox.
+    '''
+    with filelock.FileLock(shared_dir.rstrip('/') + '.lock', timeout=SHARED_DOWNLOAD_LOCK_TIMEOUT):
+        shared_dir_complete = download_landsat_bundle(bundle, task_id, head, shared_dir)
+    if not isinstance(shared_dir_complete, str):
+        return shared_dir_complete
+
+    return fan_out_shared_scenes(shared_dir, dest_dir, bufferedfire_shp_path, start_date, end_date)
+
+
+def download_task(submission_order, start_date, end_date, task_id, bundle, dest_dir, shared_dir, bufferedfire_shp_path, download_log, args, fireid):
     print(f'Current time: {datetime.now()}')
     print(f'Downloading bundle with start date: {start_date}; task_id: {task_id}', flush=True)
+    t0 = time.time()
     head = login_earthaccess()
     
     # Try to download bundle
-    dest_dir_complete = download_landsat_bundle(bundle, task_id, head, dest_dir)
+    if shared_dir:
+        dest_dir_complete = download_shared_task(task_id, bundle, shared_dir, dest_dir, bufferedfire_shp_path, start_date, end_date, head)
+    else:
+        dest_dir_complete = download_landsat_bundle(bundle, task_id, head, dest_dir)
     print('DEST DIR COMPLETE FLAG')
     print(f'{dest_dir_complete}, {type(dest_dir_complete)}', flush=True)
     
     # Return results 
     return {
         'submission_order': submission_order,
-        'success': isinstance(dest_dir_complete, str)
+        'success': isinstance(dest_dir_complete, str),
+        'seconds': time.time() - t0,
+        'mb': dir_size_mb(dest_dir)
     }
 
+
+def mosaic_task(submission_orders, start_date, dest_dir, args):
+    # Runs in a worker process, so the mosaic (CPU) overlaps with other windows' downloads (network)
+    print(f'Starting seasonal mosaic for: {start_date}; dest_dir: {dest_dir}', flush=True)
+    t0 = time.time()
+    try:
+        mosaic_ndvi_timeseries(
+            dest_dir, args['valid_layers'], args['ls_seasonal_dir'], NODATA=args['default_nodata'], 
+            NDVI_BANDS_DICT=args['ndvi_bands_dict'], RGB_BANDS_DICT=args['rgb_bands_dict'],
+            MAKE_RGB=args['make_daily_rgb'], MAKE_DAILY_NDVI=args['make_daily_ndvi'],
+            DELETE_RAW_SCENES=args['stream_raw_scenes']
+        )
+        success = True
+    except Exception as e:
+        print(f'Failed to mosaic from {dest_dir}.')
+        print(e)
+        success = False
+
+    return {
+        'submission_orders': submission_orders,
+        'success': success,
+        'seconds': time.time() - t0,
+        'mb': dir_size_mb(dest_dir)
+    }
+
+
+def dir_size_mb(dir_path):
+    if not os.path.isdir(dir_path): return 0.0
+    return sum(f.stat().st_size for f in os.scandir(dir_path) if f.is_file()) / 1e6
+
+
+def scratch_usage_gb(scratch_dirs):
+    # total size of the raw scenes on scratch disk (all fires)
+    total = 0
+    for scratch_dir in scratch_dirs:
+        for root, _, files in os.walk(scratch_dir):
+            for f in files:
+                try: total += os.path.getsize(os.path.join(root, f))
+                except OSError: pass # deleted by another job while walking
+    return total / 1e9
+
+
+def scratch_has_room(args, bundle_gb, wait=False):
+    '''
+    Check whether a bundle of bundle_gb fits under the global scratch quota (SCRATCH_QUOTA_GB).
+    If wait, poll until it fits (other fires' jobs free up space as they mosaic),
+    giving up after SCRATCH_WAIT_HOURS so a stale scratch dir can't stall downloads forever.
+    '''
+    if args['scratch_quota_gb'] is None: return True
+    if pd.isna(bundle_gb): bundle_gb = 0
+
+    t0 = time.time()
+    while True:
+        usage_gb = scratch_usage_gb(args['scratch_dirs'])
+        if usage_gb + bundle_gb <= args['scratch_quota_gb']: return True
+        if not wait: return False
+        if (time.time() - t0) / 3600 > args['scratch_wait_hours']:
+            print(f'WARNING: Scratch still over quota ({usage_gb:.1f} GB used + {bundle_gb:.1f} GB > {args['scratch_quota_gb']} GB) '
+                  f'after {args['scratch_wait_hours']} hours. Downloading anyway.', flush=True)
+            return True
+        print(f'Scratch over quota ({usage_gb:.1f} GB used + {bundle_gb:.1f} GB > {args['scratch_quota_gb']} GB). Waiting to download.', flush=True)
+        time.sleep(SLEEP_TIME)
+
+
+def new_stage_metrics():
+    return {'windows': 0, 'failed': 0, 'busy_seconds': 0.0, 'mb': 0.0}
+
+
+def log_stage_metrics(metrics, wall_seconds, max_windows_on_disk):
+    # per-stage throughput for this pass of the pipeline
+    print(f'PIPELINE METRICS ({datetime.now()}): wall time {wall_seconds:.0f}s, max windows on disk {max_windows_on_disk}', flush=True)
+    for stage, m in metrics.items():
+        if stage == 'queue': continue
+        mb_per_s = m['mb'] / m['busy_seconds'] if m['busy_seconds'] > 0 else 0.0
+        windows_per_hr = 3600 * m['windows'] / wall_seconds if wall_seconds > 0 else 0.0
+        print(
+            f'  {stage}: {m['windows']} windows ({m['failed']} failed), {m['mb']:.0f} MB, '
+            f'{m['busy_seconds']:.0f}s busy, {mb_per_s:.2f} MB/s per worker, {windows_per_hr:.2f} windows/hr',
+            flush=True
+        )
+    waits = metrics['queue']['wait_seconds']
+    if len(waits) > 0:
+        print(f'  queue: mean wait between download and mosaic {sum(waits)/len(waits):.0f}s, max {max(waits):.0f}s', flush=True)
+
+
 def update_download_log(result, download_log, args, fireid):
     # Update download log
     if result['success']:
         print('download complete')
         download_log.loc[download_log['submit_order']==result['submission_order'], 'download_complete'] = True
     else:
-        download_log.loc[download_log['submit_order']==submission_order, 'download_bundle_tries_left'] = download_log.loc[download_log['submit_order']==submission_order, 'download_bundle_tries_left'] - 1
+        download_log.loc[download_log['submit_order']==result['submission_order'], 'download_bundle_tries_left'] = download_log.loc[download_log['submit_order']==result['submission_order'], 'download_bundle_tries_left'] - 1
         
-    # Update download log csv
-    update_csv_wlock(args['download_log_csv'], download_log, fireid)
+    # Update download log db
+    update_download_log_fire(args['download_log_db'], download_log, fireid)
+
+    # Once every fire served by a shared request has its scenes, remove the shared download
+    shared_dir = download_log.loc[download_log['submit_order']==result['submission_order'], 'shared_dir'].iloc[0]
+    if result['success'] and shared_dir:
+        remove_shared_dir_if_done(args['download_log_db'], shared_dir)
     
     return download_log
 
 
+def run_download_mosaic_pipeline(download_log, args, fireid):
+    '''
+    Download and mosaic this fire's incomplete windows as a pipeline: each window's mosaic starts
+    as soon as its download finishes (windows split around the bad date share a dest_dir, so they are
+    mosaiced together once both are downloaded). At most args['max_windows_on_disk'] windows are
+    downloading or waiting to be mosaiced at once, so raw scenes on disk stay bounded.
+    '''
+    fire_rows = (download_log['fireid']==fireid) & (download_log['ndvi_mosaic_complete']==False)
+    # for each task with a bundle, but incomplete download, try to download bundle
+    to_download = download_log[
+        fire_rows & (download_log['download_complete']==False) & (download_log['download_bundle_tries_left']>0)
+    ]['submit_order'].tolist()
+    # windows already downloaded on a previous pass/run only need a mosaic
+    already_downloaded = download_log[
+        fire_rows & (download_log['download_complete']==True) & (download_log['mosaic_tries_left']>0)
+    ]['submit_order'].tolist()
+    print(f'WINDOWS TO DOWNLOAD: {to_download}; WINDOWS TO MOSAIC: {already_downloaded}', flush=True)
+
+    def row(submit_order):
+        return download_log.loc[download_log['submit_order']==submit_order].iloc[0]
+
+    dest_dirs = {submit_order: row(submit_order)['dest_dir'] for submit_order in to_download + already_downloaded}
+    downloads_left = {}     # dest_dir: submit_orders still to download this pass
+    for submit_order in to_download: downloads_left.setdefault(dest_dirs[submit_order], set()).add(submit_order)
+    ready_to_mosaic = {}    # dest_dir: downloaded submit_orders waiting on the rest of their dest_dir
+    to_start = [('mosaic', submit_order) for submit_order in already_downloaded] + [('download', submit_order) for submit_order in to_download]
+
+    events = queue.Queue()  # (stage, result) from finished downloads/mosaics
+    metrics = {'download': new_stage_metrics(), 'mosaic': new_stage_metrics(), 'queue': {'wait_seconds': []}}
+    downloaded_time = {}
+    windows_on_disk, running = 0, 0
+    t_start = time.time()
+
+    with ThreadPoolExecutor(max_workers=args['download_workers']) as download_executor, \
+        ProcessPoolExecutor(max_workers=args['mosaic_workers']) as mosaic_executor:
+
+        def put_result(stage, failed_result):
+            # always report back to the main loop, even if the task raised
+            def callback(future):
+                try: events.put((stage, future.result()))
+                except Exception as e:
+                    print(f'ERROR in {stage} task: {e}', flush=True)
+                    events.put((stage, failed_result))
+            return callback
+
+        def start_mosaic(submit_orders):
+            nonlocal running
+            r = row(submit_orders[0])
+            future = mosaic_executor.submit(mosaic_task, submit_orders, r['start_date'], r['dest_dir'], args)
+            future.add_done_callback(put_result('mosaic', {'submission_orders': submit_orders, 'success': False, 'seconds': 0.0, 'mb': 0.0}))
+            running += 1
+
+        def start_download(submit_order):
+            nonlocal running
+            r = row(submit_order)
+            future = download_executor.submit(
+                download_task, submit_order, r['start_date'], r['end_date'], r['task_id'], r['bundle'], r['dest_dir'],
+                r['shared_dir'], r['bufferedfire_shp_path'], download_log, args, fireid
+            )
+            future.add_done_callback(put_result('download', {'submission_order': submit_order, 'success': False, 'seconds': 0.0, 'mb': 0.0}))
+            running += 1
+
+        def mosaic_when_dir_downloaded(dest_dir):
+            # start the mosaic once nothing else is still downloading into this dest_dir
+            if (len(downloads_left.get(dest_dir, set())) == 0) and (len(ready_to_mosaic.get(dest_dir, [])) > 0):
+                start_mosaic(ready_to_mosaic.pop(dest_dir))
+
+        while (len(to_start) > 0) or (running > 0):
+            # start work while there's room on disk (or if nothing running could free up room)
+            while ((windows_on_disk < args['max_windows_on_disk']) or (running == 0)) and (len(to_start) > 0):
+                stage, submit_order = to_start[0]
+                # hold new downloads while the shared scratch disk is over quota
+                if (stage == 'download') and not scratch_has_room(args, bundle_size_gb(row(submit_order)['bundle']), wait=(running == 0)):
+                    break
+                to_start.pop(0)
+                windows_on_disk += 1
+                if stage == 'download':
+                    start_download(submit_order)
+                else:
+                    ready_to_mosaic.setdefault(dest_dirs[submit_order], []).append(submit_order)
+                    mosaic_when_dir_downloaded(dest_dirs[submit_order])
+
+            stage, result = events.get()
+            running -= 1
+            metrics[stage]['windows'] += 1
+            metrics[stage]['failed'] += int(not result['success'])
+            metrics[stage]['busy_seconds'] += result['seconds']
+            metrics[stage]['mb'] += result['mb']
+
+            if stage == 'download':
+                submit_order = result['submission_order']
+                dest_dir = dest_dirs[submit_order]
+                download_log = update_download_log(result, download_log, args, fireid)
+                downloads_left[dest_dir].discard(submit_order)
+                if result['success']:
+                    # hand the window to the mosaic stage (it keeps its place on disk until mosaiced)
+                    downloaded_time[submit_order] = time.time()
+                    ready_to_mosaic.setdefault(dest_dir, []).append(submit_order)
+                else:
+                    windows_on_disk -= 1
+                mosaic_when_dir_downloaded(dest_dir)
+
+            else:
+                for submit_order in result['submission_orders']:
+                    if submit_order in downloaded_time:
+                        metrics['queue']['wait_seconds'].append(time.time() - downloaded_time.pop(submit_order) - result['seconds'])
+                    row_mask = download_log['submit_order']==submit_order
+                    if result['success']: download_log.loc[row_mask, 'ndvi_mosaic_complete'] = True
+                    else: download_log.loc[row_mask, 'mosaic_tries_left'] = download_log.loc[row_mask, 'mosaic_tries_left'] - 1
+                    windows_on_disk -= 1
+                # Update download log db
+                update_download_log_fire(args['download_log_db'], download_log, fireid)
+
+    log_stage_metrics(metrics, time.time() - t_start, args['max_windows_on_disk'])
+    return download_log
+
+
 def process_all_years(args: dict):
-    # open download log
-    download_log = read_csv_wait_for_content(args['download_log_csv'])
+    # open download log (just the rows for this fire)
+    download_log = read_download_log(args['download_log_db'], fireid=args['fireid'])
+    fireid = args['fireid']
 
     # keep working on download until all years complete
     unsuccessful_years_w_retries = download_log['start_date'][
@@ -57,57 +285,8 @@ def process_all_years(args: dict):
     print(f'YEARS TO DOWNLOAD/MOSAIC: {unsuccessful_years_w_retries}', flush=True)
     print(download_log[['start_date', 'download_bundle_tries_left']][download_log['fireid']==args['fireid']], flush=True)
     while len(unsuccessful_years_w_retries) > 0:
-        # DOWNLOAD
-        # for each task with a bundle, but incomplete download, try to download bundle
-        incompletedownload_years_df = download_log[['submit_order','start_date', 'task_id', 'bundle', 'dest_dir']][
-            (download_log['fireid']==args['fireid']) &
-            (download_log['ndvi_mosaic_complete']==False) & 
-            (download_log['download_complete']==False) & 
-            # (download_log['bundle'].notna()) & 
-            (download_log['download_bundle_tries_left']>0)
-        ]
-
-        print(f'YEARS TO DOWNLOAD: {incompletedownload_years_df['start_date']}', flush=True)
-
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            # Submit all tasks
-            futures = []
-            for _, (submission_order, start_date, task_id, bundle, dest_dir) in incompletedownload_years_df.iterrows():
-                future = executor.submit(download_task, submission_order, start_date, task_id, bundle, dest_dir, download_log, args, fireid)
-                futures.append(future)
-
-            for future in as_completed(futures):
-                result = future.result()
-                with lock:
-                    download_log = update_download_log(result, download_log, args, fireid)
-
-        # MOSAIC
-        # for each task with a complete download, but incomplete ndvi_mosaic, try to create mosaic
-        incomplete_mosaic_df = download_log[['start_date', 'end_date', 'dest_dir']][
-            (download_log['fireid']==args['fireid']) &
-            (download_log['download_complete']==True) & 
-            (download_log['ndvi_mosaic_complete']==False) & 
-            (download_log['mosaic_tries_left']>0)
-        ]
-        for index, (start_date, end_date, dest_dir) in incomplete_mosaic_df.iterrows():
-            print(f'Starting seasonal mosaic for: {start_date}; dest_dir: {dest_dir}')
-            try:
-                mosaic_ndvi_timeseries(
-                    dest_dir, args['valid_layers'], args['ls_seasonal_dir'], NODATA=args['default_nodata'], 
-                    NDVI_BANDS_DICT=args['ndvi_bands_dict'], RGB_BANDS_DICT=args['rgb_bands_dict'],
-                    MAKE_RGB=args['make_daily_rgb'], MAKE_DAILY_NDVI=args['make_daily_ndvi']
-                )
-                # Update download log
-                download_log.loc[index, 'ndvi_mosaic_complete'] = True
-
-            except Exception as e:
-                # Update mosaic_tries_left on download log
-                print(f'Failed to mosaic from {dest_dir}.')
-                print(e)
-                download_log.loc[index, 'mosaic_tries_left'] = download_log.loc[index, 'mosaic_tries_left'] - 1
-
-            # Update download log csv
-            update_csv_wlock(args['download_log_csv'], download_log, fireid)
+        # DOWNLOAD + MOSAIC each window, pipelined
+        download_log = run_download_mosaic_pipeline(download_log, args, fireid)
         
         # ASSESS PROGRESS + UPDATE LOG
         # re-check the list of unsuccessful years with retries left to determine if we should keep looping
@@ -137,24 +316,28 @@ if __name__ == "__main__":
         perfire_json = json.load(f)
     fire_metadata = perfire_json[fireid]['FIRE_METADATA']
     file_paths = perfire_json[fireid]['FILE_PATHS']
-    download_log_path = os.path.join(
-        os.path.dirname(config['RECOVERY_PARAMS']['LOGGING_PROCESS_CSV']),
-        'allfires_download_log.csv'
-    )
+    download_log_path = get_download_log_path(config)
 
     # get relevant params
     args = {
         'fireid': fireid,
         'ls_seasonal_dir': file_paths['INPUT_LANDSAT_SEASONAL_DIR'],
         'progress_log_csv': config['RECOVERY_PARAMS']['LOGGING_PROCESS_CSV'],
-        'download_log_csv': download_log_path,
+        'download_log_db': download_log_path,
         'valid_layers': config['LANDSAT']['VALID_LAYERS'],
         'default_nodata': config['LANDSAT']['DEFAULT_NODATA'],
         'ndvi_bands_dict': config['LANDSAT']['NDVI_BANDS_DICT'],
         'rgb_bands_dict': config['LANDSAT']['RGB_BANDS_DICT'],
         'years_range': range(fire_metadata['FIRE_YEAR'] - int(config['RECOVERY_PARAMS']['YRS_PREFIRE_MATCHED']), datetime.now().year+1),
         'make_daily_rgb': False,
-        'make_daily_ndvi': False
+        'make_daily_ndvi': False,
+        'download_workers': int(config['LANDSAT'].get('DOWNLOAD_WORKERS', 4)),
+        'mosaic_workers': int(config['LANDSAT'].get('MOSAIC_WORKERS', 1)),
+        'max_windows_on_disk': int(config['LANDSAT'].get('MAX_WINDOWS_ON_DISK', 4)),
+        'stream_raw_scenes': bool(config['LANDSAT'].get('STREAM_RAW_SCENES', False)),
+        'scratch_dirs': [os.path.join(config['LANDSAT']['dir_name'], 'unmerged_scenes'), get_shared_requests_dir(config)],
+        'scratch_quota_gb': config['LANDSAT'].get('SCRATCH_QUOTA_GB', None),
+        'scratch_wait_hours': float(config['LANDSAT'].get('SCRATCH_WAIT_HOURS', 24))
     }
 
     # print args to log
@@ -384,9 +384,10 @@ def mosaic_export_from_ndvi_list(
     output_dir: str, 
     file_suffix: str,
     nodata: float
-    ) -> None:
+    ) -> str:
     """
     Mosaic NDVI into single scene, using median NDVI for each pixel over all provided scenes, and export to GeoTIFF.
+    Returns the path to the exported seasonal mosaic.
     
     Parameters:
     -----------
@@ -421,6 +422,37 @@ def mosaic_export_from_ndvi_list(
     )
     export_to_tiff(merged_ndvi, out_merged_seasonal_path, dtype_out='float32', nodata=nodata)
 
+    return out_merged_seasonal_path
+
+
+def verify_seasonal_mosaic(mosaic_path: str) -> bool:
+    """
+    Check that an exported seasonal mosaic exists, opens, and can be read in full
+    (i.e. it's safe to delete the raw scenes it was made from).
+    """
+    try:
+        with rio.open(mosaic_path) as src:
+            for _, window in src.block_windows(1):
+                src.read(1, window=window)
+            return (src.width > 0) and (src.height > 0)
+    except Exception as e:
+        print(f'WARNING: Could not verify seasonal mosaic {mosaic_path}. Error: {e}', flush=True)
+        return False
+
+
+def delete_raw_scenes(LS_DATA_DIR: str, uids: List[str]) -> float:
+    """
+    Delete all band files in LS_DATA_DIR for the given scene uids. Returns the MB freed.
+    """
+    uids = set(uids)
+    freed = 0
+    for path in glob.glob(os.path.join(LS_DATA_DIR, '*.tif')):
+        if get_prod_doy_tile(path)[0] in uids:
+            freed += os.path.getsize(path)
+            os.remove(path)
+
+    return freed / 1e6
+
 
 def mosaic_ndvi_timeseries(
     LS_DATA_DIR: str, 
@@ -431,11 +463,12 @@ def mosaic_ndvi_timeseries(
     RGB_BANDS_DICT: dict = {},
     MAKE_RGB: bool = False,
     MAKE_DAILY_NDVI: bool = False,
+    DELETE_RAW_SCENES: bool = False
     ) -> None:
     """
     Merge Landsat scenes across dates, creating seasonal NDVI composites.
     Given the path to a directory of LS images, creates seasonal merged and cloud masked images in the specified LS_OUT_DIR directory.
-    Optionally deletes all files in the original LS_DATA_DIR
+    Optionally deletes each season's raw scenes from LS_DATA_DIR as soon as its mosaic is exported and verified
     
     Params:
     LS_DATA_DIR : str
@@ -450,6 +483,8 @@ def mosaic_ndvi_timeseries(
         Create RGB images for each scene
     MAKE_DAILY_NDVI : bool, optional
         Export daily NDVI images
+    DELETE_RAW_SCENES : bool, optional
+        Delete each season's raw scenes once its mosaic is verified (to keep scratch disk bounded)
     """
     # Set suffix for tif files
     file_suffix = '_season_mosaiced.tif'
@@ -489,11 +524,16 @@ def mosaic_ndvi_timeseries(
             continue
         
         # Merge NDVI into single scene for the season, and export to tif
-        mosaic_export_from_ndvi_list(
+        mosaic_path = mosaic_export_from_ndvi_list(
             allNDVIs,
             year, 
             time_period, 
             LS_OUT_DIR,
             file_suffix,
             NODATA
-        )
\ No newline at end of file
+        )
+
+        # Optionally free up scratch space as soon as this season is done
+        if DELETE_RAW_SCENES and verify_seasonal_mosaic(mosaic_path):
+            freed_mb = delete_raw_scenes(LS_DATA_DIR, group['uid'].unique())
+            print(f'Deleted raw scenes for {year} season {time_period} ({freed_mb:.0f} MB)', flush=True)
\ No newline at end of file
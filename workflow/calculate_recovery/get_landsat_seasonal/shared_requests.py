@@ -0,0 +1,203 @@
+"""
+Share AppEEARS requests between fires whose buffered bboxes and date windows overlap (reburns,
+adjacent fires in the same year).
+
+plan_shared_requests groups download log rows into shared requests: each group is served by one
+appeears task over the union bbox and union date range of its rows. The group's bundle is downloaded
+once to a shared dir, then fan_out_shared_scenes copies each fire's scenes (clipped to that fire's
+buffered bbox, filtered to that row's date window) into the row's own dest_dir.
+"""
+
+import sys, os, glob, re, shutil
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio.windows import from_bounds
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+from shapely import STRtree
+from datetime import datetime
+
+from download_log_db import read_download_log
+
+sys.path.append("workflow/utils/")
+from file_utils import get_prod_doy_tile
+
+AREA_CRS = 'EPSG:5070' # CONUS Albers (equal area), for comparing request sizes
+
+
+def read_bboxes(shp_paths) -> dict:
+    '''Read each unique buffered fire bbox shapefile once, returning {shp_path: bbox polygon in AREA_CRS}.'''
+    return {
+        shp_path: box(*gpd.read_file(shp_path).to_crs(AREA_CRS).total_bounds)
+        for shp_path in pd.unique(pd.Series(shp_paths))
+    }
+
+
+def request_cost(bbox, start_date, end_date) -> float:
+    '''Proxy for the size of an appeears bundle: bbox area x number of days requested.'''
+    return bbox.area * ((end_date - start_date).days + 1)
+
+
+def plan_shared_requests(
+    download_log: pd.DataFrame,
+    shared_requests_dir: str,
+    bad_date: datetime
+    ) -> pd.DataFrame:
+    '''
+    Greedily group rows that still need to be requested into shared requests.
+    Rows are visited in submit_order; each ungrouped row starts a group (and is its request_leader),
+    then takes in ungrouped rows with an overlapping bbox and date window, as long as the single
+    union request is no bigger (area x days) than the separate requests it replaces and the union
+    date range does not span the bad date.
+
+    Updates request_leader, request_shp_path for all rows (shared_dir is set when the task is submitted).
+    '''
+    download_log['request_leader'] = download_log['submit_order']
+    download_log['request_shp_path'] = download_log['bufferedfire_shp_path']
+    download_log['shared_dir'] = ''
+
+    to_request = download_log[
+        (download_log['ndvi_mosaic_complete']==False) &
+        (download_log['task_status']=='unsubmitted') &
+        (download_log['task_id'].isna())
+    ].sort_values('submit_order')
+    if len(to_request) < 2: return download_log
+
+    fire_bboxes = read_bboxes(to_request['bufferedfire_shp_path'])
+    submit_orders = to_request['submit_order'].values
+    start_dates = dict(zip(submit_orders, to_request['start_date']))
+    end_dates = dict(zip(submit_orders, to_request['end_date']))
+    bboxes = [fire_bboxes[shp_path] for shp_path in to_request['bufferedfire_shp_path']]
+    row_bbox = dict(zip(submit_orders, bboxes))
+    tree = STRtree(bboxes)
+
+    grouped = set()
+    os.makedirs(shared_requests_dir, exist_ok=True)
+    for leader in submit_orders:
+        if leader in grouped: continue
+        grouped.add(leader)
+
+        group = [leader]
+        group_bbox, group_start, group_end = row_bbox[leader], start_dates[leader], end_dates[leader]
+        separate_cost = request_cost(group_bbox, group_start, group_end)
+
+        # candidates: ungrouped rows whose bbox intersects the leader's bbox, in submit order
+        candidates = sorted(submit_orders[tree.query(row_bbox[leader], predicate='intersects')])
+        for candidate in candidates:
+            if candidate in grouped: continue
+            if (start_dates[candidate] > group_end) or (end_dates[candidate] < group_start): continue # no date overlap
+
+            union_bbox = box(*group_bbox.union(row_bbox[candidate]).bounds)
+            union_start, union_end = min(group_start, start_dates[candidate]), max(group_end, end_dates[candidate])
+            if union_start < bad_date < union_end: continue
+
+            union_cost = request_cost(union_bbox, union_start, union_end)
+            candidate_cost = request_cost(row_bbox[candidate], start_dates[candidate], end_dates[candidate])
+            if union_cost > separate_cost + candidate_cost: continue
+
+            group.append(candidate)
+            grouped.add(candidate)
+            group_bbox, group_start, group_end = union_bbox, union_start, union_end
+            separate_cost += candidate_cost
+
+        if len(group) == 1: continue
+
+        # save union bbox for the shared request
+        request_shp_path = os.path.join(shared_requests_dir, f'shared_request_{leader}_bufferedshp.shp')
+        gpd.GeoDataFrame(geometry=[group_bbox], crs=AREA_CRS).to_file(request_shp_path, mode='w')
+
+        group_mask = download_log['submit_order'].isin(group)
+        download_log.loc[group_mask, 'request_leader'] = leader
+        download_log.loc[group_mask, 'request_shp_path'] = request_shp_path
+
+    num_groups = (download_log.groupby('request_leader').size() > 1).sum()
+    num_shared_rows = (download_log['request_leader'] != download_log['submit_order']).sum()
+    print(f'Planned {num_groups} shared requests, saving {num_shared_rows} appeears tasks.', flush=True)
+
+    return download_log
+
+
+def scene_date(path: str) -> datetime:
+    # doy is formatted as doyYYYYJJJ where JJJ is the julian date
+    doy = get_prod_doy_tile(path)[2]
+    return datetime.strptime(doy.strip('doy'), '%Y%j')
+
+
+def clip_scene(src_path: str, dest_path: str, bbox_shp_path: str) -> bool:
+    '''
+    Copy one scene to dest_path, clipped to the bbox in bbox_shp_path.
+    If the scene already falls within the bbox, hard-link it instead of rewriting it.
+    Returns False if the scene does not overlap the bbox.
+    '''
+    with rio.open(src_path) as src:
+        bbox_gdf = gpd.read_file(bbox_shp_path)
+        minx, miny, maxx, maxy = transform_bounds(bbox_gdf.crs, src.crs, *bbox_gdf.total_bounds)
+        left, bottom, right, top = src.bounds
+
+        if (minx >= right) or (maxx <= left) or (miny >= top) or (maxy <= bottom):
+            return False
+
+        if (minx <= left) and (maxx >= right) and (miny <= bottom) and (maxy >= top):
+            try: os.link(src_path, dest_path)
+            except OSError: shutil.copy2(src_path, dest_path) # e.g. across filesystems
+            return True
+
+        # read just the bbox window, and write it with the same tags/scale/offset as the original scene
+        window = from_bounds(max(minx, left), max(miny, bottom), min(maxx, right), min(maxy, top), src.transform)
+        window = window.round_offsets().round_lengths()
+        data = src.read(window=window)
+        profile = src.profile.copy()
+        profile.update(
+            height=data.shape[1],
+            width=data.shape[2],
+            transform=src.window_transform(window)
+        )
+        with rio.open(dest_path, 'w', **profile) as dst:
+            dst.write(data)
+            dst.update_tags(**src.tags())
+            dst.scales, dst.offsets = src.scales, src.offsets
+            for b in range(1, src.count+1):
+                dst.update_tags(b, **src.tags(b))
+
+    return True
+
+
+def fan_out_shared_scenes(
+    shared_dir: str,
+    dest_dir: str,
+    bbox_shp_path: str,
+    start_date: datetime,
+    end_date: datetime
+    ) -> str:
+    '''
+    Copy the scenes in a shared request's download dir that fall in [start_date, end_date]
+    to this row's dest_dir, clipped to this fire's buffered bbox. Skips scenes already in dest_dir.
+    '''
+    os.makedirs(dest_dir, exist_ok=True)
+    already_copied = set(os.listdir(dest_dir))
+    start_date, end_date = pd.to_datetime(start_date), pd.to_datetime(end_date)
+
+    copied = 0
+    for src_path in sorted(glob.glob(os.path.join(shared_dir, '*.tif'))):
+        fname = os.path.basename(src_path)
+        if fname in already_copied: continue
+        if not (start_date <= scene_date(src_path) <= end_date): continue
+        if clip_scene(src_path, os.path.join(dest_dir, fname), bbox_shp_path): copied += 1
+
+    print(f'Copied {copied} scenes from {shared_dir} to {dest_dir}', flush=True)
+    return dest_dir
+
+
+def remove_shared_dir_if_done(download_log_path: str, shared_dir: str) -> bool:
+    '''Delete a shared request's download dir once every row it serves has finished downloading.'''
+    download_log = read_download_log(download_log_path)
+    shared_rows = download_log[download_log['shared_dir'] == shared_dir]
+    if len(shared_rows) == 0 or not shared_rows['download_complete'].all():
+        return False
+
+    pattern = r'.*/shared_requests/LS_.*'
+    if re.match(pattern, shared_dir) and os.path.isdir(shared_dir):
+        print(f'All fires fanned out from {shared_dir}. Deleting it.', flush=True)
+        shutil.rmtree(shared_dir)
+    return True
@@ -3,136 +3,108 @@ import xarray as xr
 import rasterio as rio
 import pandas as pd
 import numpy as np
-import subprocess, glob
-from merged_band_info import band_info, band_names, encoding
+import subprocess, glob, sys, os, json, gc, shutil
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from merged_band_info import get_band_info, band_names, encoding, nodata_value, overview_factors
 from merge_allfire_recovery import *
-import time
 
 def aggregate_recovery_summaries(
     perfire_config: dict,
     processing_progress_csv_path: str,
     template_baselayer: str,
     merged_recovery_path: str,
-    uid_start: int,
-    uid_end: int
+    num_workers: int,
+    tile_size: int,
+    single_uid_band: bool = False
     ) -> None:
     '''Finds all the clipped recovery rasters in recovery_dir, merges into int8 CA-wide layers with bands described in band_info.
+    The CA-wide grid is split into tiles; each tile gets the fires overlapping it (oldest to newest, so the newest
+    fire wins), and tiles are merged concurrently in a process pool, then written into their window of the CA-wide layers.
+    Overview levels are made from each merged tile as it is written, and each band is saved as a COG (merged_{band}.tif).
+    If single_uid_band, fire UIDs are saved as one uint16 UID band instead of the int8 UID_h/UID_to bands.
+    merged_UID_lookup.csv maps each UID to its fireid.
     
     In out_summary_path, creates a pd df with UID: fire_incidID and creates tif with recovery time and UID layers
     '''
     # Order fires by date --> assign UID to each fire
     uid_fireID_list = get_ordered_fireUIDs(processing_progress_csv_path)
-    num_recovery_tifs = len(uid_fireID_list)
+    band_info = get_band_info(single_uid_band)
     
-    # Create template with no data to update with recovery times and UIDs
+    # Create empty (sparse, nodata) CA-wide tifs (+ one per overview level) to update with recovery times and UIDs
     # dtype = int8 for all  layers
-    out_raster = create_template_raster(template_baselayer, band_names)
-    
-    # For each fire (in chronological order, oldest to newest), update full CA-wide template with recovery time, UID, severity
-    for uid, fireid in uid_fireID_list[uid_start: uid_end]:
-        recovery_matched_path = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['fire_recovery_time'][0]
-        recovery_baseline_path = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['prefire_baseline_recovery_time'][0]
-        out_raster = add_fire_out_raster(
-            perfire_config,
-            uid, 
-            fireid, 
-            num_recovery_tifs, 
-            out_raster)
-        
-    # Add attributes for each variable
-    for band_name in band_names:
-        out_raster.attrs[f'{band_name}_description'] = band_info[band_name]['description']
-        out_raster.attrs[f'{band_name}_units'] = band_info[band_name]['units']
-
-    # Add global attributes
-    num_bands = len(band_names)
-    out_raster.attrs.update({
-        'title': 'Merged Fire Recovery',
-        'variable_count': str(num_bands),
-        'creation_date': str(pd.Timestamp.now()),
-        'nodata_value': str(nodata_value)
-    })
-        
-    # Save output raster
-    out_merged_path = f'{merged_recovery_path.strip('.nc')}_merged_{uid_start}_{uid_end}.nc'
-    out_raster.to_netcdf(out_merged_path, format='NETCDF4', engine='netcdf4')
-    print(f'Successfully exported {out_merged_path} as:\n{out_raster}', flush=True)
-    
-    # Save per-variable output tif
-    for band_name in band_names:
-        out_merged_tif = out_merged_path.replace('_merged_', f'_merged_{band_name}_').replace('.nc', '.tif')
-        out_raster[band_name].rio.write_nodata(-128).rio.to_raster(out_merged_tif, dtype=np.int8, PIXELTYPE='SIGNEDBYTE')
-        print(f'Successfully exported {os.path.basename(out_merged_tif)}', flush=True)
-    
-    return None
-
-
-def merge_all_recovery_rasters(merged_recovery_path, total_aggregate_maps):
-    '''Once all subsets of fires have been merged by aggregate_recovery_summaries, merge all the aggregate recovery maps into 1 final map.
-    '''
-    last_band_name = band_names[-1]
-    all_rasters = glob.glob(os.path.join(os.dirname(merged_recovery_path), f'merged_{last_band_name}_*.tif'))
-
-    while len(all_rasters)<total_aggregate_maps:
-        # wait until all jobs finish
-        print(f'Only have {len(all_rasters)}, but expecting {total_aggregate_maps}.\nCurrent list is: {all_rasters}.\nWaiting 5 minutes and checking again.', flush=True)
-        time.sleep(60*5) # wait 5 minutes and check again
-        all_rasters = glob.glob(os.path.join(os.dirname(merged_recovery_path), 'merged_recovery_time_*.tif'))
+    grid = get_merged_grid(template_baselayer)
+    merged_dir = os.path.dirname(merged_recovery_path)
+    work_dir = os.path.join(merged_dir, 'merge_tiles_tmp')
+    os.makedirs(work_dir, exist_ok=True)
+    assert tile_size % max(overview_factors) == 0, f'Merge tile size {tile_size} must be a multiple of {max(overview_factors)}'
+    out_tifs = create_merged_band_tifs(os.path.join(work_dir, 'merged_{band}.tif'), grid, band_info)
+    overview_tifs = {
+        factor: create_merged_band_tifs(os.path.join(work_dir, f'merged_{{band}}_ovr{factor}.tif'), get_overview_grid(grid, factor), band_info)
+        for factor in overview_factors
+    }
 
-    sorted_rasters = sorted(all_rasters, key=extract_first_number)
+    # Vegetation type codes, shared by all fires
+    vegetation_csv_f = perfire_config[uid_fireID_list[0][1]]['FILE_PATHS']['BASELAYERS']['groupings_summary_csv']
+    vegetation_type_dict = get_vegetation_type_dict(pd.read_csv(vegetation_csv_f))
+    pd.DataFrame(vegetation_type_dict.items(), columns=['NLCD_NAME', 'vegetation_type']).to_csv(
+        os.path.join(merged_dir, 'vegetation_type_dict.csv'), index=False)
 
-    # EXPORT SINGLE BAND TIFS OF EACH BAND AFTER MERGING
-    for band in band_names:
-        f_to_merge = [f.replace('recovery_time', band).replace('.nc', '.tif') for f in sorted_rasters]
-        rasters_to_merge = [rxr.open_rasterio(f.replace('recovery_time', band).replace('.nc', '.tif')) for f in sorted_rasters]
-        print(f'About to merge: {f_to_merge}')
-        
-        merged_raster = merge_arrays(rasters_to_merge, nodata=-128, method='last')
-        out_path = os.path.join(os.dirname(merged_recovery_path), f'merged_{band}.tif')
-        merged_raster.rio.to_raster(out_path, PIXELTYPE='SIGNEDBYTE', **encoding)
-        print(f'Successfully exported merged_{band}.tif', flush=True)
-        
-        del rasters_to_merge, merged_raster
-        gc.collect()
-    
-    # Export nc file
-    cmd = [
-        'gdal_merge.py',
-        '-o', merged_recovery_path,
-        '-n', '-128',
-        '-a_nodata', '-128',
-        '-ot', 'Int8',
-        '-co', 'FORMAT=NC4',
-        '-co', 'COMPRESS=DEFLATE'
-    ]
-    
-    # Add all input files
-    cmd.extend(sorted_rasters)
-    
-    print(f'Running command: {' '.join(cmd)}')
+    # Assign the fires overlapping each tile, in chronological order
+    fire_windows = get_fire_windows(perfire_config, uid_fireID_list, grid)
+    pd.DataFrame([(uid, fireid) for uid, fireid, _ in fire_windows], columns=['uid', 'fireid']).to_csv(
+        os.path.join(merged_dir, 'merged_UID_lookup.csv'), index=False)
+    tile_fires = assign_fires_to_tiles(get_tiles(grid, tile_size), fire_windows)
+    print(f'Merging {len(fire_windows)} fires over {len(tile_fires)} tiles with {num_workers} workers.', flush=True)
     
+    # Merge tiles in parallel; write each tile (and its overviews) as it finishes (only this process writes to the tifs)
+    out_dsts = {band_name: rio.open(out_tif, 'r+') for band_name, out_tif in out_tifs.items()}
+    overview_dsts = {
+        factor: {band_name: rio.open(out_tif, 'r+') for band_name, out_tif in tifs.items()}
+        for factor, tifs in overview_tifs.items()
+    }
     try:
-        result = subprocess.run(
-            cmd,
-            check=True,  # Raises exception if command fails
-            capture_output=True,
-            text=True
-        )
-        
-        print(f'Merged all recovery rasters: {sorted_rasters}')
-        if result.stdout:
-            print('STDOUT:', result.stdout)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(
+                    merge_tile, tile, fires, {fireid: perfire_config[fireid] for _, fireid, _ in fires},
+                    grid, band_info, vegetation_type_dict, overview_factors
+                )
+                for tile, fires in tile_fires
+            ]
+            for i, future in enumerate(as_completed(futures), start=1):
+                tile, out, overviews = future.result()
+                for band_name, dst in out_dsts.items():
+                    dst.write(out[band_name], 1, window=tile)
+                for factor, dsts in overview_dsts.items():
+                    for band_name, dst in dsts.items():
+                        dst.write(overviews[band_name][factor], 1, window=get_overview_window(tile, factor))
+                print(f'{i}/{len(futures)}:\tMerged tile {tile}', flush=True)
         
-        return True
-        
-    except subprocess.CalledProcessError as e:
-        print('Error running gdal_merge.py: {e}')
-        print(f'Return code: {e.returncode}')
-        if e.stdout:
-            print(f'STDOUT: {e.stdout}')
-        if e.stderr:
-            print(f'STDERR: {e.stderr}')
-        return False
+        # Add global attributes
+        for dst in out_dsts.values():
+            dst.update_tags(
+                title='Merged Fire Recovery',
+                creation_date=str(pd.Timestamp.now()),
+                nodata_value=str(nodata_value),
+                num_fires=str(len(fire_windows))
+            )
+    finally:
+        for dst in out_dsts.values(): dst.close()
+        for dsts in overview_dsts.values():
+            for dst in dsts.values(): dst.close()
+
+    # Write each band as a COG, with the overviews made during the merge
+    for band_name, out_tif in out_tifs.items():
+        out_cog = write_cog(
+            out_tif,
+            {factor: tifs[band_name] for factor, tifs in overview_tifs.items()},
+            os.path.join(merged_dir, f'merged_{band_name}.tif')
+        )
+        print(f'Successfully exported {os.path.basename(out_cog)}', flush=True)
+    shutil.rmtree(work_dir)
+    
+    return None
 
 
 if __name__ == '__main__':
@@ -140,10 +112,7 @@ if __name__ == '__main__':
     print(f'Running main_merge_allfire_recovery.py with arguments {'\n'.join(sys.argv)}\n', flush=True)
     config_path = sys.argv[1]
     perfire_config_path = sys.argv[2]
-    uid_start = int(sys.argv[3])
-    uid_end = int(sys.argv[4])
-    merge_all = str(sys.argv[5])=='True'
-    done_flag = sys.argv[6]
+    done_flag = sys.argv[3]
 
     # read in jsons
     with open(config_path, 'r') as f:
@@ -153,22 +122,21 @@ if __name__ == '__main__':
 
     # get args from config
     recovery_dir = config['RECOVERY_PARAMS']['RECOVERY_MAPS_DIR']
-    merged_recovery_path = os.path.join(recovery_dir, 'merged_recovery_full.nc')
+    merged_recovery_path = os.path.join(recovery_dir, 'merged_recovery_full.tif')
     processing_progress_csv_path = config['RECOVERY_PARAMS']['LOGGING_PROCESS_CSV']
     template_baselayer = config['BASELAYERS']['topo']['fname']
+    num_workers = int(config['RECOVERY_PARAMS'].get('MERGE_WORKERS', os.cpu_count()))
+    tile_size = int(config['RECOVERY_PARAMS'].get('MERGE_TILE_SIZE', 4096))
+    single_uid_band = bool(config['RECOVERY_PARAMS'].get('MERGE_SINGLE_UID_BAND', False))
 
-    # aggregate from uid_start to uid_end
+    # merge all fires, tile by tile
     aggregate_recovery_summaries(
         perfire_config,
         processing_progress_csv_path,
         template_baselayer,
         merged_recovery_path,
-        uid_start,
-        uid_end)
-
-    # merge all fires (if this is the last job)
-    if merge_all:
-        total_aggregate_maps = uid_end // 100 # 1 merged file per 100 fires
-        merge_all_recovery_rasters(merged_recovery_path, total_aggregate_maps)
+        num_workers,
+        tile_size,
+        single_uid_band)
 
     subprocess.run(['touch', done_flag])
\ No newline at end of file
@@ -1,11 +1,24 @@
-import os, re, shutil, gc, subprocess
+import sys, os, re, shutil, gc, subprocess
 import rioxarray as rxr
 import xarray as xr
 import rasterio as rio
 import pandas as pd
 import numpy as np
 import filelock
+import xml.etree.ElementTree as ET
+from affine import Affine
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window, from_bounds, intersect
+from rasterio.warp import reproject, transform_bounds, Resampling
+from shapely.geometry import box
+from shapely import STRtree
 from scipy.ndimage import uniform_filter
+from typing import List
+
+from merged_band_info import nodata_value
+
+sys.path.append("workflow/utils/")
+from geo_utils import export_burnbndy_dist, get_burnbndy_dist_path
 
 # TODO: need to add layer for new recovery metrics, too
 
@@ -15,7 +28,7 @@ def extract_date(fireid):
     match = re.search(r'(\d{8})$', dir_basename)
     if match: return int(match.group(1))
     else: return None
-    
+
 
 def sort_dirs_by_date(dir_list: List[str]) -> List[str]:
     # return directories sorted by date
@@ -23,206 +36,429 @@ def sort_dirs_by_date(dir_list: List[str]) -> List[str]:
 
 
 def get_ordered_fireUIDs(processing_progress_csv_path):
-    ''' 
+    '''
     Add unique IDs (ranging from 1-N) to processing progress summary CSV
     '''
 
     # check if UIDs were already made
     summary_csv = pd.read_csv(processing_progress_csv_path)
-    
+
     # if already made
     if 'uid' in summary_csv.columns:
-        uid, fire_id = pd.read_csv(temp_csv)[['uid','fireid']]
-        uid_fireID_list = list(zip(uid, fire_id))
+        summary_csv = summary_csv.sort_values('uid')
+        uid_fireID_list = list(zip(summary_csv['uid'], summary_csv['fireid']))
 
     # otherwise, make ordered fireids csv
     else:
-        lock_file = progress_log_path + '.lock'
+        lock_file = processing_progress_csv_path + '.lock'
         lock = filelock.FileLock(lock_file, timeout=60)  # wait for lock, if necessary (other batch jobs for other fires may also be waiting to update csv)
         try:
             with lock:
-                summary_csv = pd.read_csv(progress_log_path)
+                summary_csv = pd.read_csv(processing_progress_csv_path)
                 # Order fires by date --> assign UID to each fire
                 sorted_fires = sort_dirs_by_date(summary_csv['fireid'])
-                uid_fireID_list = list(enumerate(fireID_list, start=0)) # create unique integer IDs (1-N) for each fireid
+                uid_fireID_list = list(enumerate(sorted_fires, start=1)) # create unique integer IDs (1-N) for each fireid
                 uid_fireID_df = pd.DataFrame(
                     uid_fireID_list,
                     columns=['uid', 'fireid']
                     )
-        
+
                 # create backup of original summary csv
-                shutil.copy(summary_csv_path, summary_csv_path.replace('.csv', '_backup.csv'))
+                shutil.copy(processing_progress_csv_path, processing_progress_csv_path.replace('.csv', '_backup.csv'))
 
                 # Add UID column to existing summary csv and then save output
-                pd.merge([summary_csv, uid_fireID_df], on='fireid').to_csv(summary_csv_path)
-        
+                pd.merge(summary_csv, uid_fireID_df, on='fireid').to_csv(processing_progress_csv_path, index=False)
+
         except filelock.Timeout:
             print("Could not acquire lock on file after waiting", flush=True)
 
     return uid_fireID_list
 
 
-def create_template_raster(baselayer_template, band_names):
-    print(f'Creating template recovery time raster.', flush=True)
-    template_raster = xr.open_dataset(baselayer_template, 
-                                format="NETCDF4", 
-                                engine="netcdf4", 
-                                chunks='auto') # open template raster
-    
-    print(template_raster, flush=True)
-    target_crs = template_raster.spatial_ref.crs_wkt
-    transform = template_raster.spatial_ref.rio.transform()
-    
-    # Create layers initialized at nodata val
-    num_bands = len(band_names)
-    template_data = np.full(
-        (len(template_raster.y), len(template_raster.x)),
-        nodata_value,
-        dtype=np.int8
-    )
-    out_raster = xr.Dataset(
-        {
-        band_name: (["y", "x"], template_data) for band_name in band_names
-        },
-        coords={
-            'y': template_raster.y,
-            'x': template_raster.x
-        }
+def get_merged_grid(baselayer_template):
+    '''Get the statewide grid (crs, transform, shape) from the template baselayer, without reading its data.'''
+    template_raster = xr.open_dataset(baselayer_template,
+                                format="NETCDF4",
+                                engine="netcdf4") # open template raster (lazily; only coords are read)
+    grid = {
+        'crs': template_raster.spatial_ref.crs_wkt,
+        'transform': template_raster.rio.transform(),
+        'width': len(template_raster.x),
+        'height': len(template_raster.y)
+    }
+    template_raster.close()
+
+    print(f'Merged grid: {grid}', flush=True)
+    return grid
+
+
+def create_merged_band_tifs(out_tif_template, grid, band_info):
+    '''
+    Create one empty (all nodata) tiled int8 GeoTIFF per band on the statewide grid, to be filled in by windowed writes.
+    Files are sparse, so unwritten blocks take no disk space and read back as nodata.
+    out_tif_template is formatted with each band name, e.g. 'merged_{band}.tif'
+    '''
+    out_tifs = {}
+    for band_name, info in band_info.items():
+        out_tif = out_tif_template.format(band=band_name)
+        with rio.open(
+            out_tif, 'w',
+            driver='GTiff',
+            width=grid['width'],
+            height=grid['height'],
+            count=1,
+            dtype=info['dtype'],
+            crs=grid['crs'],
+            transform=grid['transform'],
+            nodata=info['nodata'],
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            compress='deflate',
+            BIGTIFF='IF_SAFER',
+            SPARSE_OK=True
+        ) as dst:
+            dst.set_band_description(1, band_name)
+            dst.update_tags(1, description=info['description'], units=info['units'])
+        out_tifs[band_name] = out_tif
+        print(f'Created empty merged {band_name} raster: {out_tif}', flush=True)
+
+    return out_tifs
+
+
+def get_overview_grid(grid, factor):
+    # grid of one overview level (same size rounding as GDAL: ceil(size/factor))
+    return {
+        'crs': grid['crs'],
+        'transform': grid['transform'] * Affine.scale(factor),
+        'width': int(np.ceil(grid['width'] / factor)),
+        'height': int(np.ceil(grid['height'] / factor))
+    }
+
+
+def get_overview_window(window, factor):
+    # window of an overview level covering window (window offsets must be multiples of factor)
+    return Window(
+        window.col_off // factor, window.row_off // factor,
+        int(np.ceil(window.width / factor)), int(np.ceil(window.height / factor)))
+
+
+def downsample_2x(arr, nodata, resampling, sentinel=None):
+    '''
+    Halve an array's resolution: each 2x2 block becomes its mode (categorical bands) or rounded mean ('average'),
+    ignoring nodata. Blocks with no data are nodata.
+    For 'average', sentinel values (e.g. never recovered=127) are left out of the mean too: a block is sentinel
+    only if all of its data is sentinel.
+    '''
+    # pad to even size with nodata, then put each 2x2 block's values along the last axis
+    arr = np.pad(arr, ((0, arr.shape[0] % 2), (0, arr.shape[1] % 2)), constant_values=nodata)
+    h, w = arr.shape[0] // 2, arr.shape[1] // 2
+    blocks = arr.reshape(h, 2, w, 2).transpose(0, 2, 1, 3).reshape(h, w, 4)
+    valid = blocks != nodata
+    num_valid = valid.sum(axis=-1)
+
+    if resampling == 'average':
+        averaged = valid if sentinel is None else valid & (blocks != sentinel)
+        num_averaged = averaged.sum(axis=-1)
+        block_sum = np.where(averaged, blocks, 0).sum(axis=-1, dtype=np.int32)
+        out = np.where(num_averaged > 0, np.round(block_sum / np.maximum(num_averaged, 1)), sentinel if sentinel is not None else nodata)
+    else:
+        # count of each value within its block; most common valid value wins (ties go to the first one in the block)
+        counts = ((blocks[..., :, None] == blocks[..., None, :]) & valid[..., None, :]).sum(axis=-1)
+        counts = np.where(valid, counts, 0)
+        out = np.take_along_axis(blocks, counts.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+
+    return np.where(num_valid > 0, out, nodata).astype(arr.dtype)
+
+
+def make_tile_overviews(out, band_info, factors):
+    '''
+    Overview levels of each band of a merged tile, each level made from the previous one (as gdaladdo does).
+    Returns {band name: {factor: array}}.
+    '''
+    overviews = {}
+    for band_name, info in band_info.items():
+        overviews[band_name] = {}
+        arr, prev_factor = out[band_name], 1
+        for factor in factors:
+            while prev_factor < factor:
+                arr = downsample_2x(arr, info['nodata'], info['overview_resampling'], info.get('overview_sentinel'))
+                prev_factor *= 2
+            overviews[band_name][factor] = arr
+    return overviews
+
+
+def write_cog(full_res_tif, overview_tifs, out_cog):
+    '''
+    Write a COG from the full resolution tif and its precomputed overview tifs ({factor: path}).
+    A VRT declares the overview tifs as the full resolution tif's overviews, so the COG driver just copies them in
+    (OVERVIEWS=FORCE_USE_EXISTING) instead of resampling the full resolution data again.
+    '''
+    vrt_f = os.path.splitext(out_cog)[0] + '.vrt'
+    with rio.open(full_res_tif) as src:
+        vrt = ET.Element('VRTDataset', rasterXSize=str(src.width), rasterYSize=str(src.height))
+        ET.SubElement(vrt, 'SRS').text = src.crs.to_wkt()
+        ET.SubElement(vrt, 'GeoTransform').text = ', '.join(str(v) for v in src.transform.to_gdal())
+        add_vrt_metadata(vrt, src.tags())
+
+        band = ET.SubElement(vrt, 'VRTRasterBand', dataType=gdal_dtype(src.dtypes[0]), band='1')
+        ET.SubElement(band, 'Description').text = src.descriptions[0]
+        ET.SubElement(band, 'NoDataValue').text = str(src.nodata)
+        add_vrt_metadata(band, src.tags(1))
+        for source_tif, element in [(full_res_tif, 'SimpleSource')] + [(overview_tifs[f], 'Overview') for f in sorted(overview_tifs)]:
+            source = ET.SubElement(band, element)
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='0').text = os.path.abspath(source_tif)
+            ET.SubElement(source, 'SourceBand').text = '1'
+    ET.ElementTree(vrt).write(vrt_f)
+
+    rio_copy(
+        vrt_f, out_cog,
+        driver='COG',
+        COMPRESS='DEFLATE',
+        BLOCKSIZE=512,
+        OVERVIEWS='FORCE_USE_EXISTING',
+        BIGTIFF='IF_SAFER',
+        SPARSE_OK=True
     )
-    
-    # Add CRS and transform information, globally and per-band
-    out_raster = out_raster.rio.write_crs(target_crs)
-    out_raster = out_raster.rio.write_transform(transform)
-    # out_raster = out_raster.rio.set_nodata(nodata_value)
-
-    for band_name in band_names:
-        out_raster[band_name] = out_raster[band_name].rio.write_crs(target_crs)
-        out_raster[band_name] = out_raster[band_name].rio.write_transform(transform)
-        out_raster[band_name] = out_raster[band_name].rio.set_nodata(nodata_value)
-    
-    # Memory management
-    del template_raster
-    gc.collect()
-    
-    print(out_raster, flush=True)
-    print(f'Finished creating template recovery time raster.', flush=True)
+    os.remove(vrt_f)
+    return out_cog
 
-    return out_raster
 
+def add_vrt_metadata(element, tags):
+    metadata = ET.SubElement(element, 'Metadata')
+    for key, value in tags.items():
+        if key == 'AREA_OR_POINT': continue
+        ET.SubElement(metadata, 'MDI', key=key).text = str(value)
 
-def calculate_burnbndy_dist(severity_tif):
-    # Create burn boundary raster using severity raster
-    rasterized_boundary = np.where(severity_tif.data==0, 1, 0)
 
-    # Create distance transform (pixels outside boundary get distance to nearest boundary)
-    distance_arr = distance_transform_edt(~rasterized_boundary.astype(bool))
-    
-    # Convert pixel distances to km units
-    pixel_size = abs(severity_tif.rio.transform()[0])  # assuming square pixels
-    print(f'pixel size: {pixel_size}')
-    distance_km_arr = np.ceil(distance_arr * pixel_size * 10**-3)
-    distance_km_arr = np.where(distance_km_arr > 127, 127, distance_km_arr) # if >127*100m away, can't be repr with int8, but set as maxval
-    distance_km_tif = severity_tif.copy(data=distance_km_arr)
+def gdal_dtype(dtype):
+    # numpy dtype name -> GDAL data type name, for the VRT
+    return {'int8': 'Int8', 'uint8': 'Byte', 'int16': 'Int16', 'uint16': 'UInt16', 'int32': 'Int32', 'float32': 'Float32'}[str(dtype)]
+
+
+def get_fire_window(grid, fire_tif_f):
+    '''Pixel window of the statewide grid covering this fire's raster (None if it falls outside the grid).'''
+    with rio.open(fire_tif_f) as src:
+        bounds = transform_bounds(src.crs, grid['crs'], *src.bounds)
+
+    window = from_bounds(*bounds, transform=grid['transform'])
+    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+    try:
+        return window.intersection(Window(0, 0, grid['width'], grid['height']))
+    except rio.errors.WindowError:
+        return None
 
-    del distance_arr, distance_km_arr, rasterized_boundary
-    gc.collect()
 
-    return distance_km_tif
+def reproject_to_window(src_f, grid, window, dst_nodata, dtype, resampling=Resampling.nearest):
+    '''Read a per-fire raster, resampled onto just this window of the statewide grid.'''
+    out_arr = np.full((int(window.height), int(window.width)), dst_nodata, dtype=dtype)
+    with rio.open(src_f) as src:
+        reproject(
+            source=rio.band(src, 1),
+            destination=out_arr,
+            src_nodata=src.nodata,
+            dst_transform=rio.windows.transform(window, grid['transform']),
+            dst_crs=grid['crs'],
+            dst_nodata=dst_nodata,
+            resampling=resampling
+        )
+    return out_arr
 
 
-def update_recovery_tif_missingdatavals(recovery_tif, future_dist_agdev_mask, temporal_coverage_qa, matched_group_temporal_coverage_qa, severity_tif):
+def create_veg_layer(groups_arr, vegetation_csv, vegetation_type_dict, groups_nodata=-9999):
+    '''
+    Convert per-fire groups (veg_elev_id followed by 3 digit prefire ndvi group, see GROUPING_BAND_FORMAT)
+    to vegetation type codes, using the groupings summary csv (id -> NLCD_NAME) and vegetation_type_dict (NLCD_NAME -> code).
+    '''
+    veg_elev_id = np.where(groups_arr == groups_nodata, 0, groups_arr // 1000)
+    id_to_veg = np.full(int(max(vegetation_csv['id'].max(), veg_elev_id.max())) + 1, nodata_value, dtype=np.int8)
+    for group_id, nlcd_name in vegetation_csv[['id', 'NLCD_NAME']].itertuples(index=False):
+        id_to_veg[int(group_id)] = vegetation_type_dict[nlcd_name]
+
+    return np.where(veg_elev_id > 0, id_to_veg[veg_elev_id], nodata_value).astype(np.int8)
+
+
+def get_vegetation_type_dict(vegetation_csv):
+    # vegetation type code for each NLCD name (1-N)
+    return {nlcd_name: i for i, nlcd_name in enumerate(sorted(vegetation_csv['NLCD_NAME'].unique()), start=1)}
+
+
+def update_recovery_tif_missingdatavals(recovery_arr, future_dist_agdev_mask, temporal_coverage_qa, matched_group_temporal_coverage_qa, severity_arr):
     # For recovery raster, set nodata/bad data/disturbed pixels to -128 and never recovered to 127
-    recovery_tif.data[:] = np.where(
-        (recovery_tif.data < 0) | (recovery_tif.data > 127), # previously, nodata=-9999
+    recovery_arr = np.where(
+        (recovery_arr < 0) | (recovery_arr > 127), # previously, nodata=-9999
         127,
-        recovery_tif.data)
+        recovery_arr)
+
+    recovery_arr = np.where(
+        (future_dist_agdev_mask > 0) | (temporal_coverage_qa > 0) | (matched_group_temporal_coverage_qa > 0) | (severity_arr < 2) | (severity_arr > 4),
+        nodata_value,
+        recovery_arr).astype(np.int8)
+
+    return recovery_arr
+
 
-    recovery_tif.data[:] = np.where(
-        (future_dist_agdev_mask > 0) | (temporal_coverage_qa > 0) | (matched_group_temporal_coverage_qa > 0) | (severity_tif < 2) | (severity_tif > 4), 
-        -128, 
-        recovery_tif.data).astype(np.int8)
+def get_fire_recovery_f(perfire_config, fireid):
+    return perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['fire_recovery_time'][0].replace('.tif', '_clipped.tif')
 
-    return recovery_tif
 
+def get_burnbndy_dist_f(perfire_config, fireid):
+    '''Burn boundary distance cached by the per-fire job (calculated here, for fires run before it was cached).'''
+    file_paths = perfire_config[fireid]['FILE_PATHS']
+    burnbndy_dist_f = file_paths.get('OUT_BURN_BNDY_DIST_TIF', get_burnbndy_dist_path(file_paths['BASELAYERS']['severity']))
+    if not os.path.exists(burnbndy_dist_f):
+        export_burnbndy_dist(file_paths['BASELAYERS']['severity'], burnbndy_dist_f)
+    return burnbndy_dist_f
 
-def add_fire_out_raster(perfire_config, uid, fireid, num_recovery_tifs, out_raster):
-    fire_date = pd.to_datetime(extract_date(fire_dir), format='%Y%m%d')
+
+def get_fire_windows(perfire_config, uid_fireID_list, grid):
+    '''Window of the statewide grid for each fire with a clipped recovery raster, as (uid, fireid, window), in uid order.'''
+    fire_windows = []
+    for uid, fireid in uid_fireID_list:
+        matched_recovery_f = get_fire_recovery_f(perfire_config, fireid)
+        if not os.path.exists(matched_recovery_f):
+            print(f'No recovery raster found for {fireid}. Skipping.', flush=True)
+            continue
+
+        window = get_fire_window(grid, matched_recovery_f)
+        if window is None:
+            print(f'{fireid} is outside the merged grid. Skipping.', flush=True)
+            continue
+        fire_windows.append((uid, fireid, window))
+
+    return fire_windows
+
+
+def get_tiles(grid, tile_size):
+    # split the statewide grid into tile_size x tile_size windows (tile_size should be a multiple of the 512px block size)
+    return [
+        Window(col_off, row_off, min(tile_size, grid['width'] - col_off), min(tile_size, grid['height'] - row_off))
+        for row_off in range(0, grid['height'], tile_size)
+        for col_off in range(0, grid['width'], tile_size)
+    ]
+
+
+def window_box(window):
+    # window as a shapely box in pixel (col, row) coords
+    return box(window.col_off, window.row_off, window.col_off + window.width, window.row_off + window.height)
+
+
+def assign_fires_to_tiles(tiles, fire_windows):
+    '''
+    For each tile, list the fires whose windows overlap it, in chronological (uid) order, using an STRtree over fire windows.
+    Returns [(tile, [(uid, fireid, fire_window), ...]), ...] for tiles with at least one fire.
+    '''
+    if len(fire_windows) == 0: return []
+    tree = STRtree([window_box(fire_window) for _, _, fire_window in fire_windows])
+
+    tile_fires = []
+    for tile in tiles:
+        # 'intersects' includes windows that only share an edge with the tile; keep those with overlapping pixels
+        idxs = sorted(tree.query(window_box(tile), predicate='intersects'), key=lambda i: fire_windows[i][0])
+        fires = [fire_windows[i] for i in idxs if intersect(tile, fire_windows[i][2])]
+        if len(fires) > 0: tile_fires.append((tile, fires))
+
+    return tile_fires
+
+
+def add_fire_out_raster(perfire_config, uid, fireid, out, tile, fire_window, grid, vegetation_type_dict):
+    '''
+    Write this fire's recovery, severity, vegetation, UID, fire year and burn boundary distance into the merged
+    tile arrays (out: band name -> array covering tile), overwriting older fires.
+    Only the part of the fire's window inside this tile is read and resampled.
+    '''
+    fire_date = pd.to_datetime(str(extract_date(fireid)), format='%Y%m%d')
     fire_yr = int(fire_date.year)
 
     ## ADD RECOVERY
     # Get recovery tif
-    matched_recovery_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['fire_recovery_time'][0].replace('.tif', '_clipped.tif')
-    baseline_recovery_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['prefire_baseline_recovery_time'][0].replace('.tif', '_clipped.tif')
-    future_dist_tif_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['future_dist_agdev_mask'][0] 
-    temp_coverage_qa_tif_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['temporal_coverage_qa'][0] 
-    matched_group_qa_tif_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['matched_group_temporal_coverage_qa'][0] 
-    severity_tif_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['severity'][0] 
-    vegetation_tif_f = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']['groups'][0] 
+    out_tifs_d = perfire_config[fireid]['FILE_PATHS']['OUT_TIFS_D']
+    matched_recovery_f = get_fire_recovery_f(perfire_config, fireid)
+    baseline_recovery_f = out_tifs_d['prefire_baseline_recovery_time'][0].replace('.tif', '_clipped.tif')
+    future_dist_tif_f = out_tifs_d['future_dist_agdev_mask'][0]
+    temp_coverage_qa_tif_f = out_tifs_d['temporal_coverage_qa'][0]
+    matched_group_qa_tif_f = out_tifs_d['matched_group_temporal_coverage_qa'][0]
+    severity_tif_f = out_tifs_d['severity'][0]
+    vegetation_tif_f = out_tifs_d['groups'][0]
     vegetation_csv_f = perfire_config[fireid]['FILE_PATHS']['BASELAYERS']['groupings_summary_csv']
 
-    if os.path.exists(matched_recovery_f): 
-        print(f'{uid}/{num_recovery_tifs}:\tAdding {os.path.basename(matched_recovery_f)} to full recovery time raster.', flush=True)
-    else:
-        print(f'No recovery raster found for {fireid}. Skipping.', flush=True) 
-        return out_raster
-    
-    # Open relevant layers
-    matched_recovery = rxr.open_rasterio(matched_recovery_f)
-    baseline_recovery = rxr.open_rasterio(baseline_recovery_f)
-    future_dist_agdev_mask = rxr.open_rasterio(future_dist_tif_f).rio.reproject_match(recovery_tif).squeeze() # update to match extent of template
-    temporal_coverage_qa = rxr.open_rasterio(temp_coverage_qa_tif_f).rio.reproject_match(recovery_tif).squeeze()
-    matched_group_temporal_coverage_qa = rxr.open_rasterio(matched_group_qa_tif_f).rio.reproject_match(recovery_tif).squeeze()
-    severity_tif = rxr.open_rasterio(severity_tif_f).rio.reproject_match(recovery_tif).squeeze()
-    vegetation_tif = rxr.open_rasterio(vegetation_tif_f)
+    # This fire's pixels in this tile
+    window = fire_window.intersection(tile)
+
+    # Open relevant layers, resampled onto the window
+    matched_recovery = reproject_to_window(matched_recovery_f, grid, window, -9999, np.int32)
+    baseline_recovery = reproject_to_window(baseline_recovery_f, grid, window, -9999, np.int32)
+    future_dist_agdev_mask = reproject_to_window(future_dist_tif_f, grid, window, 0, np.int8)
+    temporal_coverage_qa = reproject_to_window(temp_coverage_qa_tif_f, grid, window, 0, np.int8)
+    matched_group_temporal_coverage_qa = reproject_to_window(matched_group_qa_tif_f, grid, window, 0, np.int8)
+    severity_arr = reproject_to_window(severity_tif_f, grid, window, -1, np.int8)
     vegetation_csv = pd.read_csv(vegetation_csv_f)[['id','NLCD_NAME']]
-    vegetation_tif = create_veg_layer(vegetation_tif, vegetation_csv)
+    vegetation_arr = create_veg_layer(
+        reproject_to_window(vegetation_tif_f, grid, window, -9999, np.int32), vegetation_csv, vegetation_type_dict)
 
     # For recovery raster, set nodata/bad data/disturbed pixels to -128 and never recovered to 127
     matched_recovery = update_recovery_tif_missingdatavals(
-        matched_recovery, 
-        future_dist_agdev_mask, 
-        temporal_coverage_qa, 
-        matched_group_temporal_coverage_qa, 
-        severity_tif)
+        matched_recovery,
+        future_dist_agdev_mask,
+        temporal_coverage_qa,
+        matched_group_temporal_coverage_qa,
+        severity_arr)
 
     baseline_recovery = update_recovery_tif_missingdatavals(
-        baseline_recovery, 
-        future_dist_agdev_mask, 
-        temporal_coverage_qa, 
-        matched_group_temporal_coverage_qa, 
-        severity_tif)
+        baseline_recovery,
+        future_dist_agdev_mask,
+        temporal_coverage_qa,
+        matched_group_temporal_coverage_qa,
+        severity_arr)
 
-    # Calcualte burn boundary distance
-    distance_km_tif = calculate_burnbndy_dist(severity_tif)
+    # Burn boundary distance, calculated once per fire on the severity raster's grid
+    distance_arr = reproject_to_window(get_burnbndy_dist_f(perfire_config, fireid), grid, window, nodata_value, np.int8)
 
     # Memory management
     del future_dist_agdev_mask, temporal_coverage_qa, matched_group_temporal_coverage_qa
     gc.collect()
-    
-    # Update template raster with this raster's recovery and burn severity, overwriting data from older fires, if necessary
-    matched_recovery = matched_recovery.rio.reproject_match(out_raster).data.squeeze() # update to match extent of template
-    severity_tif = severity_tif.rio.reproject_match(out_raster).data.squeeze()
-    vegetation_tif = vegetation_tif.rio.reproject_match(out_raster).data.squeeze()
-    distance_km_tif = distance_km_tif.rio.reproject_match(out_raster).data.squeeze()
-    
-    out_raster['matched_recovery_time'].data[:] = np.where(matched_recovery > 0, matched_recovery, out_raster['matched_recovery_time'].data).squeeze().astype(np.int8)
-    out_raster['matched_recovery_status'].data[:] = np.where(matched_recovery > 0, 1, out_raster['matched_recovery_status'].data).squeeze().astype(np.int8)
-    out_raster['matched_recovery_status'].data[:] = np.where(matched_recovery == 127, 0, out_raster['matched_recovery_status'].data).squeeze().astype(np.int8)
-    
-    out_raster['prefire_baseline_recovery_time'].data[:] = np.where(baseline_recovery > 0, baseline_recovery, out_raster['prefire_baseline_recovery_time'].data).squeeze().astype(np.int8)
-    out_raster['prefire_baseline_recovery_time'].data[:] = np.where(baseline_recovery > 0, 1, out_raster['prefire_baseline_recovery_status'].data).squeeze().astype(np.int8)
-    out_raster['prefire_baseline_recovery_time'].data[:] = np.where(baseline_recovery == 127, 0, out_raster['prefire_baseline_recovery_status'].data).squeeze().astype(np.int8)
-    
+
+    # Update merged tile (just this window) with this fire's data, overwriting data from older fires, if necessary
+    row_off, col_off = int(window.row_off - tile.row_off), int(window.col_off - tile.col_off)
+    out_window = (slice(row_off, row_off + int(window.height)), slice(col_off, col_off + int(window.width)))
+    out = {band_name: arr[out_window] for band_name, arr in out.items()} # views into the tile arrays
+
+    out['matched_recovery_time'][:] = np.where(matched_recovery > 0, matched_recovery, out['matched_recovery_time'])
+    out['matched_recovery_status'][:] = np.where(matched_recovery > 0, 1, out['matched_recovery_status'])
+    out['matched_recovery_status'][:] = np.where(matched_recovery == 127, 0, out['matched_recovery_status'])
+
+    out['prefire_baseline_recovery_time'][:] = np.where(baseline_recovery > 0, baseline_recovery, out['prefire_baseline_recovery_time'])
+    out['prefire_baseline_recovery_status'][:] = np.where(baseline_recovery > 0, 1, out['prefire_baseline_recovery_status'])
+    out['prefire_baseline_recovery_status'][:] = np.where(baseline_recovery == 127, 0, out['prefire_baseline_recovery_status'])
+
     recovery_available_mask = (matched_recovery > 0) | (baseline_recovery > 0)
-    out_raster['vegetation_type'].data[:] = np.where(recovery_available_mask, vegetation_tif, out_raster['vegetation_type'].data).squeeze().astype(np.int8)
-    out_raster['UID_h'].data[:] = np.where(recovery_available_mask, uid // 100, out_raster['UID_h'].data).squeeze().astype(np.int8)
-    out_raster['UID_to'].data[:] = np.where(recovery_available_mask, uid % 100, out_raster['UID_to'].data).squeeze().astype(np.int8)
-    out_raster['severity'].data[:] = np.where(recovery_available_mask, severity_tif, out_raster['severity'].data).squeeze().astype(np.int8)
-    out_raster['fire_yr'].data[:] = np.where(recovery_available_mask, fire_yr-1982, out_raster['fire_yr'].data).squeeze().astype(np.int8)
-    out_raster['burn_bndy_dist'].data[:] = np.where(recovery_available_mask, distance_km_tif, out_raster['burn_bndy_dist'].data).squeeze().astype(np.int8)
-    
+    out['vegetation_type'][:] = np.where(recovery_available_mask, vegetation_arr, out['vegetation_type'])
+    if 'UID' in out: # single uint16 UID band
+        out['UID'][:] = np.where(recovery_available_mask, uid, out['UID'])
+    else:
+        out['UID_h'][:] = np.where(recovery_available_mask, uid // 100, out['UID_h'])
+        out['UID_to'][:] = np.where(recovery_available_mask, uid % 100, out['UID_to'])
+    out['severity'][:] = np.where(recovery_available_mask, severity_arr, out['severity'])
+    out['fire_yr'][:] = np.where(recovery_available_mask, fire_yr-1982, out['fire_yr'])
+    out['burn_bndy_dist'][:] = np.where(recovery_available_mask, distance_arr, out['burn_bndy_dist'])
+
     # Memory management
-    del severity_tif, vegetation_tif, distance_km_tif, recovery_tif, matched_recovery, baseline_recovery
+    del severity_arr, vegetation_arr, distance_arr, matched_recovery, baseline_recovery, out
     gc.collect()
 
-    return out_raster
\ No newline at end of file
+    return True
+
+
+def merge_tile(tile, fires, perfire_config, grid, band_info, vegetation_type_dict, overview_factors):
+    '''
+    Merge all fires overlapping this tile (oldest to newest, so the newest fire wins) into in-memory tile arrays.
+    Runs in a worker process; returns (tile, {band name: array}, {band name: {factor: overview array}}) for the parent to write.
+    '''
+    out = {
+        band_name: np.full((int(tile.height), int(tile.width)), info['nodata'], dtype=info['dtype'])
+        for band_name, info in band_info.items()
+    }
+    for uid, fireid, fire_window in fires:
+        add_fire_out_raster(perfire_config, uid, fireid, out, tile, fire_window, grid, vegetation_type_dict)
+
+    return tile, out, make_tile_overviews(out, band_info, overview_factors)
@@ -1,68 +1,106 @@
+import numpy as np
+
 nodata_value=-128
+overview_factors=[2, 4, 8, 16, 32] # overview levels in the merged COGs (merge tile size must be a multiple of the largest)
 
 # Define band information for output merged tif
 band_info = {
     'matched_recovery_time': {
-        'description': f'Recovery time (recovery in seasons; nodata={nodata_value}, never recovered=-1)',
+        'description': f'Recovery time (recovery in seasons; nodata={nodata_value}, never recovered=127)',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'average',
+        'overview_sentinel': 127, # never recovered: left out of overview means (a block is 127 only if all its data is 127)
         'units': 'seasons'
     },
     'matched_recovery_status': {
         'description': f'Recovery status (never recovered=0, recovered=1, nodata={nodata_value})',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'prefire_baseline_recovery_time': {
-        'description': f'Recovery time (recovery in seasons; nodata={nodata_value}, never recovered=-1)',
+        'description': f'Recovery time (recovery in seasons; nodata={nodata_value}, never recovered=127)',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'average',
+        'overview_sentinel': 127, # never recovered: left out of overview means (a block is 127 only if all its data is 127)
         'units': 'seasons'
     },
     'prefire_baseline_recovery_status': {
         'description': f'Recovery status (never recovered=0, recovered=1, nodata={nodata_value})',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'vegetation_type': {
         'description': 'Vegetation type; according to vegetation_type_dict exported.',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'UID_h': {
         'description': 'UID thousands/hundreds digit (e.g. for UID=812, UID_h=8; for UID=1127, UID_h=11)',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'UID_to': {
         'description': 'UID tens and ones digit (e.g. for UID=812, UID_to=12)',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'fire_yr': {
         'description': 'Fire year, counting from 1982. EX: fire_year=0 is for 1982; fire_year=5 is for 1987; ',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'years since 1982'
     },
     'severity': {
         'description': 'Fire severity',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     },
     'burn_bndy_dist': {
         'description': 'Distance, in hundreds of meters, from the burn boundary. Distance is reported rounded to the nearest 100 meters (ceiling). Distances >12,700m are reported as 127.',
         'nodata': nodata_value,
         'dtype': np.int8,
+        'overview_resampling': 'average',
+        'units': 'dimensionless'
+    }
+}
+
+# Single UID band (optional, replaces UID_h/UID_to); uids start at 1, so 0 is nodata
+uid_nodata_value=0
+uid_band_info = {
+    'UID': {
+        'description': f'Fire UID (see merged_UID_lookup.csv; nodata={uid_nodata_value})',
+        'nodata': uid_nodata_value,
+        'dtype': np.uint16,
+        'overview_resampling': 'mode',
         'units': 'dimensionless'
     }
 }
 
+
+def get_band_info(single_uid_band=False):
+    # band_info with UID_h/UID_to replaced by one uint16 UID band (in the same position), if single_uid_band
+    if not single_uid_band: return band_info
+    merged_band_info = {}
+    for band_name, info in band_info.items():
+        if band_name == 'UID_h': merged_band_info.update(uid_band_info)
+        elif band_name != 'UID_to': merged_band_info[band_name] = info
+    return merged_band_info
+
+
 band_names = list(band_info.keys())
 encoding = {'_FillValue': nodata_value, 'dtype': 'int8'}
\ No newline at end of file
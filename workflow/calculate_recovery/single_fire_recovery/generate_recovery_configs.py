@@ -82,6 +82,7 @@ def get_file_paths(config, ROI_PATH, fireinfo):
         'OUT_SUMMARY_CSV': f'{maps_fire_dir}{prefix}_time_series_summary_df.csv',
         'RECOVERY_COUNTS_SUMMARY_CSV': f'{maps_fire_dir}{prefix}_grouping_counts_recovery_summary.csv',
         'PLOTS_DIR': get_path(f'{config['RECOVERY_PARAMS']['RECOVERY_PLOTS_DIR']}{prefix}/', ROI_PATH),
+        'OUT_BURN_BNDY_DIST_TIF': f'{maps_fire_dir}spatialinfo/{prefix}_burn_bndy_dist.tif',
         'BASELAYERS': {
             'severity': next(iter(glob.glob(get_path(f'{config['RECOVERY_PARAMS']['RECOVERY_MAPS_DIR']}{prefix}/spatialinfo/*_burnsev.tif', ROI_PATH))), None),
             'agdev_mask': get_path(config['BASELAYERS']['agdev_mask']['fname'], ROI_PATH),
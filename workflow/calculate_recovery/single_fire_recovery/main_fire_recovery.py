@@ -8,7 +8,7 @@ from qa_checks import temporal_coverage_check
 from recovery_calculator import calculate_ndvi_thresholds, calculate_recovery_time, single_fire_recoverytime_summary
 
 sys.path.append("workflow/utils")
-from geo_utils import clip_raster_to_poly, export_to_tiff
+from geo_utils import clip_raster_to_poly, export_to_tiff, export_burnbndy_dist, get_burnbndy_dist_path
 
 sys.path.append("workflow/calculate_recovery/make_plots")
 from recovery_plots import plot_time_series, plot_random_sampled_pt
@@ -70,6 +70,12 @@ if __name__ == '__main__':
 
         sys.exit(1)
 
+    #### BURN BOUNDARY DISTANCE ####
+    # calculated once per fire on the severity raster's grid (independent of recovery params), reused by the merge
+    burnbndy_dist_f = file_paths.get('OUT_BURN_BNDY_DIST_TIF', get_burnbndy_dist_path(file_paths['BASELAYERS']['severity']))
+    if not os.path.exists(burnbndy_dist_f):
+        export_burnbndy_dist(file_paths['BASELAYERS']['severity'], burnbndy_dist_f)
+
     #### GENERATE ALL PARAMS FOR SENSITIVITY ANALYSIS ####
     all_param_combos = [] # create a list of dictionaries with all param values combos + the assocated file suffix
 
@@ -2,7 +2,7 @@ import rioxarray as rxr
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-import os, gc
+import os, sys, gc
 import rasterio
 from rasterio import sample
 from shapely.geometry import Point
@@ -11,6 +11,9 @@ import tempfile
 from merge_predictor_layers_info import *
 from merge_predictor_layers_helper import *
 
+sys.path.append('workflow/utils/')
+from geo_utils import open_merged_uid
+
 
 #### MERGE/ALIGN EXISTING ####
 
@@ -23,11 +26,7 @@ recovery_status = open_var('recovery_status')
 topo = rxr.open_rasterio(topo_f)
 fire_yr = open_var('fire_yr')
 fire_yr.data[:] = 1982+fire_yr.data
-uid = open_var('UID_h').astype('int16')
-uid_to = open_var('UID_to')
-uid.data[:] = (100*uid.data) + uid_to.data
-del uid_to
-gc.collect()
+uid = open_merged_uid(var_path('UID')) # single UID band, or UID_h/UID_to recombined (nodata=0)
 
 recovery_time, topo = reproj_align_rasters('reproj_match', recovery_time, topo)
 # Extract base data
@@ -36,12 +36,14 @@ burnarea_proj_f = '/u/project/eordway/shared/surp_cd/fire_recovery/data/baselaye
 avg_annual_pr_f = '/u/project/eordway/shared/surp_cd/timeseries_data/data/GRIDMET/pr_clipped_sum_alltimeavg_wateryr_sum.nc'
 
 # merged variables
-def open_var(variable, test=TESTING):
+def var_path(variable, test=TESTING):
     if TESTING:
-        path = f'/u/project/eordway/shared/surp_cd/timeseries_data/data/fullCArecovery_shap/testing/merged_{variable}_200_300.tif'
+        return f'/u/project/eordway/shared/surp_cd/timeseries_data/data/fullCArecovery_shap/testing/merged_{variable}_200_300.tif'
     else: 
-        path = f'/u/project/eordway/shared/surp_cd/timeseries_data/data/fullCArecovery_shap2/merged_{variable}.tif'
-    return rxr.open_rasterio(path).isel(band=0)
+        return f'/u/project/eordway/shared/surp_cd/timeseries_data/data/fullCArecovery_shap2/merged_{variable}.tif'
+
+def open_var(variable, test=TESTING):
+    return rxr.open_rasterio(var_path(variable, test)).isel(band=0)
 
 # topo
 topo_f = '/u/project/eordway/shared/surp_cd/fire_recovery/data/california/baselayers/merged/topo.nc'
@@ -1,38 +1,31 @@
 import subprocess, sys, os, glob, gc
-import zipfile
+import shutil
 import numpy as np
 import geopandas as gpd
 import xarray as xr
 import pyproj
 
 sys.path.append("workflow/utils")
-from geo_utils import get_crs, calculate_bbox, format_roi, clip_tif
-from file_utils import confirm_checksum
+from geo_utils import get_crs, calculate_bbox, format_roi, clip_tifs
+from file_utils import confirm_checksum, stream_download, walk_zip
 
 def download_landfire(prod_name, prod_link, prod_checksum, download_dir):
-    # Download .zip file
-    downloaded_zip = download_zip(prod_name, prod_link, prod_checksum, download_dir)
+    # Download .zip file, calculating its checksum as it downloads
+    downloaded_zip, download_checksum = download_zip(prod_name, prod_link, download_dir)
 
     # Confirm checksum
-    confirm_checksum(downloaded_zip, prod_checksum)
+    confirm_checksum(downloaded_zip, prod_checksum, download_checksum)
 
-    # Unzip, delete original .zip files
-    unzip_dir = unzip(prod_name, download_dir, downloaded_zip)
-    subprocess.run(['rm', downloaded_zip])
+    # Save metadata, straight from the zip (nothing else is unzipped)
+    save_metadata(downloaded_zip, download_dir, metadata_dir)
 
-    # Save metadata
-    save_metadata(download_dir, metadata_dir)
+    return downloaded_zip
 
-    return unzip_dir
 
-
-def clip_landfire(unzip_dir, download_dir, ROI):
-    print(f'Unzip dir: {unzip_dir}\nDownload dir: {download_dir}')
-    unzip_tif_dirs = [os.path.join(unzip_dir, 'Tif'), os.path.join(download_dir, '**', '**', 'Tif')]
-    print(unzip_tif_dirs)
-    all_tifs = []
-    for unzip_tif_dir in unzip_tif_dirs:
-        all_tifs += glob.glob(f'{unzip_tif_dir}/*.tif')
+def clip_landfire(downloaded_zip, download_dir, ROI, n_processes=1):
+    print(f'Downloaded zip: {downloaded_zip}\nDownload dir: {download_dir}')
+    # Tifs are read (and clipped) from inside the zip, and any zips nested in it
+    all_tifs = [vsi_path for vsi_path, name, _ in walk_zip(downloaded_zip) if is_tif_dir_member(name) and name.endswith('.tif')]
     print(all_tifs)
     all_crs = [get_crs(tif) for tif in all_tifs]
     crs_uniq = list(set(all_crs))
@@ -47,85 +40,53 @@ def clip_landfire(unzip_dir, download_dir, ROI):
     clip_dir = f'{download_dir}clipped/'
     os.makedirs(clip_dir, exist_ok=True)
     
-    # Clip all tifs
-    for tif, crs in zip(all_tifs, all_crs):
-        clip_tif(clip_dir, tif, *bbox_by_crs[crs])
+    # Clip all tifs (n_processes at a time)
+    clip_tifs(clip_dir, [(tif, bbox_by_crs[crs]) for tif, crs in zip(all_tifs, all_crs)], n_processes)
 
     # Remove unclipped data
-    print(f'Deleting {unzip_dir}', flush=True)
-    subprocess.run(['rm', '-r', unzip_dir])
+    print(f'Deleting {downloaded_zip}', flush=True)
+    os.remove(downloaded_zip)
 
     pass
 
 
 ### HELPER FNS ###
-def download_zip(prod_name:str, prod_link:str, prod_checksum:str, download_dir:str):
+def download_zip(prod_name:str, prod_link:str, download_dir:str):
     print(f'About to download {prod_name} at link {prod_link} to {download_dir}', flush=True)
-    try:
-        os.makedirs(download_dir, exist_ok=True)
-        subprocess.run(['wget', '-q', '-P', download_dir, prod_link])
-        print(f'Downloaded {prod_link} to {download_dir}.')
-    except subprocess.CalledProcessError as e:
-        print(f'Failed to download {prod_name}: {e}', flush=True)
-        print(e.stderr, flush=True)
-
-    if '/' != download_dir[-1]: download_dir += '/'
-    downloaded_f = glob.glob(f'{download_dir}{prod_link.split('/')[-1]}')[0]
+    downloaded_f, download_checksum = stream_download(prod_link, download_dir)
     print(f'Successfully downloaded file {downloaded_f}', flush=True)
-    return downloaded_f
-    
-
-def unzip(prod_name:str, download_dir:str, f:str):
-    print(f'About to unzip {prod_name} at {f}', flush=True)
-    try:
-        subprocess.run(['unzip', f, '-d', download_dir])
+    return downloaded_f, download_checksum
 
-        # Get name of unzipped dir to unzip 1 level down
-        with zipfile.ZipFile(f, 'r') as zip_ref:
-            new_dir = zip_ref.namelist()[0].split('/')[0]
-        new_path = os.path.join(download_dir, new_dir)
-        subprocess.run(['unzip', f'{new_path}/*.zip', '-d', new_path])
-    
-    except subprocess.CalledProcessError as e:
-        print(f'Failed to unzip {prod_name}: {e}', flush=True)
-        print(e.stderr, flush=True)
 
-    print(f'Successfully unzipped file {f}', flush=True)
-    return new_path
+def is_tif_dir_member(name:str)->bool:
+    # zip member in a Tif/ folder
+    return (len(name.split('/')) > 1) and (name.split('/')[-2] == 'Tif')
 
 
-def save_metadata(download_dir:str, metadata_dir:str):
+def save_metadata(downloaded_zip:str, download_dir:str, metadata_dir:str):
+    '''
+    Extract LANDFIRE metadata from the downloaded zip (and zips nested in it):
+        General_Metadata/*.xml, CSV_Data/*.csv -> metadata_dir
+        Tif/*.tif.* (e.g. RAT .vat.dbf, .aux.xml; not overviews), Tif/*.tfw -> {download_dir}clipped/
+    '''
     os.makedirs(metadata_dir, exist_ok=True)
     clip_dir = f'{download_dir}clipped/'
     os.makedirs(clip_dir, exist_ok=True)
 
-    def find_dir(base_dir, folder_name):
-        matches = glob.glob(f'{base_dir}**/{folder_name}/', recursive=True)
-        return matches if matches else None
-
-    # Find metadata, csv, tif directories
-    metadata_source_l = find_dir(download_dir, 'General_Metadata')
-    csv_source_l = find_dir(download_dir, 'CSV_Data') 
-    tif_source_l = find_dir(download_dir, 'Tif')
-
-    if metadata_source_l:
-        for metadata_source in metadata_source_l:
-            print(f'Metadata source: {metadata_source}')
-            os.system(f'cp {metadata_source}*.xml {metadata_dir}')
-    else: print(f'No .xml metadata found in {download_dir}')
-
-    if csv_source_l:
-        for csv_source in csv_source_l:
-            print(f'csv source: {csv_source}')
-            os.system(f'cp {csv_source}*.csv {metadata_dir}')
-    else: print(f'No .csv metadata found in {download_dir}')
-
-    if tif_source_l:
-        for tif_source in tif_source_l:
-            print(f'tif source: {tif_source}')
-            os.system(f'cp {tif_source}*.tif.* {clip_dir}')
-            os.system(f'cp {tif_source}*.tfw {clip_dir}')
-    else: print(f'No tif data found in {download_dir}')
+    n_saved = 0
+    for _, name, zip_file in walk_zip(downloaded_zip):
+        folder, fname = (name.split('/')[-2] if '/' in name else ''), name.split('/')[-1]
+        if (folder == 'General_Metadata') and fname.endswith('.xml'): out_dir = metadata_dir
+        elif (folder == 'CSV_Data') and fname.endswith('.csv'): out_dir = metadata_dir
+        elif is_tif_dir_member(name) and (('.tif.' in fname and not fname.endswith('.ovr')) or fname.endswith('.tfw')): out_dir = clip_dir
+        else: continue
+
+        print(f'Saving {name} to {out_dir}')
+        with zip_file.open(name) as src, open(os.path.join(out_dir, fname), 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        n_saved += 1
+
+    if n_saved == 0: print(f'No metadata found in {downloaded_zip}')
 
     pass
 
@@ -139,7 +100,8 @@ if __name__ == '__main__':
     metadata_dir = sys.argv[5]
     ROI = sys.argv[6]
     done_flag = sys.argv[7]
+    n_processes = int(sys.argv[8])
 
-    unzip_dir = download_landfire(prod_name, prod_link, prod_checksum, download_dir)
-    clip_landfire(unzip_dir, download_dir, ROI)
+    downloaded_zip = download_landfire(prod_name, prod_link, prod_checksum, download_dir)
+    clip_landfire(downloaded_zip, download_dir, ROI, n_processes)
     subprocess.run(['touch', done_flag])
\ No newline at end of file
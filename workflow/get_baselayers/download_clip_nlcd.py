@@ -1,72 +1,125 @@
-import subprocess, os, glob, sys
+import subprocess, os, glob, sys, threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import pandas as pd
 import rioxarray as rxr
 import xml.etree.ElementTree as ET
 
 sys.path.append("workflow/utils")
 from geo_utils import get_crs, calculate_bbox, format_roi, clip_tif
+from file_utils import stream_download, walk_zip
 
 '''
 python workflow/get_baselayers/download_clip_nlcd.py https://www.mrlc.gov/downloads/sciweb1/shared/mrlc/data-bundles/Annual_NLCD_LndCov_YEAR_CU_C1V1.zip data/baselayers/temp/NLCD/ 1990 1991 data/ROI/california.shp
 '''
 
-def download_clip_nlcd(f, out_dir, ROI):
-    # download data to out_dir
-    downloaded_f = download_nlcd(f, out_dir)
-    
-    # unzip downloaded data, clip to ROI
-    unzip_clip(downloaded_f, out_dir, ROI)
+def download_clip_nlcd_years(download_link, out_dir, vegcodes_csv, years, ROI, n_downloads=1, n_processes=1):
+    '''
+    Download (n_downloads threads) and clip (n_processes worker processes) each year of NLCD: years are clipped as soon as
+    their download finishes. Downloads wait for a zip slot, so at most n_downloads + n_processes CONUS zips are ever on disk
+    (a slot frees up once its year is clipped and its zip deleted). Years that already have a state file
+    (see get_year_state_f) are skipped, so reruns resume. The per-year veg codes/names mappings are merged into vegcodes_csv at the end.
+    '''
+    todo_years = [yr for yr in years if not os.path.exists(get_year_state_f(out_dir, yr))]
+    print(f'{len(years) - len(todo_years)}/{len(years)} NLCD years already done; processing {todo_years}', flush=True)
+
+    zip_slots = threading.BoundedSemaphore(n_downloads + n_processes)
+    failed_years = []
+    with ThreadPoolExecutor(max_workers=n_downloads) as downloader, ProcessPoolExecutor(max_workers=n_processes) as clipper:
+        downloads = {downloader.submit(download_nlcd_zip_slot, zip_slots, download_link.replace('YEAR', str(yr)), out_dir): yr for yr in todo_years}
+        clips = {}
+        for future in as_completed(downloads):
+            # a failed download has already released its slot: record it and keep clipping the others (so their slots free up too)
+            try:
+                downloaded_f = future.result()
+            except Exception as e:
+                print(f'WARNING: Failed to download NLCD {downloads[future]}. Error message:\n{e}', flush=True)
+                failed_years.append(downloads[future])
+                continue
+            clip = clipper.submit(clip_nlcd_year, downloaded_f, out_dir, ROI, downloads[future])
+            clip.add_done_callback(lambda _: zip_slots.release()) # (also if the clip fails, so later downloads never deadlock)
+            clips[clip] = downloads[future]
+        for future in as_completed(clips):
+            try:
+                print(f'Finished NLCD {future.result()}', flush=True)
+            except Exception as e:
+                print(f'WARNING: Failed to clip NLCD {clips[future]}. Error message:\n{e}', flush=True)
+                failed_years.append(clips[future])
+
+    if len(failed_years) > 0:
+        raise RuntimeError(f'Failed to download/clip NLCD years {sorted(failed_years)}; rerun to retry just those years.')
+
+    # save veg codes/names mapping for all years
+    os.makedirs(os.path.dirname(vegcodes_csv), exist_ok=True)
+    pd.concat([pd.read_csv(get_year_state_f(out_dir, yr)) for yr in years]).to_csv(vegcodes_csv)
+
+    return vegcodes_csv
+
+
+def get_year_state_f(out_dir, year):
+    # the year's veg codes/names csv, written once the year is clipped; its existence marks the year as done
+    return os.path.join(out_dir, 'vegcodes_by_year', f'nlcd_vegcodes_{year}.csv')
 
-    # get df of veg codes, names mapping
+
+def clip_nlcd_year(downloaded_f, out_dir, ROI, year):
+    # clip to ROI, reading the tif from inside the zip
+    clip_nlcd(downloaded_f, out_dir, ROI)
+
+    # get df of veg codes, names mapping -> save as the year's state file
     year_df = get_code_vegname_df(downloaded_f)
+    year_df['year'] = year
+    state_f = get_year_state_f(out_dir, year)
+    os.makedirs(os.path.dirname(state_f), exist_ok=True)
+    year_df.to_csv(f'{state_f}.tmp', index=False)
+    os.replace(f'{state_f}.tmp', state_f)
+
+    # Remove unclipped data
+    print(f'Deleting zip file {downloaded_f}', flush=True)
+    os.remove(downloaded_f)
+
+    return year
+
+def download_nlcd_zip_slot(zip_slots, f, out_dir):
+    # wait for a free zip slot before downloading; the slot is released once the year's zip is clipped (or if the download fails)
+    zip_slots.acquire()
+    try:
+        return download_nlcd(f, out_dir)
+    except Exception:
+        zip_slots.release()
+        raise
 
-    return year_df
 
 def download_nlcd(f, out_dir):
     print(f'About to download {f} to {out_dir}', flush=True)
-    try:
-        os.makedirs(out_dir, exist_ok=True)
-        subprocess.run(['wget', '-q', '-P', out_dir, f])
-        print(f'Downloaded {f} to {out_dir}.')
-    except subprocess.CalledProcessError as e:
-        print(f'Failed to download {f}: {e}', flush=True)
-        print(e.stderr, flush=True)
-
-    if out_dir[-1] != '/': out_dir += '/'
-    suffix=f.split('/')[-1]
-    downloaded_f = glob.glob(f'{out_dir}{suffix}')[0]
-    print(f'Successfully downloaded file {downloaded_f}', flush=True)
+    downloaded_f, download_checksum = stream_download(f, out_dir)
+    print(f'Successfully downloaded file {downloaded_f} (md5 {download_checksum})', flush=True)
     return downloaded_f
 
 
-def unzip_clip(f, out_dir, ROI):
-    print(f'About to unzip {f} to {out_dir}', flush=True)
-    try:
-        subprocess.run(['unzip', f, '-d', out_dir])
-    except subprocess.CalledProcessError as e:
-        print(f'Failed to unzip {f}: {e}', flush=True)
-        print(e.stderr, flush=True)
-    
-    print(f'About to clip {f} to {ROI}.', flush=True)
-    tif = f.replace('.zip', '.tif')
+def find_zip_member(zip_f, suffix):
+    # (/vsizip/ path, member name) of the first file in zip_f ending with suffix
+    for vsi_path, name, _ in walk_zip(zip_f):
+        if name.endswith(suffix): return vsi_path, name
+    raise FileNotFoundError(f'No *{suffix} in {zip_f}')
+
+
+def clip_nlcd(f, out_dir, ROI):
+    # the tif is read through /vsizip/, so the CONUS raster is never unzipped to disk
+    tif, _ = find_zip_member(f, '.tif')
+    print(f'About to clip {tif} to {ROI}.', flush=True)
     crs = get_crs(tif)
 
-    bbox_by_crs = {}
     ROI = format_roi(ROI)
     bbox = calculate_bbox(ROI, crs)
     
     clip_tif(out_dir, tif, *bbox)
-
-    # Remove unclipped data
-    print(f'Deleting zip file {f} and unclipped tif {tif}', flush=True)
-    subprocess.run(['rm', '-r', f])
-    subprocess.run(['rm', '-r', tif])
     
 def get_code_vegname_df(downloaded_f):
-    # open, parse xml
-    pam = downloaded_f.replace('.zip', '.tif.aux.xml')
+    # open, parse xml (read from inside the zip)
+    _, pam = find_zip_member(downloaded_f, '.tif.aux.xml')
     print(f'Reading {pam}')
-    tree = ET.parse(pam)
+    with zipfile.ZipFile(downloaded_f) as zip_file, zip_file.open(pam) as pam_f:
+        tree = ET.parse(pam_f)
     root=tree.getroot()
 
     # extract veg codes and corresponding names
@@ -95,19 +148,11 @@ if __name__ == '__main__':
     ROI=sys.argv[6]
     done_flag=sys.argv[7]
 
-    # download/clip each year
-    # keep track of veg codes/names mapping for all processed years
-    df_list = []
-    for yr in range(start_year, end_year+1):
-        df = download_clip_nlcd(download_link.replace('YEAR', str(yr)), out_dir, ROI)
-        df['year'] = yr
-        df_list.append(df)
+    n_downloads=int(sys.argv[8])
+    n_processes=int(sys.argv[9])
 
-    # save veg codes/names mapping for all years
-    os.makedirs(os.path.dirname(vegcodes_csv), exist_ok=True)
-    pd.concat(df_list).to_csv(vegcodes_csv)
+    # download/clip all years, keeping track of veg codes/names mapping for all processed years
+    download_clip_nlcd_years(download_link, out_dir, vegcodes_csv, list(range(start_year, end_year+1)), ROI, n_downloads, n_processes)
 
     # done flag
     subprocess.run(['touch', done_flag])
-
-
@@ -1,75 +1,127 @@
 import pandas as pd
-import xarray as xr
-import rioxarray as rxr
 import numpy as np
-import sys, subprocess, os, gc
+import rasterio as rio
+from rasterio.windows import Window
+import sys, subprocess, os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 sys.path.append("workflow/utils")
-from geo_utils import get_crs, get_gdalinfo, calculate_bbox, format_roi, export_to_tiff
-from file_utils import confirm_checksum
+from geo_utils import get_crs, get_gdalinfo, calculate_bbox, format_roi, get_clip_window, get_windows
+from file_utils import confirm_checksum, stream_download
+
+RAP_ORDERED_BANDS = ['annual_forb_grass', 'bare_ground', 'litter', 'perennial_forb_grass', 'shrub', 'tree']
+RAP_NODATA = -128 # int8 nodata, for source nodata vals that don't fit in int8
+RAP_WINDOW_SIZE = 2048 # pixels per side of each window read at a time
+
+
+def download_rap_years(prod_link, checksum_filename_ref, years, ROI, out_dir, n_threads=1, verify_checksum=False):
+    '''
+    Download the ROI window of each year of RAP, n_threads years at a time (reads are network-bound).
+    Returns the years that failed (each failure is printed as a warning, as before).
+    '''
+    # Make sure we just have mainland CA
+    ROI = format_roi(ROI)
+    ref_csv = pd.read_csv(checksum_filename_ref)
+    os.makedirs(out_dir, exist_ok=True)
+
+    failed_years = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {executor.submit(download_rap_year, prod_link, ref_csv, year, ROI, out_dir, verify_checksum): year for year in years}
+        for future in as_completed(futures):
+            try:
+                print(f'Downloaded {futures[future]} RAP data to {future.result()}.', flush=True)
+            except Exception as e:
+                print(f'WARNING: Failed to download {futures[future]} RAP data. Error message:\n{e}', flush=True)
+                failed_years.append(futures[future])
+
+    download_tmp_dir = os.path.join(out_dir, 'download_tmp')
+    if os.path.isdir(download_tmp_dir) and not os.listdir(download_tmp_dir): os.rmdir(download_tmp_dir)
+
+    return failed_years
+
+
+def download_rap_year(prod_link, ref_csv, curr_year, ROI, out_dir, verify_checksum=False):
+    '''
+    Read just the ROI window of curr_year's RAP file, writing it (int8, LZW, with band names) in one pass.
+    The window is read remotely, unless verify_checksum: then the whole file is streamed once (its md5 calculated
+    as it downloads, and checked against checksum_filename_ref), windowed from the local copy, and deleted.
+    '''
+    # get checksum, filename for current year
+    checksum, f = ref_csv[ref_csv['year']==int(curr_year)][['checksum', 'file_name']].values[0]
+    out_f = out_dir + f
+    f = prod_link + str(f)
+
+    downloaded_f = None
+    if verify_checksum:
+        downloaded_f, download_checksum = stream_download(f, os.path.join(out_dir, 'download_tmp'))
+        confirm_checksum(downloaded_f, checksum, download_checksum)
+        f = downloaded_f
+
+    # get bbox window for download
+    target_crs = get_crs(f)
+    minx, miny, maxx, maxy = calculate_bbox(ROI, target_crs)
+
+    # get nodata val for original data
+    gdalinfo_dict = get_gdalinfo(f)
+    nodataval = np.unique([gdalinfo_dict[band]['nodata'] for band in gdalinfo_dict.keys()])
+    if len(nodataval) > 1:
+        print(f'WARNING: Found multiple nodatavals for different band: {nodataval}. Moving forward with 0th nodataval')
+    nodataval = nodataval[0]
+
+    print(f'About to download {f}.', flush=True)
+    write_rap_window(f, out_f, minx, miny, maxx, maxy, nodataval)
+
+    if downloaded_f is not None: os.remove(downloaded_f)
+    return out_f
+
+
+def write_rap_window(f, out_f, minx, miny, maxx, maxy, nodataval):
+    # copy the bbox window of f to out_f window by window, as int8 (clamped, as gdal_translate -ot Int8 did) with band names
+    out_nodata = nodataval if np.iinfo(np.int8).min <= nodataval <= np.iinfo(np.int8).max else RAP_NODATA
+    tmp_f = f'{out_f}.tmp' # write then rename, so a failed year never leaves a partial file
+
+    with rio.open(f) as src:
+        clip_window = get_clip_window(src, minx, miny, maxx, maxy)
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'int8',
+            'nodata': out_nodata,
+            'count': src.count,
+            'crs': src.crs,
+            'transform': src.window_transform(clip_window),
+            'width': int(clip_window.width),
+            'height': int(clip_window.height),
+            'tiled': True,
+            'blockxsize': 512,
+            'blockysize': 512,
+            'compress': 'lzw'
+        }
+        with rio.open(tmp_f, 'w', **profile) as dst:
+            dst.descriptions = tuple(RAP_ORDERED_BANDS[:src.count])
+            for window in get_windows(profile['height'], profile['width'], RAP_WINDOW_SIZE):
+                src_window = Window(clip_window.col_off + window.col_off, clip_window.row_off + window.row_off, window.width, window.height)
+                data = src.read(window=src_window)
+                out_data = np.clip(data, np.iinfo(np.int8).min, np.iinfo(np.int8).max).astype('int8')
+                out_data[data == nodataval] = out_nodata
+                dst.write(out_data, window=window)
+
+    os.replace(tmp_f, out_f)
+    return out_f
+
 
 if __name__ == '__main__':
     print(f'Running download_rap.py with arguments {'\n'.join(sys.argv)}\n')
     prod_link = sys.argv[1]
     checksum_filename_ref = sys.argv[2]
-    curr_year = sys.argv[3]
-    ROI = sys.argv[4]
-    out_dir = sys.argv[5]
-    out_done_f = sys.argv[6]
-
-    # Download curr_year of RAP
-    try:
-        # Make sure we just have mainland CA
-        ROI = format_roi(ROI)
-
-        # get checksum, filename for current year
-        ref_csv = pd.read_csv(checksum_filename_ref)
-        checksum, f = ref_csv[ref_csv['year']==int(curr_year)][['checksum', 'file_name']].values[0]
-        os.makedirs(out_dir, exist_ok=True)
-        out_f = out_dir + f
-        f = prod_link + str(f)
-
-        # get bbox window for download
-        target_crs = get_crs(f)
-        minx, miny, maxx, maxy = calculate_bbox(ROI, target_crs)
-
-        # get nodata val for original data
-        print(f'About to get gdalinfo for {f}', flush=True)
-        gdalinfo_dict = get_gdalinfo(f)
-        nodataval = np.unique([gdalinfo_dict[band]['nodata'] for band in gdalinfo_dict.keys()])
-        if len(nodataval) > 1:
-            print(f'WARNING: Found multiple nodatavals for different band: {nodataval}. Moving forward with 0th nodataval')
-        nodataval = nodataval[0]
-        
-        # download just desired window
-        print(f'About to download {f}.', flush=True)
-        cmd = [
-            'gdal_translate',
-            '-co', 'compress=lzw',
-            '-ot', 'Int8',
-            f,
-            '-projwin', minx, maxy, maxx, miny, 
-            '-a_nodata', nodataval,
-             out_f
-        ]
-        cmd = [str(i) for i in cmd]
-        subprocess.run(cmd)
-        print(f'Downloaded {f}.', flush=True)
-
-        # add band names
-        rap_ds = rxr.open_rasterio(out_f)
-
-        # Update band names and re-save
-        rap_ordered_bands = ['annual_forb_grass', 'bare_ground', 'litter', 'perennial_forb_grass', 'shrub', 'tree']
-        rap_ds['band'] = rap_ordered_bands 
-        rap_ds.rio.to_raster(
-            out_f,
-            dtype='int8', 
-            compress='LZW'
-        )
-
-        # Create output done file
-        subprocess.run(['touch', out_done_f])
-
-    except Exception as e:
-        print(f'WARNING: Failed to download {curr_year} RAP data. Error message:\n{e}')
\ No newline at end of file
+    start_year, end_year = int(sys.argv[3]), int(sys.argv[4])
+    ROI = sys.argv[5]
+    out_dir = sys.argv[6]
+    out_done_f = sys.argv[7]
+    n_threads = int(sys.argv[8])
+    verify_checksum = sys.argv[9].lower() == 'true'
+
+    # Download all years of RAP
+    failed_years = download_rap_years(prod_link, checksum_filename_ref, range(start_year, end_year+1), ROI, out_dir, n_threads, verify_checksum)
+
+    # Create output done file
+    if len(failed_years) == 0: subprocess.run(['touch', out_done_f])
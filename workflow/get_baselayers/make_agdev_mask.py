@@ -3,95 +3,93 @@ import pandas as pd
 import numpy as np
 import xarray as xr
 import rioxarray as rxr
+import rasterio as rio
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append("workflow/utils")
-from geo_utils import reproj_align_rasters
+from geo_utils import get_raster_grid, aligned_reader, get_windows, map_bounded
 
-def update_agdev_mask(r, rat, agdev_mask_combined, dtype_out):
+AGDEV_WINDOW_SIZE = 2048 # pixels per side of each window processed at a time
+
+
+def build_agdev_lut(rat):
+    '''
+    Given a RAT with NLCD codes/names for one year, returns a lookup table (indexed by NLCD value) that is
+    1 for agricultural/development codes and 0 otherwise.
+    '''
+    ag_dev_values = rat['NLCD_CODE'][rat['NLCD_NAMES'].str.lower().str.contains('agricult|develop|crop|pasture|cultiv')].values
+    lut = np.zeros(int(rat['NLCD_CODE'].max()) + 1, dtype=np.uint8)
+    lut[ag_dev_values] = 1
+    return lut
+
+
+def update_agdev_mask(agdev_mask, nlcd_arr, lut):
     '''
-    Given an EVT raster r and a RAT file with corresponding veg codes, returns an np 2d array
-    representing an agricultural/development mask for the raster r.
+    OR one year's agricultural/development pixels into agdev_mask (in place).
     0: unmasked values, not known to be ag or dev
     1: masked values, ag or dev
     '''
-    
-    # make np array with 1s for agdev, 0 for non-agdev
-    ag_dev_values = rat['NLCD_CODE'][rat['NLCD_NAMES'].str.lower().str.contains('agricult|develop|crop|pasture|cultiv')].values
-    ag_dev_mask = np.where(np.isin(r.data.squeeze(), ag_dev_values), 1, 0).astype(dtype_out)
-    
-    # create new mask if none exists
-    if agdev_mask_combined is None:
-        agdev_mask_combined = ag_dev_mask
-
-    # update existing mask        
-    else:
-        agdev_mask_combined = np.nanmax(
-            np.array(
-                [agdev_mask_combined, ag_dev_mask]
-                ).astype(dtype_out), 
-            axis=0
-            ).squeeze()
-        
-    # memory management
-    del ag_dev_mask, ag_dev_values
-    gc.collect()
-    
-    return agdev_mask_combined
+    valid = (nlcd_arr >= 0) & (nlcd_arr < len(lut))
+    agdev_mask[valid] |= lut[nlcd_arr[valid]]
+    return agdev_mask
+
+
+def process_agdev_window(window, all_nlcd_tifs, luts, grid):
+    # agdev mask for one window, from every NLCD year (aligned to the template grid on the fly). Runs in a worker process.
+    agdev_mask = np.zeros((int(window.height), int(window.width)), dtype=np.uint8)
+    for f, lut in zip(all_nlcd_tifs, luts):
+        with rio.open(f) as src, aligned_reader(src, grid) as reader:
+            update_agdev_mask(agdev_mask, reader.read(1, window=window), lut)
 
-def create_agdev_mask(nlcd_dir, vegcodes_csv, merged_out_path, dtype_out):
+    return window, agdev_mask
+
+
+def create_agdev_mask(nlcd_dir, vegcodes_csv, merged_out_path, dtype_out, n_processes=1, window_size=AGDEV_WINDOW_SIZE):
     # glob
     all_nlcd_tifs = glob.glob(os.path.join(nlcd_dir,'*_clipped.tif'))
     template_tif = all_nlcd_tifs[0]
+    grid = get_raster_grid(template_tif)
 
-    # open agdev rasters + NLCD code/name mapping
-    template_r = rxr.open_rasterio(template_tif)
+    # NLCD code/name mapping -> agdev lookup table for each year
     vegcodes_df = pd.read_csv(vegcodes_csv)
     vegcodes_df['NLCD_CODE']=vegcodes_df['NLCD_CODE'].astype('int')
     vegcodes_df['year']=vegcodes_df['year'].astype('int')
-
-    # update agdev mask with each year's agdev info
-    agdev_mask_combined = None
+    luts = []
     for f in all_nlcd_tifs:
-        print(f'Adding information from {f} to agrdev mask.')
-        # get vegcodes for current year
         curr_yr = int(os.path.basename(f).split('_')[3])
-        vegcodes_yr = vegcodes_df[vegcodes_df['year']==curr_yr]
-
-        # reproj align
-        r = rxr.open_rasterio(f)
-        _, r = reproj_align_rasters('reproj_match', template_r, r)
-
-        # update mask
-        agdev_mask_combined = update_agdev_mask(r, vegcodes_yr, agdev_mask_combined, dtype_out)
-
-        # memory management
-        del r, vegcodes_yr
-        gc.collect()
+        luts.append(build_agdev_lut(vegcodes_df[vegcodes_df['year']==curr_yr]))
+        print(f'Built agrdev lookup table for {f}.', flush=True)
+
+    # build each window's mask from all years in parallel; write each window as it finishes (only this process writes)
+    profile = {
+        'driver': 'GTiff',
+        'dtype': dtype_out,
+        'count': 1,
+        'crs': grid['crs'],
+        'transform': grid['transform'],
+        'width': grid['width'],
+        'height': grid['height'],
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'lzw'
+    }
+    windows = get_windows(grid['height'], grid['width'], window_size)
+    print(f'Processing {len(windows)} windows with {n_processes} processes', flush=True)
+    # (at most 2 windows per process in flight, so finished windows never pile up here)
+    with rio.open(merged_out_path, 'w', **profile) as dst, ProcessPoolExecutor(max_workers=n_processes) as executor:
+        args_list = [(window, all_nlcd_tifs, luts, grid) for window in windows]
+        for i, (window, agdev_mask) in enumerate(map_bounded(executor, process_agdev_window, args_list, 2*n_processes), start=1):
+            dst.write(agdev_mask.astype(dtype_out), 1, window=window)
+            del agdev_mask
+            if (i % 10 == 0) or (i == len(windows)): print(f'{i}/{len(windows)} windows saved', flush=True)
 
-        print(f'Finished adding information from {f} to agrdev mask.')
-
-    print(agdev_mask_combined)
-    print('--------')
-    print(template_r.coords, template_r.dims, template_r.rio.crs)
-
-    # create merge rxr da
-    agdev_mask_da = xr.DataArray(
-        np.array([agdev_mask_combined.squeeze()]),
-        coords=template_r.coords,
-        dims=template_r.dims
-    ).rio.write_crs(template_r.rio.crs)
-
-    # memory management
-    del agdev_mask_combined
-    gc.collect()
-
-    # save output
-    agdev_mask_da.rio.to_raster(merged_out_path, dtype=dtype_out)
-    
     # save printout to summary txt file
+    agdev_mask_da = rxr.open_rasterio(merged_out_path)
+    print(agdev_mask_da)
     with open(merged_out_path.replace('.tif', '_summary.txt'), 'w') as f:
         print(agdev_mask_da, file=f)
-
+    agdev_mask_da.close()
 
 
 if __name__ == "__main__":
@@ -101,7 +99,8 @@ if __name__ == "__main__":
     merged_out_path = sys.argv[3]
     dtype_out = sys.argv[4]
     done_flag = sys.argv[5]
+    n_processes = int(sys.argv[6])
     
-    create_agdev_mask(nlcd_dir, vegcodes_csv, merged_out_path, dtype_out)
+    create_agdev_mask(nlcd_dir, vegcodes_csv, merged_out_path, dtype_out, n_processes=n_processes)
     
     subprocess.run(['touch', done_flag])
\ No newline at end of file
@@ -3,10 +3,17 @@ import pandas as pd
 import numpy as np
 import xarray as xr
 import rioxarray as rxr
+import rasterio as rio
+import netCDF4
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append("workflow/utils")
-from geo_utils import reproj_align_rasters
+from geo_utils import reproj_align_rasters, export_to_tiff, get_raster_grid, aligned_reader, get_windows, write_nc_grid, map_bounded
+
+GROUPINGS_WINDOW_SIZE = 2048 # pixels per side of each window reclassified at a time
+GROUPINGS_CHUNK_SIZE = 512 # pixels per side of each netcdf chunk (one year per chunk)
+GROUPINGS_VAR = '__xarray_dataarray_variable__' # variable name readers of the groupings .nc expect
 
 '''
 input:
@@ -25,23 +32,41 @@ new csv with groupings code; 0 reserved for groupings we don't care about (ignor
 .txt file with rxr summary
 '''
 
-def make_singleyear_groupings(nlcd_tif, elev_groupings_tif, nlcd_yr_csv, output_csv, nodataval):
-    # starts with np array initialized with maskvals -> fills in for each NLCD value x elev grouping
-    out_data = np.full(nlcd_tif.data.shape, nodataval)
+def build_groupings_lut(nlcd_yr_csv, output_csv, nodataval, output_dtype):
+    '''
+    Lookup table from a combined (NLCD value, elev band) key to grouping code, for one NLCD year:
+        key = nlcd_val * n_elev_bands + (elev_band - elev_min)
+    Keys for groupings we don't care about are nodataval.
+    '''
+    elev_min = int(output_csv['ELEV_BAND'].min()) if len(output_csv) > 0 else 0
+    n_elev_bands = int(output_csv['ELEV_BAND'].max()) - elev_min + 1 if len(output_csv) > 0 else 1
+
+    lut = np.full((int(nlcd_yr_csv['NLCD_CODE'].max()) + 1) * n_elev_bands, nodataval, dtype=output_dtype)
     for _, row in output_csv.iterrows():
-        group_code = int(row['id'])
-        nlcd_name = row['NLCD_NAME']
-        nlcd_val = int(nlcd_yr_csv['NLCD_CODE'][nlcd_yr_csv['NLCD_NAMES'] == nlcd_name].iloc[0])
-        elev_band = int(row['ELEV_BAND'])
-        
-        out_data = np.where(
-            (nlcd_tif.data==nlcd_val) & (elev_groupings_tif.data==elev_band),
-            group_code,
-            out_data
-            )
-    
-    # return copy of nlcd_tif with new data
-    return nlcd_tif.copy(data=out_data)
+        nlcd_val = int(nlcd_yr_csv['NLCD_CODE'][nlcd_yr_csv['NLCD_NAMES'] == row['NLCD_NAME']].iloc[0])
+        lut[nlcd_val * n_elev_bands + int(row['ELEV_BAND']) - elev_min] = int(row['id'])
+
+    return lut, elev_min, n_elev_bands
+
+
+def make_singleyear_groupings(nlcd_arr, elev_arr, lut, elev_min, n_elev_bands, nodataval):
+    # one gather through the lookup table; pixels with NLCD values/elev bands outside the table are nodataval
+    nlcd_arr, elev_idx = nlcd_arr.astype(np.int64), elev_arr.astype(np.int64) - elev_min
+    keys = nlcd_arr * n_elev_bands + elev_idx
+    valid = (nlcd_arr >= 0) & (elev_idx >= 0) & (elev_idx < n_elev_bands) & (keys < len(lut))
+
+    out_data = np.full(nlcd_arr.shape, nodataval, dtype=lut.dtype)
+    out_data[valid] = lut[keys[valid]]
+    return out_data
+
+
+def process_groupings_window(t, window, nlcd_tif, elev_tif, grid, lut, elev_min, n_elev_bands, nodataval):
+    # one year's groupings for one window (NLCD aligned to the template grid on the fly). Runs in a worker process.
+    with rio.open(nlcd_tif) as src, aligned_reader(src, grid) as reader, rio.open(elev_tif) as elev_src:
+        nlcd_arr = reader.read(1, window=window)
+        elev_arr = elev_src.read(1, window=window)
+
+    return t, window, make_singleyear_groupings(nlcd_arr, elev_arr, lut, elev_min, n_elev_bands, nodataval)
 
 
 def get_elev_groupings(template_tif, merged_topo, elevation_band_m):
@@ -92,11 +117,45 @@ def get_groupings_csv(nlcd_csv, elev_rxr, elevation_band_m):
     return output_csv, output_dtype, nodataval
 
 
-def make_allyr_groupings(elevation_band_m, nlcd_dir, nlcd_csv, groupings_csv, merged_topo, output_f):
-    # open inputs
-    all_tifs = glob.glob(os.path.join(nlcd_dir, '*_clipped.tif'))
+def create_groupings_nc(out_f, grid, years, output_dtype, nodataval, chunk_size):
+    '''
+    Create the (empty) groupings netcdf on disk with dims (band, time, y, x), chunked by (1, 1, chunk_size, chunk_size),
+    in the layout xarray/rioxarray wrote it before (so readers select band=0, then a time).
+    '''
+    dates = [np.datetime64('-'.join([str(year), '12', '31']), 'D') for year in years]
+
+    if os.path.exists(out_f): os.remove(out_f)
+    with netCDF4.Dataset(out_f, 'w', format='NETCDF4') as nc:
+        nc.createDimension('band', 1)
+        band_var = nc.createVariable('band', 'i8', ('band',))
+        band_var[:] = [1]
+
+        nc.createDimension('time', len(dates))
+        time_var = nc.createVariable('time', 'i8', ('time',))
+        time_var.units = 'days since 1970-01-01'
+        time_var.calendar = 'proleptic_gregorian'
+        time_var[:] = np.array(dates).astype('int64')
+
+        write_nc_grid(nc, grid)
+
+        data_var = nc.createVariable(
+            GROUPINGS_VAR, np.dtype(output_dtype), ('band', 'time', 'y', 'x'),
+            fill_value=np.array(nodataval, dtype=output_dtype),
+            chunksizes=(1, 1, min(chunk_size, grid['height']), min(chunk_size, grid['width'])),
+            zlib=True,
+            complevel=4
+        )
+        data_var.grid_mapping = 'spatial_ref'
+
+    return out_f
+
+
+def make_allyr_groupings(elevation_band_m, nlcd_dir, nlcd_csv, groupings_csv, merged_topo, output_f, n_processes=1, window_size=GROUPINGS_WINDOW_SIZE):
+    # open inputs; NLCD years in chronological order
+    all_tifs = sorted(glob.glob(os.path.join(nlcd_dir, '*_clipped.tif')), key=lambda f: int(os.path.basename(f).split('_')[3]))
     nlcd_csv = pd.read_csv(nlcd_csv)
     template_tif = rxr.open_rasterio(all_tifs[0])
+    grid = get_raster_grid(all_tifs[0])
 
     # Open, align elevation to template tif -> convert to elev bands groupings
     elev_rxr = get_elev_groupings(template_tif, merged_topo, elevation_band_m)
@@ -105,37 +164,41 @@ def make_allyr_groupings(elevation_band_m, nlcd_dir, nlcd_csv, groupings_csv, me
     output_csv, output_dtype, nodataval = get_groupings_csv(nlcd_csv, elev_rxr, elevation_band_m)
     output_csv.to_csv(groupings_csv)
 
-    # Get groupings layer for each year
-    yr_layers = []
-    for tif_f in all_tifs:
-        # align to original tif, extract this year's data
-        _, tif = reproj_align_rasters('reproj_match', template_tif, rxr.open_rasterio(tif_f))
-        
-        # get this year's original NLCD csv + format year as np datetime
-        year = int(os.path.basename(tif_f).split('_')[3])
-        nlcd_yr_csv = nlcd_csv[nlcd_csv['year'] == year]
-        curr_date = np.datetime64('-'.join([str(year), '12', '31']), 'ns')
-
-        # get this year's grouping layer, add date dim, dtype info]
-        yr_layer = make_singleyear_groupings(tif, elev_rxr, nlcd_yr_csv, output_csv, nodataval)
-        yr_layers.append(
-            yr_layer
-            .expand_dims(time=[curr_date])
-            .transpose('band', 'time', 'y','x')
-            .fillna(nodataval)
-            .rio.set_nodata(nodataval)
-            .astype(output_dtype)
-        )
+    # Save elev bands on the template grid, so each worker reads only its window
+    elev_tif = output_f.replace('.nc', '_elev_bands_tmp.tif')
+    export_to_tiff(elev_rxr, elev_tif, 'int8', nodata=-128)
+    del elev_rxr, template_tif
+    gc.collect()
 
-    # merge all tifs along band dim and save
-    merged_groupings = xr.concat(yr_layers, dim=('time'))
-    merged_groupings.rio.write_crs(yr_layers[0].rio.crs, inplace=True)
-    merged_groupings.to_netcdf(output_f)
+    # Lookup table for each year's NLCD codes
+    years = [int(os.path.basename(tif_f).split('_')[3]) for tif_f in all_tifs]
+    luts = [build_groupings_lut(nlcd_csv[nlcd_csv['year'] == year], output_csv, nodataval, output_dtype) for year in years]
+
+    # Reclassify each year x window in parallel; write each one as it finishes (only this process writes)
+    create_groupings_nc(output_f, grid, years, output_dtype, nodataval, min(window_size, GROUPINGS_CHUNK_SIZE))
+    windows = get_windows(grid['height'], grid['width'], window_size)
+    print(f'Processing {len(years)} years x {len(windows)} windows with {n_processes} processes', flush=True)
+    # (at most 2 year-windows per process in flight, so finished results never pile up here)
+    args_list = [
+        (t, window, tif_f, elev_tif, grid, *luts[t], nodataval)
+        for t, tif_f in enumerate(all_tifs)
+        for window in windows
+    ]
+    with netCDF4.Dataset(output_f, 'a') as nc, ProcessPoolExecutor(max_workers=n_processes) as executor:
+        for i, (t, window, yr_groupings) in enumerate(map_bounded(executor, process_groupings_window, args_list, 2*n_processes), start=1):
+            row_slice, col_slice = window.toslices()
+            nc[GROUPINGS_VAR][0, t, row_slice, col_slice] = yr_groupings
+            del yr_groupings
+            if (i % 50 == 0) or (i == len(args_list)): print(f'{i}/{len(args_list)} windows saved', flush=True)
+
+    os.remove(elev_tif)
     print(f'Saved to {output_f}', flush=True)
 
     # save printout to summary txt file
+    merged_groupings = xr.open_dataset(output_f, format='NETCDF4', engine='netcdf4')
     with open(output_f.replace('.nc', '_summary.txt'), 'w') as f:
         print(merged_groupings, file=f)
+    merged_groupings.close()
 
     return True
 
@@ -149,7 +212,8 @@ if __name__ == '__main__':
     merged_topo = sys.argv[5]
     output_f = sys.argv[6]
     done_flag = sys.argv[7]
+    n_processes = int(sys.argv[8])
 
-    make_allyr_groupings(elevation_band_m, nlcd_dir, nlcd_vegcodes_csv, groupings_csv, merged_topo, output_f)
+    make_allyr_groupings(elevation_band_m, nlcd_dir, nlcd_vegcodes_csv, groupings_csv, merged_topo, output_f, n_processes=n_processes)
 
     subprocess.run(['touch', done_flag])
\ No newline at end of file
@@ -3,94 +3,164 @@ import xarray as xr
 import rioxarray as rxr
 import numpy as np
 import geopandas as gpd
+import pandas as pd
+import rasterio as rio
+import netCDF4
 import sys, os, gc
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append("workflow/utils")
-from geo_utils import get_crs, reproj_align_rasters
+from geo_utils import get_raster_grid, aligned_reader, get_windows, write_nc_grid, map_bounded
 
-def make_hdist(dist_dir, out_f, NO_DIST_VAL=0, dtype_out='int8', xdim='x', ydim='y', timedim='time', valid_yrs=range(1999,2024)):
+SEVERITY_CODES = {'Low': 1, 'Medium': 2, 'High': 3} # RAT SEVERITY -> disturbance classification
+DIST_WINDOW_SIZE = 2048 # pixels per side of each window processed at a time
+DIST_CHUNK_SIZE = 512 # pixels per side of each netcdf chunk (all years in one chunk)
+
+def make_hdist(dist_dir, out_f, NO_DIST_VAL=0, dtype_out='int8', xdim='x', ydim='y', timedim='time', valid_yrs=range(1999,2024), n_processes=1, window_size=DIST_WINDOW_SIZE):
     '''Returns:
-    an rxr object with dims (time, y, x)
+    a netcdf with dims (time, y, x)
         bands = 
             annual disturbance with 1, 2, 3 for low, med, high severity disturbance
             cumulative annual disturbance summed over previous years
+    The netcdf is created empty (chunked on disk), then filled window by window: each window's annual and cumulative
+    disturbance is calculated independently (in parallel, across n_processes), so memory is bounded by the window size.
     '''
     
     # Get all the dist/hdist rasters
     all_dist_paths = list_dist_tifs(dist_dir)
 
-    # Create output raster (filled with NO_DIST_VALs to start) to fill with annual disturbance severity info
-    template_rxr, annual_dist_da = create_dist_template(all_dist_paths, NO_DIST_VAL, valid_yrs)
-    
-    # For each Dist tif, extract all known annual disturbances and update our output dist raster
+    # Output grid: the first dist raster's grid
+    grid = get_raster_grid(all_dist_paths[0])
+
+    # For each Dist tif, build lookup tables from raster value to (year, severity) using its RAT
+    dist_luts = []
     for i, f in enumerate(all_dist_paths):
-        # open the current raster layer and associated RAT
-        print(f'Processing file {i+1}/{len(all_dist_paths)}: {os.path.basename(f)}', flush=True)
-        r = rxr.open_rasterio(f)
+        print(f'Reading RAT {i+1}/{len(all_dist_paths)}: {os.path.basename(f)}', flush=True)
         rat = gpd.read_file(f.replace('_clipped.tif', '.tif.vat.dbf'))
         rat.columns = rat.columns.str.upper()
-        
-        # make sure this raster is aligned with the template
-        _, r = reproj_align_rasters('reproj_match', template_rxr, r)
 
         # get the year column in the RAT
         rat_yr_col = rat.columns.values[np.isin(rat.columns.values, ['YEAR', 'HDIST_YR', 'DIST_YEAR', 'CALENDAR_Y'])][0]
-
-        for curr_yr in np.unique(rat[rat_yr_col].dropna()):
-            try:
-                if int(curr_yr) in valid_yrs:
-                    print(f'\tUpdating annual severity layer for {curr_yr}')
-                    curr_date = np.datetime64('-'.join([str(curr_yr), '12', '31']), 'ns')
-
-                    # make a layer with 0-3 disturbance classification (No, Low, Med, High sev) for current year
-                    lowsevvals, medsevvals, highsevvals = [rat['VALUE'][(rat['SEVERITY']==sev) & (rat[rat_yr_col]==curr_yr)].values for sev in ['Low', 'Medium', 'High']]
-                    sev_layer = np.where(np.isin(r, lowsevvals), 1, 0)
-                    sev_layer = np.where(np.isin(r, medsevvals), 2, sev_layer)
-                    sev_layer = np.where(np.isin(r, highsevvals), 3, sev_layer)
-
-                    # for every year represented in this file, update the annual_dist_da "annual_dist" band to have the max of it's previous value and this sev_layer
-                    # print(f'annual dist_da {annual_dist_da}', flush=True)
-                    annual_dist_da.annual_dist.sel(time=curr_date).data[:] = np.nan_to_num(
-                        np.max(
-                            [
-                                annual_dist_da.annual_dist.sel(time=curr_date).data, 
-                                sev_layer.squeeze()
-                            ], 
-                            axis=0),
-                        nan=-128).astype(dtype_out)
-            except:
-                print(f'WARNING: {curr_yr} not a valid year.', flush=True)
-                
-        # memory management
-        del _, r, rat, rat_yr_col, sev_layer
-        gc.collect()
-    
-    # sum up each year's annual cumulative disturbance rasters
-    print(f'Adding cumulative annual disturbance variable', flush=True)
-    annual_dist_da.cumulative_annual_dist.data[:] = annual_dist_da.annual_dist.cumsum(dim=timedim, dtype=dtype_out).astype(dtype_out)
-    
-    print(f'Adding spatial properties, nodata vals', flush=True)
-    annual_dist_da.annual_dist.rio.set_nodata(NO_DIST_VAL, inplace=True)
-    annual_dist_da.cumulative_annual_dist.rio.set_nodata(NO_DIST_VAL, inplace=True)
-    annual_dist_da.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
-    annual_dist_da.rio.write_crs(template_rxr.rio.crs, inplace=True)
-    
-    # save to final output file
-    print(f'Saving annual disturbance, and annual cumulative disturbance to {out_f}', flush=True)
-    annual_dist_da.to_netcdf(out_f, format='NETCDF4', engine='netcdf4')
-    print(f'Successfully saved annual_dist_da\n{annual_dist_da}', flush=True)
+        dist_luts.append(build_dist_lut(rat, rat_yr_col, valid_yrs))
+
+    # Create output netcdf (filled with NO_DIST_VALs to start) to fill with annual disturbance severity info
+    create_dist_nc(out_f, grid, valid_yrs, NO_DIST_VAL, dtype_out, xdim, ydim, timedim, window_size)
+
+    # Calculate annual + cumulative disturbance for each window in parallel; write each window as it finishes (only this process writes)
+    windows = get_windows(grid['height'], grid['width'], window_size)
+    print(f'Processing {len(windows)} windows with {n_processes} processes', flush=True)
+    # (at most 2 windows per process in flight, so finished windows never pile up here)
+    with netCDF4.Dataset(out_f, 'a') as nc, ProcessPoolExecutor(max_workers=n_processes) as executor:
+        args_list = [(window, all_dist_paths, dist_luts, grid, len(valid_yrs), NO_DIST_VAL, dtype_out) for window in windows]
+        for i, (window, annual_dist, cumulative_annual_dist) in enumerate(map_bounded(executor, process_dist_window, args_list, 2*n_processes), start=1):
+            row_slice, col_slice = window.toslices()
+            nc['annual_dist'][:, row_slice, col_slice] = annual_dist
+            nc['cumulative_annual_dist'][:, row_slice, col_slice] = cumulative_annual_dist
+            del annual_dist, cumulative_annual_dist
+            if (i % 10 == 0) or (i == len(windows)): print(f'{i}/{len(windows)} windows saved', flush=True)
 
     # save summary of data structure
+    annual_dist_da = xr.open_dataset(out_f, format='NETCDF4', engine='netcdf4')
+    print(f'Successfully saved annual_dist_da\n{annual_dist_da}', flush=True)
     with open(out_f.replace('.nc', '_summary.txt'), 'w') as f:
         print(annual_dist_da, file=f)
-    
-    # memory management
-    del annual_dist_da
-    gc.collect()
+    annual_dist_da.close()
     
     return True
 
 
+def process_dist_window(window, all_dist_paths, dist_luts, grid, num_yrs, NO_DIST_VAL, dtype_out):
+    '''
+    Annual (max severity of each year) and cumulative (summed over previous years) disturbance for one window,
+    from every dist raster. Runs in a worker process.
+    '''
+    annual_dist = np.full((num_yrs, int(window.height), int(window.width)), NO_DIST_VAL, dtype=dtype_out)
+    for f, (yr_idx_lut, sev_lut) in zip(all_dist_paths, dist_luts):
+        # read just this window (aligned with the output grid), updating the annual_dist layer for every year in the window at once
+        with rio.open(f) as src, aligned_reader(src, grid) as reader:
+            update_annual_dist(annual_dist, reader.read(1, window=window), yr_idx_lut, sev_lut)
+
+    # sum up each year's annual disturbance (along time, within this window)
+    cumulative_annual_dist = annual_dist.cumsum(axis=0, dtype=dtype_out)
+
+    return window, annual_dist, cumulative_annual_dist
+
+
+def create_dist_nc(out_f, grid, valid_yrs, NO_DIST_VAL, dtype_out, xdim, ydim, timedim, window_size):
+    '''
+    Create the (empty) annual_dist/cumulative_annual_dist netcdf on disk, chunked by (all years, window_size, window_size),
+    with the same coords/CRS attributes rioxarray writes (x/y pixel centers, spatial_ref grid mapping).
+    '''
+    dates = [np.datetime64('-'.join([str(yr), '12', '31']), 'D') for yr in valid_yrs]
+    chunk = min(window_size, DIST_CHUNK_SIZE)
+
+    if os.path.exists(out_f): os.remove(out_f)
+    with netCDF4.Dataset(out_f, 'w', format='NETCDF4') as nc:
+        nc.createDimension(timedim, len(dates))
+        time_var = nc.createVariable(timedim, 'i8', (timedim,))
+        time_var.units = 'days since 1970-01-01'
+        time_var.calendar = 'proleptic_gregorian'
+        time_var[:] = np.array(dates).astype('int64')
+
+        write_nc_grid(nc, grid, xdim, ydim)
+
+        for var in ['annual_dist', 'cumulative_annual_dist']:
+            data_var = nc.createVariable(
+                var, np.dtype(dtype_out), (timedim, ydim, xdim),
+                fill_value=np.array(NO_DIST_VAL, dtype=dtype_out),
+                chunksizes=(len(dates), min(chunk, grid['height']), min(chunk, grid['width'])),
+                zlib=True,
+                complevel=4
+            )
+            data_var.grid_mapping = 'spatial_ref'
+
+    print(f'Created empty annual disturbance netcdf {out_f}', flush=True)
+    return out_f
+
+
+def build_dist_lut(rat, rat_yr_col, valid_yrs):
+    '''
+    Build lookup tables (indexed by raster value) from a disturbance RAT:
+        yr_idx_lut: index of the disturbance year in valid_yrs (-1 if not a valid year)
+        sev_lut: 0-3 disturbance classification (No, Low, Med, High sev)
+    '''
+    values = pd.to_numeric(rat['VALUE'], errors='coerce')
+    years = pd.to_numeric(rat[rat_yr_col], errors='coerce')
+    yr_idx = years.map({yr: i for i, yr in enumerate(valid_yrs)})
+    sev = rat['SEVERITY'].map(SEVERITY_CODES)
+
+    skipped_yrs = np.unique(years[years.notna() & yr_idx.isna()])
+    if len(skipped_yrs) > 0: print(f'WARNING: {skipped_yrs} not valid years.', flush=True)
+
+    valid = values.notna() & (values >= 0) & yr_idx.notna() & sev.notna()
+    values, yr_idx, sev = values[valid].astype(int).values, yr_idx[valid].astype(int).values, sev[valid].astype(int).values
+
+    lut_size = (values.max() + 1) if len(values) > 0 else 1
+    yr_idx_lut = np.full(lut_size, -1, dtype=np.int16)
+    sev_lut = np.zeros(lut_size, dtype=np.int8)
+    yr_idx_lut[values] = yr_idx
+    sev_lut[values] = sev
+    print(f'\tDisturbance years in RAT: {sorted({int(valid_yrs[i]) for i in yr_idx})}', flush=True)
+
+    return yr_idx_lut, sev_lut
+
+
+def update_annual_dist(annual_dist, dist_arr, yr_idx_lut, sev_lut):
+    '''
+    Update annual_dist (time, y, x) with the same window of a disturbance raster:
+    each pixel's value is looked up once to get its year and severity, and that year's layer keeps the max severity.
+    '''
+    # pixels with values in the lookup tables
+    rows, cols = np.nonzero((dist_arr >= 0) & (dist_arr < len(sev_lut)))
+    vals = dist_arr[rows, cols]
+    yr_idx, sev = yr_idx_lut[vals], sev_lut[vals]
+
+    # only disturbed pixels in a valid year
+    keep = (yr_idx >= 0) & (sev > 0)
+    yr_idx, rows, cols, sev = yr_idx[keep], rows[keep], cols[keep], sev[keep]
+    annual_dist[yr_idx, rows, cols] = np.maximum(annual_dist[yr_idx, rows, cols], sev)
+
+
 def list_dist_tifs(dist_dir):
     print(dist_dir)
     all_dist_paths = glob.glob(dist_dir+'clipped/*clipped.tif')
@@ -99,29 +169,6 @@ def list_dist_tifs(dist_dir):
     return all_dist_paths
 
 
-def create_dist_template(all_dist_paths, NO_DIST_VAL, valid_yrs):
-    # create a template rxr object for just one year of data
-    template_crs = get_crs(all_dist_paths[0])
-    template_rxr = (
-        rxr.open_rasterio(all_dist_paths[0])
-        .assign_coords(band=["annual_dist"])
-        .rio.set_nodata(NO_DIST_VAL)
-        .rio.write_crs(template_crs)
-    )
-    template_rxr.attrs['_FillValue'] = NO_DIST_VAL
-    template_rxr.data = np.full(template_rxr.data.shape, fill_value=NO_DIST_VAL, dtype=dtype_out)
-
-    # create a template to hold all years disturbance + cumulative disturbance    
-    annual_dist_rxrL = [template_rxr.copy().expand_dims(time=[np.datetime64('-'.join([str(yr), '12', '31']), 'ns')]) for yr in valid_yrs]
-    annual_dist_da = xr.concat(annual_dist_rxrL, dim=timedim).transpose('band', timedim, ydim, xdim).astype(dtype_out)
-    annual_dist_da = xr.Dataset({
-        'annual_dist': annual_dist_da.squeeze(dim='band', drop=True),  # Remove band dimension if present
-        'cumulative_annual_dist': annual_dist_da.squeeze(dim='band', drop=True)
-    }).transpose(timedim, ydim, xdim).astype(dtype_out)
-
-    return template_rxr, annual_dist_da
-
-
 if __name__ == '__main__':
     print(f'Running make_hdist.py with arguments {'\n'.join(sys.argv)}\n')
     annual_dist_dir = sys.argv[1]
@@ -131,7 +178,8 @@ if __name__ == '__main__':
     xdim, ydim, timedim = sys.argv[5], sys.argv[6], sys.argv[7]
     start_year, end_year = int(sys.argv[8]), int(sys.argv[9])
     done_flag = sys.argv[10]
+    n_processes = int(sys.argv[11])
 
-    make_hdist(annual_dist_dir, merged_nc_out_f, NO_DIST_VAL=nodataval, dtype_out=dtype_out, xdim=xdim, ydim=ydim, timedim=timedim, valid_yrs=range(start_year,end_year))
+    make_hdist(annual_dist_dir, merged_nc_out_f, NO_DIST_VAL=int(nodataval), dtype_out=dtype_out, xdim=xdim, ydim=ydim, timedim=timedim, valid_yrs=range(start_year,end_year), n_processes=n_processes)
 
     subprocess.run(['touch', done_flag])
\ No newline at end of file
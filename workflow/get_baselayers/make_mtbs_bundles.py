@@ -4,13 +4,19 @@ import geopandas as gpd
 import subprocess, os, glob, shutil, sys, gc, re
 import rioxarray as rxr
 import xarray as xr
+import rasterio as rio
 from rasterio.features import rasterize
+from affine import Affine
 from multiprocessing import Pool, cpu_count
 from functools import partial
 import pyproj
 
 sys.path.append("workflow/utils")
-from geo_utils import clip_raster_to_poly, export_to_tiff
+from geo_utils import get_clip_window
+from fire_index import build_fire_index, get_fire_index_path
+from wumi_polys import get_wumi_polys_path, build_wumi_polys, read_wumi_polys, WUMI_YEAR_COL
+
+BUNDLE_BATCH_SIZE = 25 # fires (all from the same year) per task; each task opens its year's severity raster once
 
 '''
 takes in 
@@ -25,42 +31,19 @@ takes in
 filters WUMI CSV + merged WUMI polygons to get WUMI fireid's for:
     ROI
     start_year <= fire year <= end_year
+(WUMI polygons are read from a compacted GPKG of all WUMI MTBS polygons, built the first time from the shapefiles: see wumi_polys.py)
 
 
 extracts MTBS sev raster for each subfire (clipped to subfire boundary)
 checks that >90% of pixels in the burn boundary are marked as burned and <10% outside the burn boundary are burned --> assert statement for debugging
+    (both fractions are saved as tags on the clipped severity raster: pct_burned_in_boundary, pct_burned_out_boundary)
 check that subfire poly is not a mulitpolygon --> assert statement for debugging
 
 creates new dir with structure data/recovery_maps/{wumi_firename}_{wumi_fireid}/spatialinfo/ containing shapefiles of fire boundaries and clipped severity rasters
 the severity raster and shapefiles should be called {wumi_firename}_{wumi_fireid}_burnbndy.shp and {wumi_firename}_{wumi_fireid}_sevraster.tif
-'''
-
-def get_wumi_mtbs_poly(
-    wumi_data_dir:str,
-    wumi_projection: pyproj.CRS,
-    fireid_yr: tuple):
-    fireid, year = fireid_yr
-    # search in wumi_data_dir/year for mtbs shapefile
-    wumi_dir = os.path.join(wumi_data_dir, year, fireid)
-    f = glob.glob(os.path.join(wumi_dir, '*_mtbs*.shp'))
-
-    # ensure there's exactly 1 match and it's not a multipolygon, return output path
-    try:
-        # get .shp file
-        assert len(f) == 1, f'Found {len(f)} shapefiles in {os.path.join(wumi_dir, '*_mtbs*.shp')}, when there should be exactly 1. \nExiting.'
-        f = f[0]
-
-        # open shp file
-        gdf = gpd.read_file(f)
-        assert len(gdf)==1, f'{f} is a multipolygon. len({f})!=1. \nExiting.'
-
-        # format columns and set crs
-        gdf.columns = [s.replace('object','').replace('_','') for s in gdf.columns] # shorten column names
-        gdf = gdf.loc[:, ~gdf.columns.duplicated()].set_crs(wumi_projection)
-        return gdf
-    except:
-        return None
 
+builds a spatial index of all fire bundles (burn polygons + buffered bboxes, fire date, chronological index_order) in wumi_summary_output_dir/fire_index.gpkg
+'''
 
 def get_wumi_id_years(
     ROI: str,
@@ -85,73 +68,102 @@ def get_wumi_id_years(
     subfires['name_orig'] = subfires['name']
     subfires['name'] = subfires['name'].map(lambda name: re.sub(r'[^a-zA-Z0-9_-]', '', name))
 
-    # merge all WUMI fires within our year range into one gdf
-    get_wumi_polys_partial = partial(
-        get_wumi_mtbs_poly,
-        wumi_data_dir,
-        wumi_projection
-    )
-    
-    args = list(zip(subfires['fireid'].astype('str'), subfires['year'].astype('str')))
-    with Pool(processes=n_processes) as pool:
-        wumi_polys = pool.map(get_wumi_polys_partial, args)
-
-    merged_wumi = pd.concat(wumi_polys)
+    # read just the WUMI fires in the ROI bbox + year range from the compacted WUMI polygons (compacting them the first time)
+    wumi_polys_f = get_wumi_polys_path(wumi_data_dir)
+    if not os.path.exists(wumi_polys_f):
+        build_wumi_polys(subfires_csv, wumi_data_dir, wumi_projection, wumi_polys_f, n_processes)
 
-    # memory management
-    del wumi_polys
-    gc.collect()
+    ROI = gpd.read_file(ROI).to_crs(wumi_projection)
+    merged_wumi = read_wumi_polys(wumi_polys_f, ROI.total_bounds, start_year, end_year)
+    merged_wumi = merged_wumi[merged_wumi['fireid'].astype(str).isin(subfires['fireid'].astype(str))].drop(columns=WUMI_YEAR_COL)
 
     # clip WUMI gdf to ROI -> save to wumi_summary_output_dir
-    ROI = gpd.read_file(ROI).to_crs(wumi_projection)
     clipped_wumi = merged_wumi.clip(ROI)
     filtered_ids = clipped_wumi['fireid']
     clipped_wumi.to_file(f'{wumi_summary_output_dir}merged_filtered_wumi.shp')
 
+    # filter subfires to only subfires in our clipped WUMI gdf
+    subfires = subfires[subfires['fireid'].isin(filtered_ids)]
+
+    # each fire's (unclipped) WUMI polygon, for its bundle -- so bundles don't re-read the per-fire shapefiles
+    merged_wumi = merged_wumi[merged_wumi['fireid'].astype(str).isin(subfires['fireid'].astype(str))]
+    fire_polys = {fireid: fire_poly for fireid, fire_poly in merged_wumi.groupby(merged_wumi['fireid'].astype(str), sort=False)}
+
     # memory management
     del merged_wumi, clipped_wumi
     gc.collect()
 
-    # filter subfires to only subfires in our clipped WUMI gdf
-    subfires = subfires[subfires['fireid'].isin(filtered_ids)]
-
     # save filtered WUMI metadata csv
     subfires.to_csv(f'{wumi_summary_output_dir}wumi_data.csv')
 
-    return zip(subfires['name'].astype('str'), subfires['fireid'].astype('str'), subfires['year'].astype('str')), len(subfires)
+    return zip(subfires['name'].astype('str'), subfires['fireid'].astype('str'), subfires['year'].astype('str')), len(subfires), fire_polys
 
 
-def confirm_burned(
-    fire_sev_tif:xr.DataArray, 
+def read_fire_severity(
+    src: rio.DatasetReader,
     burn_poly: gpd.GeoDataFrame
-    ) -> bool:
-    # returns True if >90% of pixels in the burn boundary are true MTBS burn values (1<=val<=6) AND all pixels out of the burn boundary are nan
-    
-    # rasterize burn poly
-    burn_poly = burn_poly.to_crs(fire_sev_tif.rio.crs)
-    mask = rasterize(
+    ) -> tuple:
+    '''
+    Windowed read of an (open) annual severity raster over just the burn polygon's bbox. As with clip_raster_to_poly, pixels
+    outside the polygon (by pixel center) are set to the raster's nodata (0 if none), and the result is cropped to the
+    polygon's pixels. Returns (severity array, its transform).
+    '''
+    burn_poly = burn_poly.to_crs(src.crs)
+    window = get_clip_window(src, *burn_poly.total_bounds)
+    sev_data = src.read(1, window=window)
+    transform = src.window_transform(window)
+
+    # rasterize the burn poly on this window only
+    inside = rasterize(
         burn_poly.geometry,
-        out_shape=fire_sev_tif.data.squeeze().shape,
-        transform=fire_sev_tif.rio.transform(),
+        out_shape=sev_data.shape,
+        transform=transform,
+        fill=0,
+        default_value=1,
+        dtype='uint8'
+    ).astype(bool)
+    rows, cols = np.nonzero(inside.any(axis=1))[0], np.nonzero(inside.any(axis=0))[0]
+    assert (len(rows) > 0) and (len(cols) > 0), 'No severity raster pixels found in the burn polygon.'
+
+    sev_data = np.where(inside, sev_data, src.nodata if src.nodata is not None else 0)
+    sev_data = sev_data[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+    transform = transform * Affine.translation(cols[0], rows[0])
+    return sev_data, transform
+
+
+def get_burned_fractions(
+    burn_data: np.ndarray,
+    transform: Affine,
+    crs,
+    burn_poly: gpd.GeoDataFrame
+    ) -> dict:
+    '''
+    Fractions of pixels in/out of the burn boundary (all_touched) that are true MTBS burn values (1<=val<=6).
+    The burn poly is rasterized once into a uint8 window (2 inside, 0 outside), burned pixels add 1,
+    and all 4 classes (out/in x unburned/burned) are counted in one pass.
+    '''
+    burn_poly = burn_poly.to_crs(crs)
+    classes = rasterize(
+        burn_poly.geometry,
+        out_shape=burn_data.shape,
+        transform=transform,
         fill=0, # outside burn boundary
-        default_value=1, # inside burn boundary
+        default_value=2, # inside burn boundary
         dtype='uint8',
         all_touched=True
     )
+    classes += (burn_data>0) & (burn_data<=6)
+    out_unburned, out_burned, in_unburned, in_burned = np.bincount(classes.ravel(), minlength=4)
 
-    # count total pixels, make bool layer of burned pixels 
-    total_burn_pixels, total_unburned_pixels = np.sum(mask), np.sum(mask==0)
-    burn_data = fire_sev_tif.data.squeeze()
-    burn_pixels = (burn_data>0) & (burn_data<=6)
-
-    # count burn pixels in/out fire boundary
-    burn_pixels_in_boundary = burn_pixels & mask
-    burn_pixels_out_boundary = burn_pixels & (mask==0)
+    return {
+        'pct_burned_in_boundary': float(in_burned / (in_burned + in_unburned)),
+        'pct_burned_out_boundary': float(out_burned / (out_burned + out_unburned)) if (out_burned + out_unburned) > 0 else 0.0
+    }
 
-    pct_burned_in_boundary = np.sum(burn_pixels_in_boundary) / np.sum(mask==1)
-    pct_burned_out_boundary = np.sum(burn_pixels_out_boundary) / np.sum(mask)
 
-    # check if >90% burned inside polygon and <10% burned outside 
+def confirm_burned(burned_fractions: dict) -> bool:
+    # returns True if >90% of pixels in the burn boundary are true MTBS burn values AND <10% of pixels out of the burn boundary are
+    pct_burned_in_boundary, pct_burned_out_boundary = burned_fractions['pct_burned_in_boundary'], burned_fractions['pct_burned_out_boundary']
     if (pct_burned_in_boundary > 0.9) and (pct_burned_out_boundary < 0.1):
         return True
     else:
@@ -159,41 +171,39 @@ def confirm_burned(
         return False
 
 
-def make_fire_spatialbundle(args):
+def make_fire_spatialbundle(src, firename, fireid, gdf, output_dir):
+    # src: this fire year's MTBS severity raster, already open; gdf: the fire's WUMI polygon (from the compacted WUMI polygons)
     try:
-        # Function takes in a tuple of args to allow for multiprocessing with multiprocessing.Pool
-        firename, fireid, year, wumi_data_dir, mtbs_sevraster_dir, wumi_projection, output_dir = args
-
-        # locate the relevant MTBS tif file
-        mtbs_sev_tif = glob.glob(os.path.join(mtbs_sevraster_dir, f'*_{year}.tif'))
-        assert len(mtbs_sev_tif) == 1, f'Found {len(mtbs_sev_tif)} tif files in {os.path.join(mtbs_sevraster_dir, str(year))}, when there should be exactly 1. \nExiting.'
-        mtbs_sev_tif = mtbs_sev_tif[0]
-
         # output will be saved to {output_dir}/{firename}_{wumi_fireid}/spatialinfo/
         fire_output_dir = f'{output_dir}/{firename}_{fireid}/spatialinfo/'
         os.makedirs(fire_output_dir, exist_ok=True)
         
-        # copy WUMI MTBS polygon to new dir 
-        # save with CRS info from provided projection
+        # copy WUMI MTBS polygon to new dir (with CRS info from the WUMI projection)
+        assert gdf is not None, f'No WUMI MTBS polygon found for {fireid}.'
         wumi_mtbs_shp_f = os.path.join(fire_output_dir, f'{firename}_{fireid}_wumi_mtbs_poly.shp').replace('//', '/')
-        gdf = get_wumi_mtbs_poly(wumi_data_dir, wumi_projection, (fireid, year))
         gdf.to_file(wumi_mtbs_shp_f)
 
-        # extract sevraster for this polygon and save to {output_dir}/{firename}_{wumi_fireid}/spatialinfo/
-        mtbs_full = rxr.open_rasterio(mtbs_sev_tif)
-        fire_sev_tif = clip_raster_to_poly(rxr_obj=mtbs_full, poly_path=wumi_mtbs_shp_f)
-        del mtbs_full
-        gc.collect()
+        # extract sevraster for this polygon (reading only its window) and save to {output_dir}/{firename}_{wumi_fireid}/spatialinfo/
+        fire_sev_data, fire_sev_transform = read_fire_severity(src, gdf)
 
-        assert confirm_burned(fire_sev_tif, gpd.read_file(wumi_mtbs_shp_f)), f'ERROR: {fire_sev_tif} does not meet the confirm_burned criteria.'
+        burned_fractions = get_burned_fractions(fire_sev_data, fire_sev_transform, src.crs, gdf)
+        assert confirm_burned(burned_fractions), f'ERROR: {firename}_{fireid} does not meet the confirm_burned criteria.'
 
+        fire_sev_tif = os.path.join(fire_output_dir, f'{firename}_{fireid}_burnsev.tif')
         print(f'Successfully extracted {firename}_{fireid}. Saving to {fire_sev_tif}.', flush=True)
-        export_to_tiff(
-            fire_sev_tif, 
-            os.path.join(fire_output_dir, f'{firename}_{fireid}_burnsev.tif'),
-            'int8',
-            -128
-        )
+        with rio.open(
+            fire_sev_tif, 'w',
+            driver='GTiff',
+            height=fire_sev_data.shape[0],
+            width=fire_sev_data.shape[1],
+            count=1,
+            dtype='int8',
+            nodata=-128,
+            crs=src.crs,
+            transform=fire_sev_transform,
+            compress='LZW') as dst:
+            dst.write(fire_sev_data.astype('int8'), 1)
+            dst.update_tags(**burned_fractions) # confirm_burned QA fractions, so they don't need to be recomputed downstream
 
         return f'SUCCESS: {firename}_{fireid}'
     
@@ -203,23 +213,48 @@ def make_fire_spatialbundle(args):
         return error_message
 
 
+def make_year_fire_bundles(args):
+    # Function takes in a tuple of args to allow for multiprocessing with multiprocessing.Pool
+    # all fires in the batch are from the same year, so that year's MTBS tif is opened once for the whole batch
+    year, fires, mtbs_sevraster_dir, output_dir = args
+    try:
+        # locate the relevant MTBS tif file
+        mtbs_sev_tif = glob.glob(os.path.join(mtbs_sevraster_dir, f'*_{year}.tif'))
+        assert len(mtbs_sev_tif) == 1, f'Found {len(mtbs_sev_tif)} tif files in {os.path.join(mtbs_sevraster_dir, str(year))}, when there should be exactly 1. \nExiting.'
+
+        with rio.open(mtbs_sev_tif[0]) as src:
+            return [
+                make_fire_spatialbundle(src, firename, fireid, fire_poly, output_dir)
+                for firename, fireid, fire_poly in fires
+            ]
+
+    except Exception as e:
+        error_messages = [f'ERROR processing {firename}_{fireid}: {e}' for firename, fireid, _ in fires]
+        print('\n'.join(error_messages), flush=True)
+        return error_messages
+
+
 def make_fire_bundles_parallel(
         fireid_years_list: list, 
-        wumi_data_dir: str, 
+        fire_polys: dict, 
         mtbs_sevraster_dir: str, 
-        wumi_projection: pyproj.CRS, 
         output_dir: str,
-        n_processes: int
+        n_processes: int,
+        batch_size: int = BUNDLE_BATCH_SIZE
     ) -> None:
-    # list args for each fire
+    # group fires (with their WUMI polygons, from get_wumi_id_years) by year, in batches of up to batch_size fires (one task each)
+    fires_by_year = {}
+    for firename, fireid, year in fireid_years_list:
+        fires_by_year.setdefault(year, []).append((firename, fireid, fire_polys.get(fireid)))
     args_list = [
-        (firename, fireid, year, wumi_data_dir, mtbs_sevraster_dir, wumi_projection, output_dir)
-        for firename, fireid, year in fireid_years_events
+        (year, fires[i:i+batch_size], mtbs_sevraster_dir, output_dir)
+        for year, fires in fires_by_year.items()
+        for i in range(0, len(fires), batch_size)
     ]
 
-     # process fires in parallel
+     # process batches in parallel
     with Pool(processes=n_processes) as pool:
-        results = pool.map(make_fire_spatialbundle, args_list)
+        results = [r for batch_results in pool.map(make_year_fire_bundles, args_list) for r in batch_results]
     
     # summary
     successes = [r for r in results if r.startswith("SUCCESS")]
@@ -252,7 +287,7 @@ if __name__ == '__main__':
 
     # FILTER -- LIST OF ALL MTBS SUBFIRES IN ROI FOR DESIRED YEARS
     wumi_projection = rxr.open_rasterio(wumi_projection_raster).rio.crs
-    fireid_years_events, total_count = get_wumi_id_years(ROI, subfires_csv, start_year, end_year, wumi_data_dir, wumi_summary_output_dir, wumi_projection, n_processes)
+    fireid_years_events, total_count, fire_polys = get_wumi_id_years(ROI, subfires_csv, start_year, end_year, wumi_data_dir, wumi_summary_output_dir, wumi_projection, n_processes)
     fireid_years_events = list(fireid_years_events)
 
     # SAVE -- CREATE CSV ALL MTBS SUBFIRES IN ROI FOR DESIRED YEARS, CREATE COLS FOR LOGGING DOWNLOAD/RECOVERY
@@ -264,13 +299,19 @@ if __name__ == '__main__':
     # CREATE SPATIAL INFO BUNDLE FOR EACH FIRE TO PROCESS
     make_fire_bundles_parallel(
         fireid_years_events, 
-        wumi_data_dir, 
+        fire_polys, 
         mtbs_sevraster_dir, 
-        wumi_projection,
         output_dir,
         n_processes
     )
 
+    # INDEX FIRE FOOTPRINTS (for window/point/date queries)
+    build_fire_index(
+        output_dir,
+        f'{wumi_summary_output_dir}wumi_data.csv',
+        get_fire_index_path(wumi_summary_output_dir)
+    )
+
     # DONE FLAG
     subprocess.run(['touch', done_flag])
     
@@ -3,46 +3,82 @@ import xarray as xr
 import rioxarray as rxr
 import rasterio as rio
 import numpy as np
+import netCDF4
 import subprocess 
 
 sys.path.append("workflow/utils")
-from geo_utils import reproj_align_rasters
+from geo_utils import get_raster_grid, aligned_reader, get_windows, write_nc_grid
 
-def merge_topo(topo_f_list, out_f):
-    # open topo layers and get band names from file paths
+TOPO_NODATA = -9999
+TOPO_WINDOW_SIZE = 2048 # pixels per side of each window aligned/written at a time
+TOPO_CHUNK_SIZE = 512 # pixels per side of each netcdf chunk (one band per chunk)
+TOPO_VAR = '__xarray_dataarray_variable__' # variable name readers of the topo .nc expect
+
+def merge_topo(topo_f_list, out_f, window_size=TOPO_WINDOW_SIZE):
+    '''
+    Merge the clipped topo layers into one int16 (band, y, x) netcdf (nodata -9999) on the first layer's grid.
+    The netcdf is created empty (chunked, compressed), then each layer is aligned and written window by window,
+    so only one window of one layer is in memory at a time.
+    '''
+    # get topo layers and band names from file paths
     print(f'Opening all topo layers', flush=True)
     topo_f_list = [glob.glob(os.path.join(f,'clipped/*_clipped.tif'))[0] for f in topo_f_list if f!='']
     print(f'Layers are: {'\n'.join(topo_f_list)}', flush=True)
     band_names = [os.path.basename(f).split('_')[1] for f in topo_f_list]
-    topo_rxr_layers = [rxr.open_rasterio(f) for f in topo_f_list]
 
-    # reproject/align all layers
-    print('Reprojecting all layers', flush=True)
-    topo_rxr_layers = reproj_align_rasters('reproj_match', *topo_rxr_layers)
+    # all layers are aligned to the first layer's grid
+    grid = get_raster_grid(topo_f_list[0])
+    create_topo_nc(out_f, grid, band_names, min(window_size, TOPO_CHUNK_SIZE))
 
     print(f'Merging all topo and mask layers --> saving to {out_f}')
-    topo_rxr_layers = [
-        r.assign_coords(band=[band_name])
-        .transpose('band','y','x')
-        .fillna(-9999)
-        .rio.set_nodata(-9999)
-        .astype('int16') 
-        for r, band_name in zip(topo_rxr_layers, band_names)
-        ]
-
-    out_rxr_merged = (
-        xr.concat(topo_rxr_layers, dim=('band'))
-        .rio.write_crs(topo_rxr_layers[0].rio.crs)
-        .rio.set_nodata(-9999))
-    out_rxr_merged.to_netcdf(out_f)
+    windows = get_windows(grid['height'], grid['width'], window_size)
+    with netCDF4.Dataset(out_f, 'a') as nc:
+        for i, f in enumerate(topo_f_list):
+            print(f'Aligning, writing {band_names[i]} ({len(windows)} windows)', flush=True)
+            with rio.open(f) as src, aligned_reader(src, grid) as reader:
+                for window in windows:
+                    row_slice, col_slice = window.toslices()
+                    nc[TOPO_VAR][i, row_slice, col_slice] = to_topo_int16(reader.read(1, window=window), src.nodata)
     print(f'Saved to {out_f}', flush=True)
 
     # save printout to summary txt file
+    out_rxr_merged = xr.open_dataset(out_f, format='NETCDF4', engine='netcdf4')
     with open(out_f.replace('.nc', '_summary.txt'), 'w') as f:
         print(out_rxr_merged, file=f)
+    out_rxr_merged.close()
 
     return True
 
+
+def to_topo_int16(data, src_nodata):
+    # source nodata (and nan) -> TOPO_NODATA, then int16
+    nodata_mask = np.isnan(data) if np.issubdtype(data.dtype, np.floating) else np.zeros(data.shape, dtype=bool)
+    if src_nodata is not None: nodata_mask |= (data == src_nodata)
+    return np.where(nodata_mask, TOPO_NODATA, data).astype('int16')
+
+
+def create_topo_nc(out_f, grid, band_names, chunk_size):
+    # empty (band, y, x) int16 netcdf with band names as the band coord, in the layout xarray/rioxarray wrote it before
+    if os.path.exists(out_f): os.remove(out_f)
+    with netCDF4.Dataset(out_f, 'w', format='NETCDF4') as nc:
+        nc.createDimension('band', len(band_names))
+        band_var = nc.createVariable('band', str, ('band',))
+        for i, band_name in enumerate(band_names):
+            band_var[i] = band_name
+
+        write_nc_grid(nc, grid)
+
+        data_var = nc.createVariable(
+            TOPO_VAR, 'i2', ('band', 'y', 'x'),
+            fill_value=np.int16(TOPO_NODATA),
+            chunksizes=(1, min(chunk_size, grid['height']), min(chunk_size, grid['width'])),
+            zlib=True,
+            complevel=4
+        )
+        data_var.grid_mapping = 'spatial_ref'
+
+    return out_f
+
 if __name__ == '__main__':
     print(f'Running make_topo.py with arguments {'\n'.join(sys.argv)}\n')
     topo_f_list = sys.argv[1:-2]
@@ -9,6 +9,7 @@ DIR_NAME=$5
 METADATA_DIR=$6
 ROI_FILE=$7
 DONE_FLAG=$8
+N_PROCESSES=$9
 
 # Activate venv
 . /u/local/Modules/default/init/modules.sh
@@ -23,4 +24,5 @@ python workflow/get_baselayers/download_clip_landfire.py \
     "$DIR_NAME" \
     "$METADATA_DIR" \
     "$ROI_FILE" \
-    "$DONE_FLAG"
\ No newline at end of file
+    "$DONE_FLAG" \
+    "$N_PROCESSES"
\ No newline at end of file
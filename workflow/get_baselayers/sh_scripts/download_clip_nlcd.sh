@@ -9,6 +9,8 @@ START_YEAR=$5
 END_YEAR=$6
 ROI_FILE=$7
 DONE_FLAG=$8
+N_DOWNLOADS=$9
+N_PROCESSES=${10}
 
 . /u/local/Modules/default/init/modules.sh
 module load anaconda3
@@ -20,4 +22,6 @@ python workflow/get_baselayers/download_clip_nlcd.py \
     "$START_YEAR" \
     "$END_YEAR" \
     "$ROI_FILE" \
-    "$DONE_FLAG"
\ No newline at end of file
+    "$DONE_FLAG" \
+    "$N_DOWNLOADS" \
+    "$N_PROCESSES"
\ No newline at end of file
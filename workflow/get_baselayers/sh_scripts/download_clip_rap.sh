@@ -4,10 +4,13 @@
 CONDA_ENV=$1
 DOWNLOAD_LINK=$2
 CHECKSUM_FILENAME_REF=$3
-CURRENT_YEAR=$4
-ROI_FILE=$5
-OUT_DIR=$6
-DONE_FLAG=$7
+START_YEAR=$4
+END_YEAR=$5
+ROI_FILE=$6
+OUT_DIR=$7
+DONE_FLAG=$8
+N_THREADS=$9
+VERIFY_CHECKSUM=${10}
 
 . /u/local/Modules/default/init/modules.sh
 module load anaconda3
@@ -16,7 +19,10 @@ conda activate $CONDA_ENV
 python workflow/get_baselayers/download_rap.py \
     "$DOWNLOAD_LINK" \
     "$CHECKSUM_FILENAME_REF" \
-    "$CURRENT_YEAR" \
+    "$START_YEAR" \
+    "$END_YEAR" \
     "$ROI_FILE" \
     "$OUT_DIR" \
-    "$DONE_FLAG"
\ No newline at end of file
+    "$DONE_FLAG" \
+    "$N_THREADS" \
+    "$VERIFY_CHECKSUM"
\ No newline at end of file
@@ -7,6 +7,7 @@ VEGCODES_CSV=$3
 MERGED_OUT_PATH=$4
 DTYPE_OUT=$5
 DONE_FLAG=$6
+N_PROCESSES=$7
 
 . /u/local/Modules/default/init/modules.sh
 module load anaconda3
@@ -17,6 +18,7 @@ python workflow/get_baselayers/make_agdev_mask.py \
     "$VEGCODES_CSV" \
     "$MERGED_OUT_PATH" \
     "$DTYPE_OUT" \
-    "$DONE_FLAG"
+    "$DONE_FLAG" \
+    "$N_PROCESSES"
 
 chmod 555 $MERGED_OUT_PATH # make read only
\ No newline at end of file
@@ -9,6 +9,7 @@ GROUPINGS_CSV=$5
 MERGED_TOPO=$6
 OUT_F=$7
 DONE_FLAG=$8
+N_PROCESSES=$9
 
 . /u/local/Modules/default/init/modules.sh
 module load anaconda3
@@ -21,4 +22,5 @@ python workflow/get_baselayers/make_groupings.py \
     "$GROUPINGS_CSV" \
     "$MERGED_TOPO" \
     "$OUT_F" \
-    "$DONE_FLAG"
\ No newline at end of file
+    "$DONE_FLAG" \
+    "$N_PROCESSES"
\ No newline at end of file
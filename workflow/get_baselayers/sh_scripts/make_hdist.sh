@@ -12,6 +12,7 @@ TIMEDIM=$8
 START_YR=$9
 END_YR=${10}
 DONE_FLAG=${11}
+N_PROCESSES=${12}
 
 . /u/local/Modules/default/init/modules.sh
 module load anaconda3
@@ -27,6 +28,7 @@ python workflow/get_baselayers/make_hdist.py \
     "$TIMEDIM" \
     "$START_YR" \
     "$END_YR" \
-    "$DONE_FLAG"
+    "$DONE_FLAG" \
+    "$N_PROCESSES"
 
 chmod 555 $MERGED_OUT_PATH # make read only
\ No newline at end of file
@@ -1,13 +1,56 @@
 import os, sys, subprocess
 import datetime
+import hashlib, zipfile
+import requests
 
-def confirm_checksum(f:str, checksum:str):
-    try:
-        result = subprocess.run(['md5sum', f], capture_output=True, text=True)
-        download_checksum = (result.stdout.split(' ')[0])
-    except subprocess.CalledProcessError as e:
-        print(f'Error calculating check sum: {e}', flush=True)
-        print(e.stderr, flush=True)
+def stream_download(url:str, out_dir:str, chunk_size:int=2**23)->tuple:
+    '''
+    Download url to out_dir in chunks, calculating its MD5 checksum as the chunks arrive (so the file isn't read again to check it).
+    Written to a .part file, then renamed. Returns (downloaded file path, md5 checksum).
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    out_f = os.path.join(out_dir, url.split('/')[-1])
+    tmp_f = f'{out_f}.part'
+
+    md5 = hashlib.md5()
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(tmp_f, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                md5.update(chunk)
+                f.write(chunk)
+    os.replace(tmp_f, out_f)
+
+    return out_f, md5.hexdigest()
+
+
+def walk_zip(zip_f:str):
+    '''
+    Yield (GDAL /vsizip/ path, member name, open ZipFile holding the member) for every file in zip_f, including files in
+    zips nested inside it, without extracting anything. The /vsizip/ paths can be opened directly with rasterio.
+    '''
+    def walk(zip_file, vsi_prefix):
+        for name in zip_file.namelist():
+            if name.endswith('/'): continue
+            if name.lower().endswith('.zip'):
+                with zipfile.ZipFile(zip_file.open(name)) as inner_zip:
+                    yield from walk(inner_zip, f'/vsizip/{{{vsi_prefix}/{name}}}')
+            else:
+                yield f'{vsi_prefix}/{name}', name, zip_file
+
+    with zipfile.ZipFile(zip_f) as zip_file:
+        yield from walk(zip_file, f'/vsizip/{os.path.abspath(zip_f)}')
+
+
+def confirm_checksum(f:str, checksum:str, download_checksum:str=None):
+    # download_checksum: md5 already calculated while downloading f; otherwise, f is read again with md5sum
+    if download_checksum is None:
+        try:
+            result = subprocess.run(['md5sum', f], capture_output=True, text=True)
+            download_checksum = (result.stdout.split(' ')[0])
+        except subprocess.CalledProcessError as e:
+            print(f'Error calculating check sum: {e}', flush=True)
+            print(e.stderr, flush=True)
 
     if download_checksum != checksum:
         sys.exit(f'CHECKSUM ERROR FOR {f}.\nDownload checksum {download_checksum} did not match {checksum}.\nPlease delete {os.path.basename(f)} after inspection.')
@@ -0,0 +1,166 @@
+"""
+Persisted spatial index of fire footprints, built from the make_mtbs_bundles outputs.
+
+The index is a GeoPackage (GPKG layers carry their own sqlite R-tree) with one row per fire bundle and two layers:
+    burn_polys:         the WUMI/MTBS burn polygon for each fire
+    buffered_bboxes:    the bbox around the burn polygon buffered by buffer_distance (same as buffer_firepoly)
+Each row has fireid, name, year, fire_date, index_order and uid:
+    index_order:    the indexed fires numbered 1-N in chronological order (the same order as sort_dirs_by_date);
+                    results are sorted, and reburns ordered, by it
+    uid:            the fire's merged UID, read from the progress CSV's uid column (made by get_ordered_fireUIDs,
+                    so it matches merged_UID_lookup.csv) when given one; 0 (the merged UID nodata) until then
+The statewide merge doesn't use the index (it assigns fires to tiles with its own STRtree).
+
+Use FireIndex to ask which fires touch a window, point or date range without opening every fire's shapefile.
+"""
+
+import os, re, glob
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box, Point
+
+INDEX_CRS = 'EPSG:5070' # CONUS Albers (meters), shared by both layers
+FIRE_INDEX_FNAME = 'fire_index.gpkg'
+FOOTPRINT_LAYERS = {'burn': 'burn_polys', 'buffered': 'buffered_bboxes'}
+NO_UID = 0 # uid for fires without a merged UID (yet); same as the merged UID band's nodata
+
+
+def get_fire_index_path(wumi_summary_output_dir:str)->str:
+    # saved next to wumi_data.csv
+    return os.path.join(wumi_summary_output_dir, FIRE_INDEX_FNAME)
+
+
+def get_fire_date(fireid:str, year)->pd.Timestamp:
+    # fireids end in the fire date (YYYYMMDD); fall back to Jan 1 of the fire year
+    match = re.search(r'(\d{8})$', str(fireid).split('_')[0])
+    if match:
+        return pd.to_datetime(match.group(1), format='%Y%m%d', errors='coerce')
+    return pd.Timestamp(year=int(year), month=1, day=1)
+
+
+def buffered_bbox(poly_gdf:gpd.GeoDataFrame, buffer_distance:float)->gpd.GeoSeries:
+    '''Bbox of one fire polygon buffered by buffer_distance (m) in its UTM zone, in INDEX_CRS.'''
+    poly_utm = poly_gdf.to_crs(poly_gdf.estimate_utm_crs())
+    buffered = poly_utm.geometry.buffer(buffer_distance).to_crs(poly_gdf.crs).envelope
+    return buffered.to_crs(INDEX_CRS).envelope
+
+
+def get_progress_uids(progress_csv:str=None):
+    # fireid -> uid from the progress CSV, if get_ordered_fireUIDs has added its uid column (empty otherwise)
+    if (progress_csv is None) or (not os.path.exists(progress_csv)): return {}
+    progress = pd.read_csv(progress_csv)
+    if 'uid' not in progress.columns: return {}
+    progress = progress.dropna(subset=['uid'])
+    return dict(zip(progress['fireid'].astype(str), progress['uid'].astype(int)))
+
+
+def build_fire_index(
+    bundles_dir:str,
+    wumi_data_csv:str,
+    out_path:str,
+    buffer_distance:float=10000,
+    progress_csv:str=None
+    )->str:
+    '''
+    Build the fire index from each fire's {bundles_dir}/{name}_{fireid}/spatialinfo/ bundle.
+    Only fires with a burn severity raster (i.e. bundles that passed confirm_burned) are indexed.
+    uids come from progress_csv's uid column if it has one (0 for fires without one); rebuild the index with
+    progress_csv once get_ordered_fireUIDs has run to fill them in.
+    '''
+    wumi_data = pd.read_csv(wumi_data_csv)
+    wumi_data['fireid'] = wumi_data['fireid'].astype(str)
+    wumi_data['name'] = wumi_data['name'].astype(str)
+    wumi_data['fire_date'] = [get_fire_date(fireid, year) for fireid, year in zip(wumi_data['fireid'], wumi_data['year'])]
+
+    # chronological (stable, so ties keep csv order), the same as sort_dirs_by_date in the merge
+    wumi_data = wumi_data.sort_values('fire_date', kind='stable').reset_index(drop=True)
+    progress_uids = get_progress_uids(progress_csv)
+
+    rows, burn_polys, bboxes = [], [], []
+    for _, fire in wumi_data.iterrows():
+        spatialinfo_dir = os.path.join(bundles_dir, f'{fire["name"]}_{fire["fireid"]}', 'spatialinfo')
+        poly_f = glob.glob(os.path.join(spatialinfo_dir, '*_wumi_mtbs_poly.shp'))
+        sev_f = glob.glob(os.path.join(spatialinfo_dir, '*_burnsev.tif'))
+        if (len(poly_f) != 1) or (len(sev_f) != 1): continue
+
+        poly_gdf = gpd.read_file(poly_f[0])
+        rows.append({
+            'fireid': fire['fireid'],
+            'name': fire['name'],
+            'year': int(fire['year']),
+            'fire_date': fire['fire_date'],
+            'index_order': len(rows) + 1,
+            'uid': progress_uids.get(fire['fireid'], NO_UID),
+            'bundle_dir': spatialinfo_dir
+        })
+        burn_polys.append(poly_gdf.to_crs(INDEX_CRS).geometry.union_all())
+        bboxes.append(buffered_bbox(poly_gdf, buffer_distance).iloc[0])
+
+    fires = pd.DataFrame(rows, columns=['fireid', 'name', 'year', 'fire_date', 'index_order', 'uid', 'bundle_dir'])
+    if os.path.exists(out_path): os.remove(out_path)
+    gpd.GeoDataFrame(fires, geometry=burn_polys, crs=INDEX_CRS).to_file(out_path, layer=FOOTPRINT_LAYERS['burn'], driver='GPKG')
+    gpd.GeoDataFrame(fires, geometry=bboxes, crs=INDEX_CRS).to_file(out_path, layer=FOOTPRINT_LAYERS['buffered'], driver='GPKG')
+
+    print(f'Indexed {len(fires)}/{len(wumi_data)} fires to {out_path}', flush=True)
+    return out_path
+
+
+class FireIndex:
+    '''
+    Query the fire index. Results are GeoDataFrames (in INDEX_CRS) sorted by index_order, i.e. oldest fire first.
+    footprint='burn' matches on burn polygons, footprint='buffered' on the buffered bboxes.
+    '''
+    def __init__(self, index_path:str):
+        self.index_path = index_path
+        self.layers = {
+            footprint: gpd.read_file(index_path, layer=layer)
+            for footprint, layer in FOOTPRINT_LAYERS.items()
+        }
+        for gdf in self.layers.values():
+            gdf['fire_date'] = pd.to_datetime(gdf['fire_date'])
+            gdf.sindex # build the STRtree once, up front
+
+
+    def filter_dates(self, gdf, start_date=None, end_date=None):
+        mask = np.ones(len(gdf), dtype=bool)
+        if start_date is not None: mask &= (gdf['fire_date'] >= pd.to_datetime(start_date)).values
+        if end_date is not None: mask &= (gdf['fire_date'] <= pd.to_datetime(end_date)).values
+        return gdf[mask]
+
+
+    def query_geometry(self, geom, crs=None, start_date=None, end_date=None, footprint='burn')->gpd.GeoDataFrame:
+        '''Fires whose footprint intersects geom (in crs, default INDEX_CRS) with start_date <= fire date <= end_date.'''
+        gdf = self.layers[footprint]
+        if crs is not None:
+            geom = gpd.GeoSeries([geom], crs=crs).to_crs(INDEX_CRS).iloc[0]
+
+        idxs = gdf.sindex.query(geom, predicate='intersects')
+        return self.filter_dates(gdf.iloc[idxs], start_date, end_date).sort_values('index_order')
+
+
+    def query_window(self, bounds, crs=None, start_date=None, end_date=None, footprint='burn')->gpd.GeoDataFrame:
+        '''Fires touching the window with bounds (minx, miny, maxx, maxy).'''
+        if crs is not None:
+            bounds = gpd.GeoSeries([box(*bounds)], crs=crs).to_crs(INDEX_CRS).total_bounds # reprojected window, as a bbox
+            crs = None
+        return self.query_geometry(box(*bounds), crs, start_date, end_date, footprint)
+
+
+    def query_point(self, x, y, crs=None, start_date=None, end_date=None, footprint='burn')->gpd.GeoDataFrame:
+        '''Fires covering the point (x, y).'''
+        return self.query_geometry(Point(x, y), crs, start_date, end_date, footprint)
+
+
+    def query_dates(self, start_date=None, end_date=None, footprint='burn')->gpd.GeoDataFrame:
+        '''All fires with start_date <= fire date <= end_date.'''
+        return self.filter_dates(self.layers[footprint], start_date, end_date).sort_values('index_order')
+
+
+    def query_reburns(self, fireid:str, footprint='burn')->gpd.GeoDataFrame:
+        '''Later fires whose footprint overlaps this fire's footprint.'''
+        gdf = self.layers[footprint]
+        fire = gdf[gdf['fireid']==str(fireid)].iloc[0]
+        overlapping = self.query_geometry(fire.geometry, footprint=footprint)
+        overlapping = overlapping[overlapping.geometry.intersection(fire.geometry).area > 0]
+        return overlapping[overlapping['index_order'] > fire['index_order']]
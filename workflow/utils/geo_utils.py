@@ -5,16 +5,23 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import pyproj
-import subprocess
 import re
 import os
-import json
 import gc
+import functools
+import contextlib
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from rasterio.enums import Resampling
 from shapely.geometry import box
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from scipy.ndimage import distance_transform_edt
 
 from typing import Union, Tuple
 NumericType = Union[int, float]
 
+CLIP_WINDOW_SIZE = 4096 # pixels per side of each window copied at a time when clipping
+
 def clip_raster_to_poly(
     rxr_obj:xr.DataArray,
     poly_path:str
@@ -163,49 +170,254 @@ def export_to_tiff(
     return out_path
 
 
+def calculate_burnbndy_dist(
+    burned:np.ndarray,
+    pixel_size:NumericType,
+    max_dist:int=127,
+    tile_size:int=2048
+)->np.ndarray:
+    '''
+    Distance from each burned pixel to the nearest unburned pixel, in hundreds of meters (rounded up).
+    Pixels past the edge of the array count as unburned; unburned pixels are 0.
+    NOTE: merged burn_bndy_dist outputs made before this was moved here used ceil(dist*pixel_size*1e-3), i.e. km,
+    despite the band description (hundreds of meters), so their values are ~10x smaller than these.
+
+    The output saturates at max_dist (int8 can't store >127*100m), so the distance transform is bounded:
+    it runs tile by tile on each tile plus a halo of max_dist*100m, and tiles with no unburned pixel in
+    reach are set straight to max_dist.
+    '''
+    halo = int(np.ceil(max_dist * 100 / pixel_size)) + 1
+    burned = np.pad(burned.astype(bool), halo, constant_values=False)
+    height, width = burned.shape[0] - 2*halo, burned.shape[1] - 2*halo
+    distance_100m_arr = np.zeros((height, width), dtype=np.int8)
+
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            tile_h, tile_w = min(tile_size, height - row), min(tile_size, width - col)
+            # tile + halo (offset by the padding)
+            block = burned[row: row + tile_h + 2*halo, col: col + tile_w + 2*halo]
+            if not block[halo: halo + tile_h, halo: halo + tile_w].any(): continue
+            if block.all():
+                distance_100m_arr[row: row + tile_h, col: col + tile_w] = max_dist
+                continue
+
+            distance_arr = distance_transform_edt(block)[halo: halo + tile_h, halo: halo + tile_w]
+            distance_100m_arr[row: row + tile_h, col: col + tile_w] = np.minimum(np.ceil(distance_arr * pixel_size * 10**-2), max_dist)
+
+    return distance_100m_arr
+
+
+def get_burnbndy_dist_path(severity_tif:str)->str:
+    # cached next to the fire's severity raster in its spatialinfo bundle
+    return severity_tif.replace('_burnsev.tif', '_burn_bndy_dist.tif')
+
+
+def export_burnbndy_dist(
+    severity_tif:str,
+    out_path:str,
+    max_dist:int=127
+)->str:
+    '''
+    Calculate burn boundary distance on the severity raster's own (cropped) grid and save it as an int8 tif (nodata -128).
+    Burned pixels are everything inside the clipped burn perimeter: unburned pixels are severity 0 or nodata.
+    '''
+    with rio.open(severity_tif) as src:
+        severity_arr = src.read(1)
+        profile = src.profile.copy()
+        pixel_size = abs(src.res[0])
+        nodata = src.nodata
+
+    burned = severity_arr != 0
+    if nodata is not None: burned &= severity_arr != nodata
+    distance_100m_arr = calculate_burnbndy_dist(burned, pixel_size, max_dist)
+
+    profile.update(driver='GTiff', dtype='int8', nodata=-128, count=1, compress='deflate')
+    tmp_path = f'{out_path}.{os.getpid()}.tmp' # write then rename, so readers (or other merge workers) never see a partial file
+    with rio.open(tmp_path, 'w', **profile) as dst:
+        dst.write(distance_100m_arr, 1)
+    os.replace(tmp_path, out_path)
+
+    print(f'Successfully saved burn boundary distance to {out_path}.', flush=True)
+    return out_path
+
+
+def open_merged_uid(uid_path:str)->xr.DataArray:
+    '''
+    Open fire UIDs from the merged recovery product, in either layout:
+        merged_UID.tif (one uint16 band, nodata=0), or
+        merged_UID_h.tif + merged_UID_to.tif (int8 bands, uid = 100*UID_h + UID_to, nodata=-128)
+    uid_path can be any of these files (names may have a suffix, e.g. merged_UID_h_200_300.tif); the other
+    layout's files are found by name next to it.
+    Returns a uint16 DataArray of UIDs with nodata=0 (UIDs start at 1).
+    '''
+    prefix, suffix = re.match(r'^(.*)_UID(?:_h|_to)?(.*\.tif)$', uid_path).groups()
+    single_f, h_f, to_f = f'{prefix}_UID{suffix}', f'{prefix}_UID_h{suffix}', f'{prefix}_UID_to{suffix}'
+
+    if os.path.exists(single_f):
+        uid = rxr.open_rasterio(single_f).isel(band=0)
+        return uid.astype('uint16').rio.write_nodata(0)
+
+    if os.path.exists(h_f) and os.path.exists(to_f):
+        uid_h = rxr.open_rasterio(h_f).isel(band=0)
+        uid_to_data = rxr.open_rasterio(to_f).isel(band=0).data
+        uid_data = np.where(
+            (uid_h.data != -128) & (uid_to_data != -128),               # where not nodata
+            100*uid_h.data.astype('uint16') + uid_to_data.astype('uint16'), # hundreds place + tens/ones place
+            0).astype('uint16')
+        return uid_h.copy(data=uid_data).rio.write_nodata(0)
+
+    raise FileNotFoundError(f'No merged UID layers found for {uid_path} (looked for {single_f}, or {h_f} and {to_f})')
+
+
+def get_raster_grid(f:str)->dict:
+    # grid (crs, transform, shape) of a raster, without reading its data
+    with rio.open(f) as src:
+        return {
+            'crs': src.crs,
+            'transform': src.transform,
+            'width': src.width,
+            'height': src.height
+        }
+
+
+def aligned_reader(src, grid:dict):
+    # read src directly if it's on the grid; otherwise, warp it to the grid on the fly (nearest, as with reproj_match)
+    if (src.crs == grid['crs']) and (src.transform == grid['transform']) and (src.shape == (grid['height'], grid['width'])):
+        return contextlib.nullcontext(src)
+    return WarpedVRT(
+        src,
+        crs=grid['crs'],
+        transform=grid['transform'],
+        width=grid['width'],
+        height=grid['height'],
+        resampling=Resampling.nearest
+    )
+
+
+def get_windows(height:int, width:int, window_size:int)->list:
+    # window_size x window_size windows covering the grid
+    return [
+        Window(col_off, row_off, min(window_size, width - col_off), min(window_size, height - row_off))
+        for row_off in range(0, height, window_size)
+        for col_off in range(0, width, window_size)
+    ]
+
+
+def map_bounded(executor, fn, args_list, max_in_flight:int):
+    '''
+    Yield fn(*args) for each args in args_list (in completion order), with at most max_in_flight tasks submitted at once.
+    Each future is dropped as soon as its result is yielded, so finished results don't pile up in the caller's process.
+    '''
+    args_iter = iter(args_list)
+    in_flight = set()
+    for args in args_iter:
+        in_flight.add(executor.submit(fn, *args))
+        if len(in_flight) >= max_in_flight: break
+
+    while in_flight:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        # refill before handing back results, so workers stay busy while the caller writes
+        for args in args_iter:
+            in_flight.add(executor.submit(fn, *args))
+            if len(in_flight) >= max_in_flight: break
+        while done:
+            result = done.pop().result()
+            yield result
+            del result
+
+
+def write_nc_grid(nc, grid:dict, xdim:str='x', ydim:str='y'):
+    '''
+    Add the x/y dims and coords (pixel centers) and a spatial_ref grid mapping variable to an open (writable) netCDF4.Dataset,
+    the same as rioxarray writes them. Data variables on the grid should set grid_mapping='spatial_ref'.
+    '''
+    transform = grid['transform']
+    xs = transform.c + transform.a * (np.arange(grid['width']) + 0.5)
+    ys = transform.f + transform.e * (np.arange(grid['height']) + 0.5)
+
+    for dim, coords in [(ydim, ys), (xdim, xs)]:
+        nc.createDimension(dim, len(coords))
+        coord_var = nc.createVariable(dim, 'f8', (dim,))
+        coord_var[:] = coords
+
+    spatial_ref = nc.createVariable('spatial_ref', 'i8')
+    spatial_ref.crs_wkt = grid['crs'].to_wkt()
+    spatial_ref.spatial_ref = grid['crs'].to_wkt()
+    spatial_ref.GeoTransform = ' '.join(str(v) for v in transform.to_gdal())
+
+
+def get_raster_metadata(f:str)->dict:
+    '''
+    CRS, grid and per-band info for a raster (tif, .nc, or any GDAL path, e.g. /vsicurl/), read in-process with rasterio.
+    Cached per path + modification time (remote paths: per path), so repeated calls don't reopen the file.
+    Returns:
+        crs (pyproj.CRS or None), transform, width, height, count,
+        bands: list of {'band', 'dtype' (GDAL type name, e.g. 'Int16'), 'nodata', 'name'},
+        subdatasets: list of subdataset paths (e.g. each variable of a .nc)
+    '''
+    mtime = os.stat(f).st_mtime_ns if os.path.exists(f) else None
+    return _read_raster_metadata(f, mtime)
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_raster_metadata(f:str, mtime)->dict:
+    with rio.open(f) as src:
+        bands = []
+        for band_num, dtype, nodata, description in zip(src.indexes, src.dtypes, src.nodatavals, src.descriptions):
+            # band name: description, else netcdf variable name, else band number
+            name = description or src.tags(band_num).get('NETCDF_VARNAME') or band_num
+            bands.append({
+                'band': band_num,
+                'dtype': rio.dtypes.typename_fwd[rio.dtypes.dtype_rev[dtype]],
+                'nodata': nodata,
+                'name': name
+            })
+
+        return {
+            'crs': pyproj.CRS(src.crs.to_wkt()) if src.crs is not None else None,
+            'transform': src.transform,
+            'width': src.width,
+            'height': src.height,
+            'count': src.count,
+            'bands': bands,
+            'subdatasets': list(src.subdatasets)
+        }
+
+
 def get_crs(
     f:str, 
     crs_type:str='wkt2_2019'
 )->pyproj.CRS:
-        wkt = subprocess.run(['gdalsrsinfo', f, '-o', crs_type], capture_output=True, text=True).stdout
-        return pyproj.CRS(wkt)
+        # for files with subdatasets and no crs of their own (e.g. .nc), use the first subdataset's crs
+        metadata = get_raster_metadata(f)
+        if (metadata['crs'] is None) and metadata['subdatasets']:
+            return get_crs(metadata['subdatasets'][0], crs_type)
+        return metadata['crs']
 
 
 def get_gdalinfo(f:str)->dict:
     output = {}
-    gdalinfo_json = subprocess.run(['gdalinfo', '-json', f], capture_output=True, text=True).stdout
-    gdalinfo_dict = json.loads(gdalinfo_json)
+    metadata = get_raster_metadata(f)
 
     # For .nc with subdatasets
-    if 'SUBDATASETS' in gdalinfo_dict['metadata'].keys():
+    if metadata['subdatasets']:
         # Iterate over all subdatasets
-        for metadata_key in gdalinfo_dict['metadata']['SUBDATASETS'].keys():
-            if '_NAME' in metadata_key:
-                subdataset_name = gdalinfo_dict['metadata']['SUBDATASETS'][metadata_key]
-                output[subdataset_name] = get_gdalinfo(subdataset_name)
+        for subdataset_name in metadata['subdatasets']:
+            output[subdataset_name] = get_gdalinfo(subdataset_name)
 
     else:
         # For tif or subdataset
         # If only 1 band, don't nest bands
-        bands = gdalinfo_dict['bands']
+        bands = metadata['bands']
         if len(bands) == 1:
-            output['dtype'] = bands[0]['type']
-            output['nodata'] = bands[0]['noDataValue']
+            output['dtype'] = bands[0]['dtype']
+            output['nodata'] = bands[0]['nodata']
         else:
             for band in bands:
-                band_num = band['band']
-                try:
-                    try:
-                        band_name = band['description']
-                    except:
-                        band_name = band['metadata']['']['NETCDF_VARNAME']
-                except:
-                    band_name = band_num # just default to band number if we can't find a name
-
-                output[band_num] = {
-                    'dtype': bands[0]['type'],
-                    'nodata': bands[0]['noDataValue'],
-                    'name': band_name
+                output[band['band']] = {
+                    'dtype': band['dtype'],
+                    'nodata': band['nodata'],
+                    'name': band['name']
                 }
 
     return output
@@ -230,45 +442,65 @@ def generate_sample_points():
     pass
 
 
-def clip_tif(clip_dir, f, minx, miny, maxx, maxy):
+def get_clip_window(src, minx:NumericType, miny:NumericType, maxx:NumericType, maxy:NumericType)->Window:
+    # pixel window of src covering the bbox (in src's crs), rounded out to whole pixels and cut to the raster, as in rio.clip_box
+    window = rio.windows.from_bounds(minx, miny, maxx, maxy, transform=src.transform)
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    window = Window.from_slices(
+        (max(int(np.floor(row_start)), 0), max(int(np.ceil(row_stop)), 0)),
+        (max(int(np.floor(col_start)), 0), max(int(np.ceil(col_stop)), 0))
+    )
+    return window.intersection(Window(0, 0, src.width, src.height))
+
+
+def clip_tif(clip_dir, f, minx, miny, maxx, maxy, window_size=CLIP_WINDOW_SIZE):
+    '''
+    Clip f to the bbox (in f's crs), saved as {clip_dir}{name}_clipped.tif (tiled, LZW) with f's dtype, nodata, and band names.
+    Only the bbox window is read from f, window_size x window_size pixels at a time, so memory doesn't scale with f.
+    '''
     f_new = clip_dir + f.split('/')[-1].replace('.tif', '_clipped.tif')
     if not os.path.exists(f_new):
-        print(f'Currently clipping {f}')
-        gdalinfo = get_gdalinfo(f)
-        dtype_orig, nodata_orig = gdalinfo['dtype'], gdalinfo['nodata']
-        print(dtype_orig, nodata_orig)
+        print(f'Currently clipping {f}', flush=True)
+        tmp_path = f'{f_new}.{os.getpid()}.tmp' # write then rename, so a partially clipped file is never skipped as done
+
+        with rio.open(f) as src:
+            clip_window = get_clip_window(src, minx, miny, maxx, maxy)
+            profile = {
+                'driver': 'GTiff',
+                'dtype': src.dtypes[0],
+                'nodata': src.nodata,
+                'count': src.count,
+                'crs': src.crs,
+                'transform': src.window_transform(clip_window),
+                'width': int(clip_window.width),
+                'height': int(clip_window.height),
+                'tiled': True,
+                'blockxsize': 512,
+                'blockysize': 512,
+                'compress': 'lzw',
+                'BIGTIFF': 'IF_SAFER'
+            }
+            print(f'{src.dtypes[0]} {src.nodata}: {src.width}x{src.height} -> {profile["width"]}x{profile["height"]}', flush=True)
+
+            with rio.open(tmp_path, 'w', **profile) as dst:
+                dst.descriptions = src.descriptions
+                for window in get_windows(profile['height'], profile['width'], window_size):
+                    src_window = Window(clip_window.col_off + window.col_off, clip_window.row_off + window.row_off, window.width, window.height)
+                    dst.write(src.read(window=src_window), window=window)
+
+        os.replace(tmp_path, f_new)
+        print(f'Successfully saved clipped tif to {f_new}', flush=True)
 
-        # Open the file to clip
-        dataset = xr.open_dataset(f)
-        
-        # Get riodataset for all vars and write crs
-        crs_info = dataset.variables['spatial_ref'].attrs
-        orig_crs = pyproj.CRS.from_cf(crs_info)
-        rds = dataset[dataset.rio.vars].squeeze()
-        rds.rio.set_spatial_dims(x_dim="x", y_dim="y", inplace=True)
-        rds.rio.write_crs(orig_crs, inplace=True)
-
-        # Clip to bbox
-        rds_clipped = rds.rio.clip_box(minx=minx, miny=miny, maxx=maxx, maxy=maxy, crs=orig_crs)
-        print(rds)
-        print(rds_clipped)
-
-        # Memory management
-        del dataset, rds
-        gc.collect()
-
-        # Save output
-        export_to_tiff(
-            rds_clipped,
-            out_path=f_new,
-            dtype_out=dtype_orig.lower(),
-            nodata=nodata_orig,
-            compression='LZW')
-
-        # Memory management
-        del rds_clipped
-        gc.collect()
-    
     else: print(f'Skipping {f}: Already in {clip_dir}')
 
-    return True
\ No newline at end of file
+    return True
+
+
+def clip_tifs(clip_dir, tifs_bboxes:list, n_processes:int=1)->bool:
+    # clip several tifs concurrently; tifs_bboxes is a list of (tif, (minx, miny, maxx, maxy)) with each bbox in its tif's crs
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(clip_tif, clip_dir, tif, *bbox) for tif, bbox in tifs_bboxes]
+        for future in as_completed(futures):
+            future.result()
+
+    return True
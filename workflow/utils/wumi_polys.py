@@ -0,0 +1,106 @@
+"""
+Compacted copy of the WUMI MTBS fire polygons, so runs don't read one shapefile per fire.
+
+All polygons are saved (once) to a single GeoPackage layer, with its own sqlite R-tree, next to the WUMI fire_maps dir.
+Each row has the fire's shapefile attributes (column names shortened as in get_wumi_mtbs_poly) plus its WUMI year.
+Later runs read just the rows in an ROI's bbox and year range.
+"""
+
+import os, glob
+import pandas as pd
+import geopandas as gpd
+import pyproj
+from multiprocessing import Pool
+from functools import partial
+
+WUMI_POLYS_FNAME = 'wumi_mtbs_polys.gpkg'
+WUMI_POLYS_LAYER = 'wumi_mtbs_polys'
+WUMI_YEAR_COL = 'wumi_year' # year of the fire_maps/{year}/ dir, only kept in the compacted file
+
+
+def get_wumi_polys_path(wumi_data_dir:str)->str:
+    # saved next to the WUMI fire_maps dir (shared by all ROIs)
+    return os.path.join(os.path.dirname(os.path.normpath(wumi_data_dir)), WUMI_POLYS_FNAME)
+
+
+def get_wumi_mtbs_poly(
+    wumi_data_dir:str,
+    wumi_projection: pyproj.CRS,
+    fireid_yr: tuple):
+    fireid, year = fireid_yr
+    # search in wumi_data_dir/year for mtbs shapefile
+    wumi_dir = os.path.join(wumi_data_dir, year, fireid)
+    f = glob.glob(os.path.join(wumi_dir, '*_mtbs*.shp'))
+
+    # ensure there's exactly 1 match and it's not a multipolygon, return output path
+    try:
+        # get .shp file
+        assert len(f) == 1, f'Found {len(f)} shapefiles in {os.path.join(wumi_dir, '*_mtbs*.shp')}, when there should be exactly 1. \nExiting.'
+        f = f[0]
+
+        # open shp file
+        gdf = gpd.read_file(f)
+        assert len(gdf)==1, f'{f} is a multipolygon. len({f})!=1. \nExiting.'
+
+        # format columns and set crs
+        gdf.columns = [s.replace('object','').replace('_','') for s in gdf.columns] # shorten column names
+        gdf = gdf.loc[:, ~gdf.columns.duplicated()].set_crs(wumi_projection)
+        return gdf
+    except:
+        return None
+
+
+def build_wumi_polys(
+    subfires_csv:str,
+    wumi_data_dir:str,
+    wumi_projection: pyproj.CRS,
+    out_path:str,
+    n_processes:int=1
+    )->str:
+    '''
+    One-time compaction: read every MTBS subfire's WUMI shapefile (in parallel, in subfires_csv order)
+    and save them all to one GPKG layer at out_path. Fires whose shapefile is missing/multipolygon are skipped, as before.
+    '''
+    subfires = pd.read_csv(subfires_csv)
+    subfires = subfires[subfires['dataset'].str.lower()=='mtbs']
+
+    args = list(zip(subfires['fireid'].astype('str'), subfires['year'].astype('str')))
+    print(f'Compacting {len(args)} WUMI MTBS polygons to {out_path}', flush=True)
+    with Pool(processes=n_processes) as pool:
+        wumi_polys = pool.map(partial(get_wumi_mtbs_poly, wumi_data_dir, wumi_projection), args, chunksize=64)
+
+    wumi_polys = [
+        gdf.assign(**{WUMI_YEAR_COL: int(year)})
+        for gdf, (_, year) in zip(wumi_polys, args) if gdf is not None
+    ]
+    merged_wumi = gpd.GeoDataFrame(pd.concat(wumi_polys, ignore_index=True), crs=wumi_projection)
+
+    # write then rename, so a failed run never leaves a partial file to be reused
+    tmp_path = out_path.replace('.gpkg', f'_tmp{os.getpid()}.gpkg')
+    merged_wumi.to_file(tmp_path, layer=WUMI_POLYS_LAYER, driver='GPKG')
+    os.replace(tmp_path, out_path)
+
+    print(f'Saved {len(merged_wumi)}/{len(args)} WUMI MTBS polygons to {out_path}', flush=True)
+    return out_path
+
+
+def read_wumi_polys(
+    wumi_polys_path:str,
+    bounds=None,
+    start_year:int=None,
+    end_year:int=None
+    )->gpd.GeoDataFrame:
+    '''
+    WUMI polygons (in the WUMI projection) intersecting the bbox bounds (minx, miny, maxx, maxy, in the WUMI projection),
+    with start_year <= WUMI year <= end_year. Only the matching rows are read (bbox via the R-tree).
+    '''
+    where = []
+    if start_year is not None: where.append(f'{WUMI_YEAR_COL} >= {int(start_year)}')
+    if end_year is not None: where.append(f'{WUMI_YEAR_COL} <= {int(end_year)}')
+
+    return gpd.read_file(
+        wumi_polys_path,
+        layer=WUMI_POLYS_LAYER,
+        bbox=tuple(bounds) if bounds is not None else None,
+        where=' AND '.join(where) if len(where) > 0 else None
+    )